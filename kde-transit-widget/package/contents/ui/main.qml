@@ -35,70 +35,156 @@ Item {
         xhr.send(JSON.stringify({}))
     }
     
+    // ETag of the last /api/trips/next we got, the server answers 304 while nothing changed
+    property string legsEtag: ""
+    
     function fetchLegs() {
         isLoading = true
         
+        // One call returns every tracked leg along with its estimates and incidents
         var xhr = new XMLHttpRequest()
         xhr.onreadystatechange = function() {
             if (xhr.readyState === XMLHttpRequest.DONE) {
-                if (xhr.status === 200) {
+                if (xhr.status === 304) {
+                    updateNextRefreshTime()
+                } else if (xhr.status === 200) {
+                    legsEtag = xhr.getResponseHeader("ETag") || ""
+                    
                     var data = JSON.parse(xhr.responseText)
-                    legs = data.legs
-                    legsUpdated()
+                    var newLegs = []
+                    var newEstimates = {}
                     
-                    for (var i = 0; i < legs.length; i++) {
-                        fetchEstimates(legs[i].id)
+                    for (var i = 0; i < data.legs.length; i++) {
+                        newLegs.push(data.legs[i].leg)
+                        newEstimates[data.legs[i].leg.id] = data.legs[i]
                     }
+                    
+                    legs = newLegs
+                    estimates = newEstimates
+                    legsUpdated()
+                    estimatesUpdated()
+                    updateNextRefreshTime()
                 } else {
                     console.log("Error fetching legs: " + xhr.status)
-                    isLoading = false
                 }
+                isLoading = false
             }
         }
         
-        xhr.open("GET", serverUrl + "/api/trips/")
+        xhr.open("GET", serverUrl + "/api/trips/next")
         xhr.setRequestHeader("Authorization", "Basic " + Qt.btoa(username + ":" + password))
+        if (legsEtag) {
+            xhr.setRequestHeader("If-None-Match", legsEtag)
+        }
         xhr.send()
     }
     
-    function fetchEstimates(legId) {
+    // Server-sent events of /api/trips/stream: the server pushes legs when they change
+    property var streamXhr: null
+    property bool streamConnected: false
+    property int streamOffset: 0
+    
+    function connectStream() {
+        if (streamXhr) {
+            streamXhr.onreadystatechange = null
+            streamXhr.abort()
+        }
+        streamOffset = 0
+        
         var xhr = new XMLHttpRequest()
         xhr.onreadystatechange = function() {
-            if (xhr.readyState === XMLHttpRequest.DONE) {
+            if (xhr.readyState === XMLHttpRequest.LOADING || xhr.readyState === XMLHttpRequest.DONE) {
                 if (xhr.status === 200) {
-                    var data = JSON.parse(xhr.responseText)
-                    estimates[legId] = data
-                    estimatesUpdated()
-                } else {
-                    console.log("Error fetching estimates for leg " + legId + ": " + xhr.status)
-                }
-                
-                var allLoaded = true
-                for (var i = 0; i < legs.length; i++) {
-                    if (!estimates[legs[i].id]) {
-                        allLoaded = false
-                        break
-                    }
-                }
-                
-                if (allLoaded) {
-                    isLoading = false
-                    updateNextRefreshTime()
+                    streamConnected = true
+                    readStreamEvents(xhr)
                 }
             }
+            if (xhr.readyState === XMLHttpRequest.DONE) {
+                // Polling takes over until we are connected again
+                streamConnected = false
+                streamXhr = null
+                reconnectTimer.start()
+            }
         }
         
-        xhr.open("GET", serverUrl + "/api/trips/" + legId + "/next")
+        xhr.open("GET", serverUrl + "/api/trips/stream")
         xhr.setRequestHeader("Authorization", "Basic " + Qt.btoa(username + ":" + password))
+        xhr.setRequestHeader("Accept", "text/event-stream")
         xhr.send()
+        streamXhr = xhr
+    }
+    
+    function readStreamEvents(xhr) {
+        var text = xhr.responseText
+        var end = text.lastIndexOf("\n\n")
+        if (end < streamOffset) {
+            return
+        }
+        
+        var events = text.substring(streamOffset, end).split("\n\n")
+        streamOffset = end + 2
+        
+        for (var i = 0; i < events.length; i++) {
+            var lines = events[i].split("\n")
+            for (var j = 0; j < lines.length; j++) {
+                // Keep-alive comments start with ":"
+                if (lines[j].indexOf("data: ") === 0) {
+                    applyStreamEvent(JSON.parse(lines[j].substring(6)))
+                }
+            }
+        }
+        
+        // The response keeps growing as long as it is open, start a fresh one once in a while
+        if (streamOffset > 1000000) {
+            connectStream()
+        }
+    }
+    
+    function applyStreamEvent(data) {
+        var newEstimates = {}
+        for (var legId in estimates) {
+            newEstimates[legId] = estimates[legId]
+        }
+        for (var i = 0; i < data.removed.length; i++) {
+            delete newEstimates[data.removed[i]]
+        }
+        for (var k = 0; k < data.legs.length; k++) {
+            newEstimates[data.legs[k].leg.id] = data.legs[k]
+        }
+        
+        var newLegs = []
+        for (var l = 0; l < legs.length; l++) {
+            if (newEstimates[legs[l].id]) {
+                newLegs.push(newEstimates[legs[l].id].leg)
+            }
+        }
+        for (var id in newEstimates) {
+            if (!legs.some(function(leg) { return leg.id == id })) {
+                newLegs.push(newEstimates[id].leg)
+            }
+        }
+        
+        legs = newLegs
+        estimates = newEstimates
+        legsUpdated()
+        estimatesUpdated()
+        updateNextRefreshTime()
+    }
+    
+    Timer {
+        id: reconnectTimer
+        interval: 30000
+        repeat: false
+        onTriggered: connectStream()
     }
     
     property var nextRefreshTime: new Date()
     
+    // Fallback for when the stream is down
     Timer {
         id: refreshTimer
         interval: 60000
-        running: true
+        running: !streamConnected
         repeat: true
         onTriggered: checkRefresh()
     }
@@ -169,12 +255,13 @@ Item {
     
     Component.onCompleted: {
         fetchLegs()
+        connectStream()
     }
     
     Connections {
         target: plasmoid.configuration
-        function onServerUrlChanged() { fetchLegs() }
-        function onUsernameChanged() { fetchLegs() }
-        function onPasswordChanged() { fetchLegs() }
+        function onServerUrlChanged() { legsEtag = ""; fetchLegs(); connectStream() }
+        function onUsernameChanged() { fetchLegs(); connectStream() }
+        function onPasswordChanged() { fetchLegs(); connectStream() }
     }
 }
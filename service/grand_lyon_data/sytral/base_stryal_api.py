@@ -1,71 +1,251 @@
+import asyncio
 import base64
-from datetime import datetime
+from collections import Counter
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta
 import re
-import requests
+import threading
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable
+
+import httpx
+
+from grand_lyon_data.sytral.json_stream import JsonRowsDecoder
+from grand_lyon_data.sytral.row_filter import RowFilter
+from instrumentation.metrics import Metrics
+from instrumentation.profiling import Profiler
+from worker_pool.worker_pool import WorkerPool
+
+metrics = Metrics.get_instance()
+page_fetch_seconds = metrics.histogram(
+    "tcl_page_fetch_seconds",
+    "Time to stream one page from upstream, rows decoded included",
+    ("dataset",),
+)
+page_bytes = metrics.counter(
+    "tcl_page_bytes_total", "Bytes downloaded from upstream", ("dataset",)
+)
+refresh_seconds = metrics.histogram(
+    "tcl_refresh_seconds",
+    "Duration of successful cache refreshes",
+    ("dataset",),
+)
+refresh_failures = metrics.counter(
+    "tcl_refresh_failures_total", "Cache refreshes that failed", ("dataset",)
+)
+refresh_rows = metrics.counter(
+    "tcl_refresh_rows_total",
+    "Rows seen by cache refreshes, by what became of them",
+    ("dataset", "outcome"),
+)
+
+
+@dataclass
+class RefreshStats:
+    added: int = 0
+    updated: int = 0
+    removed: int = 0
+    unchanged: int = 0
+    incremental: bool = False
+    duration_seconds: float = 0
+    # HTTP requests made to upstream
+    requests: int = 0
+    # Rows that could not be parsed into records, they are left out of the cache
+    rejected: int = 0
+    # Rows downloaded but dropped by the row filter
+    filtered: int = 0
+
+    @property
+    def changed(self) -> int:
+        return self.added + self.updated + self.removed
+
+    @property
+    def change_ratio(self) -> float:
+        total = self.added + self.updated + self.unchanged
+        return self.changed / total if total else 0
+
+    def to_dict(self):
+        return {
+            "added": self.added,
+            "updated": self.updated,
+            "removed": self.removed,
+            "unchanged": self.unchanged,
+            "incremental": self.incremental,
+            "duration_seconds": self.duration_seconds,
+            "requests": self.requests,
+            "rejected": self.rejected,
+            "filtered": self.filtered,
+        }
 
 
-class HashableDict:
-    def __init__(self, dictionary):
-        self.dict = dictionary
-        self._hash = hash(HashableDict.make_dict_hashable(dictionary))
+class SytralAPICache:
+    """
+    Upstream rows parsed into records once, at ingest, keyed by `SytralAPI.row_key`,
+    with secondary indexes on the record fields we query.
 
-    def __hash__(self):
-        return self._hash
+    Each index maps the distinct values of a field (as strings) to the keys of the records holding them.
+    Records whose field is a tuple are indexed under each of its items.
+    - exact lookups are a dictionary access
+    - regex lookups are evaluated once per distinct value, and remembered until the cache changes,
+      or until max_pattern_matches patterns are remembered: they are then all forgotten
 
-    def __eq__(self, other):
-        if isinstance(other, HashableDict):
-            return self.dict == other.dict
-        return False
+    Lookups on fields that are not indexed fall back to a scan of all records.
 
-    @classmethod
-    def make_dict_hashable(cls, d):
-        """Convert a dictionary to a hashable representation."""
-        # Sort items by key and convert to tuple of tuples
-        return tuple(
-            sorted((k, cls.make_value_hashable(v)) for k, v in d.items())
-        )
+    A cache is filled once by `SytralAPI.refresh_cache` then published as a read-only snapshot.
+    """
 
-    @classmethod
-    def make_value_hashable(cls, value):
-        """Make a value hashable, handling nested dictionaries and lists."""
-        if isinstance(value, dict):
-            return cls.make_dict_hashable(value)
-        elif isinstance(value, list):
-            return tuple(cls.make_value_hashable(v) for v in value)
-        elif isinstance(value, set):
-            return tuple(sorted(cls.make_value_hashable(v) for v in value))
-        else:
-            return value
+    max_pattern_matches = 1024
 
+    def __init__(
+        self, index_fields: tuple[str, ...] = (), *, generation: int = 0
+    ):
+        # Incremented by every successful refresh, identifies the snapshot
+        self.generation = generation
+        self.refreshed_at: datetime | None = None
+        self.entries: dict[tuple, Any] = {}
+        # Upstream last_update_fme of each entry, tells incremental refreshes what they can reuse
+        self.versions: dict[tuple, str | None] = {}
+        # Position of each entry in upstream order, lookups return their matches in that order
+        self.positions: dict[tuple, int] = {}
+        self.indexes: dict[str, dict[str, set[tuple]]] = {
+            field: {} for field in index_fields
+        }
+        # (field, pattern) -> indexed values matching the pattern
+        self._pattern_matches: dict[tuple[str, re.Pattern[str]], list[str]] = {}
 
-class SytralAPICache:
-    def __init__(self):
-        self.entries = set()
-
-    def add(self, entry: dict):
-        self.entries.add(HashableDict(entry))
+    def add(
+        self, key: tuple, entry: Any, *, version: str | None = None
+    ) -> tuple | None:
+        """
+        Insert entry under key. Returns the key it was stored under, None for an exact duplicate.
 
-    def clear(self):
-        self.entries = set()
+        Rows sharing a key but not their content are all kept, later ones get a suffixed key.
+        """
+        while key in self.entries:
+            if self.entries[key] == entry:
+                return None
+            key = (*key, "dup")
+
+        self.positions[key] = len(self.entries)
+        self.entries[key] = entry
+        self.versions[key] = version
+        for field, index in self.indexes.items():
+            value = getattr(entry, field, None)
+            for item in value if isinstance(value, tuple) else (value,):
+                if item is not None:
+                    index.setdefault(str(item), set()).add(key)
+
+        self._pattern_matches.clear()
+
+        return key
+
+    def get_entry(
+        self, key: str, value: str | re.Pattern[str], *, exact: bool = False
+    ) -> list:
+        """
+        Records where `re.search(value, str(record.key))` matches, or where `str(record.key) == value` if exact.
+        """
+        return self.get_entries({key: value}, exact=exact)
 
-    def get_entry(self, key: str, value: str | re.Pattern[str]) -> set[dict]:
+    def get_entries(
+        self,
+        criteria: dict[str, str | re.Pattern[str]],
+        *,
+        exact: bool = False,
+    ) -> list:
         """
-        O(n) search through HashableDict entries
+        Records matching all criteria, see `get_entry`, in the order upstream sent them.
         """
-        matches = set()
+        matches: set[tuple] | None = None
+        for key, value in criteria.items():
+            key_matches = (
+                self._match_exact(key, value)
+                if exact
+                else self._match_pattern(key, value)
+            )
+            matches = (
+                key_matches
+                if matches is None
+                else matches.intersection(key_matches)
+            )
+
+            if not matches:
+                return []
+
+        if not matches:
+            return []
+
+        return [
+            self.entries[key]
+            for key in sorted(matches, key=self.positions.__getitem__)
+        ]
+
+    def _match_exact(
+        self, key: str, value: str | re.Pattern[str]
+    ) -> set[tuple]:
+        if isinstance(value, re.Pattern):
+            raise ValueError("Exact lookups need a plain string value")
+
+        if key in self.indexes:
+            return self.indexes[key].get(value, set())
+
+        return {
+            entry_key
+            for entry_key, entry in self.entries.items()
+            if getattr(entry, key, None) is not None
+            and str(getattr(entry, key)) == value
+        }
 
-        for entry in self.entries:
-            if key in entry.dict and re.search(value, str(entry.dict[key])):
-                matches.add(entry.dict)
+    def _match_pattern(
+        self, key: str, value: str | re.Pattern[str]
+    ) -> set[tuple]:
+        pattern = re.compile(value)
+
+        if key not in self.indexes:
+            return {
+                entry_key
+                for entry_key, entry in self.entries.items()
+                if getattr(entry, key, None) is not None
+                and pattern.search(str(getattr(entry, key)))
+            }
+
+        index = self.indexes[key]
+        matching_values = self._pattern_matches.get((key, pattern))
+        if matching_values is None:
+            matching_values = [v for v in index if pattern.search(v)]
+            if len(self._pattern_matches) >= self.max_pattern_matches:
+                self._pattern_matches.clear()
+            self._pattern_matches[(key, pattern)] = matching_values
+
+        if len(matching_values) == 1:
+            return index[matching_values[0]]
+
+        matches: set[tuple] = set()
+        for matching_value in matching_values:
+            matches.update(index[matching_value])
 
         return matches
 
 
 class SytralAPI:
+    # Fields the cache maintains a lookup index for, see `SytralAPICache`
+    index_fields: tuple[str, ...] = ()
+    # Fields identifying a row across refreshes, see `row_key`
+    key_fields: tuple[str, ...] = ("id",)
+    # Record each row is parsed into at ingest, anything with a `from_dict(row)` classmethod
+    record_type: Any = None
+    # Above this many values, a server side filter costs more requests than a full scan
+    max_server_queries = 8
+    # Idle connections are kept for the next refresh, a minute later at the soonest
+    keepalive_seconds = 120
+
     def __init__(
         self,
         *,
         maxfeatures: int | None = 1000,
+        max_workers: int = 4,
+        timeout: float = 30,
         username: str = "demo",
         password: str = "demo4dev",
         url_base: str,
@@ -79,65 +259,402 @@ class SytralAPI:
         self.url_base = url_base
         self.route = route
         self.filename = filename
-        self.cache = SytralAPICache()
+        # Published snapshot, only ever replaced as a whole by refresh_cache
+        self.cache = SytralAPICache(type(self).index_fields)
+        self.last_refresh_failed_at: datetime | None = None
+        self.last_refresh_error: str | None = None
+        self.last_refresh_stats: RefreshStats | None = None
+        # Called after every successful refresh, once the new snapshot is published
+        self.refresh_listeners: list[Callable[[], None]] = []
+        # Called at the start of every refresh, rows it rejects are left out of the cache.
+        # None, or returning None, keeps everything.
+        self.row_filter: Callable[[], RowFilter | None] | None = None
+        # Total number of HTTP requests made upstream, refreshes can run from several threads
+        self.requests_made = 0
+        self._requests_lock = threading.Lock()
 
         # Number of entries to query at once
         self.maxfeatures = maxfeatures
+        # Number of pages fetched concurrently
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def dataset(self) -> str:
+        """
+        Name of the upstream dataset, e.g. `tcl_sytral.tclpassagearret`.
+        """
+        return self.route.split("/")[0]
 
-        self.cache_refreshed_at: datetime | None = None
+    @property
+    def cache_refreshed_at(self) -> datetime | None:
+        return self.cache.refreshed_at
 
-    def refresh_cache(self):
-        self.cache.clear()
+    def cache_age(self) -> timedelta | None:
+        refreshed_at = self.cache.refreshed_at
+        return datetime.now() - refreshed_at if refreshed_at else None
 
-        all_rows = self.get_all()
-        for row in all_rows:
-            self.cache.add(row)
+    def row_key(self, row: dict) -> tuple:
+        return tuple(row.get(field) for field in type(self).key_fields)
 
-        self.cache_refreshed_at = datetime.now()
+    def parse_row(self, row: dict) -> Any:
+        return type(self).record_type.from_dict(row)
+
+    def refresh_cache(self, *, incremental: bool = True) -> RefreshStats:
+        """
+        Blocking version of `refresh_cache_async`, for threads without an event loop (scheduler jobs, worker pool).
+        The refresh itself runs on the worker pool's event loop, alongside the other ones,
+        the calling thread only waits for it.
+        Profiled when an admin asked for it, see `Profiler`.
+        """
+        return (
+            WorkerPool.get_instance()
+            .run_coroutine(self._profiled_refresh(incremental))
+            .result()
+        )
+
+    async def _profiled_refresh(self, incremental: bool) -> RefreshStats:
+        with Profiler.get_instance().profile("refresh", self.dataset):
+            return await self.refresh_cache_async(incremental=incremental)
+
+    async def refresh_cache_async(
+        self, *, incremental: bool = True
+    ) -> RefreshStats:
+        """
+        Build a complete new cache off to the side then publish it with a single reference swap.
+
+        Readers never see a partial cache: in-flight lookups keep the snapshot they started with.
+        If fetching fails, the last good snapshot keeps being served and the error is raised.
+
+        Every row is parsed into a record (see `parse_row`) here, once, rather than by every lookup.
+        In incremental mode, rows whose key and last_update_fme did not change since the previous
+        snapshot reuse its record rather than being parsed again. Rows sharing a key are matched
+        with the previous entries under that key in turn, not all with the first one.
+        Rows gone from upstream are dropped either way, rows that fail to parse are counted and left out.
+
+        Pages are streamed (see `iter_rows`): rows go into the new cache as they are decoded,
+        no page is ever held in memory as a whole.
+
+        With a `row_filter`, irrelevant rows are dropped on arrival, and when it allows
+        only rows matching them are requested from upstream in the first place.
+        """
+        started_at = datetime.now()
+        previous = self.cache
+        cache = SytralAPICache(
+            type(self).index_fields, generation=previous.generation + 1
+        )
+        stats = RefreshStats(incremental=incremental)
+        # Rows seen so far per key
+        occurrences: Counter[tuple] = Counter()
+        requests_before = self.requests_made
+        row_filter = self.row_filter() if self.row_filter else None
+        queries = (
+            row_filter.server_queries(type(self).max_server_queries)
+            if row_filter
+            else [{}]
+        )
+
+        try:
+            async for row in self.iter_rows(queries):
+                if row_filter and not row_filter.accepts(row):
+                    stats.filtered += 1
+                    continue
+
+                key = self.row_key(row)
+                # The nth row under key is matched with the nth entry stored under it, see `SytralAPICache.add`
+                previous_key = (*key, *["dup"] * occurrences[key])
+                occurrences[key] += 1
+                known = previous.entries.get(previous_key)
+                version = row.get("last_update_fme")
+
+                if (
+                    incremental
+                    and known is not None
+                    and version is not None
+                    and previous.versions.get(previous_key) == version
+                ):
+                    entry = known
+                else:
+                    try:
+                        entry = self.parse_row(row)
+                    except (KeyError, TypeError, ValueError) as error:
+                        stats.rejected += 1
+                        print(f"Skipping malformed row {key}: {error!r}")
+                        continue
+
+                stored_key = cache.add(key, entry, version=version)
+                if stored_key is None:
+                    continue
+
+                known = previous.entries.get(stored_key)
+                if known is None:
+                    stats.added += 1
+                elif known is entry or known == entry:
+                    stats.unchanged += 1
+                else:
+                    stats.updated += 1
+        except Exception as error:
+            self.last_refresh_failed_at = datetime.now()
+            self.last_refresh_error = repr(error)
+            refresh_failures.inc(self.dataset)
+            raise
+
+        stats.requests = self.requests_made - requests_before
+        stats.removed = len(previous.entries.keys() - cache.entries.keys())
+        cache.refreshed_at = datetime.now()
+        stats.duration_seconds = (
+            cache.refreshed_at - started_at
+        ).total_seconds()
+
+        self.last_refresh_stats = stats
+        refresh_seconds.observe(stats.duration_seconds, self.dataset)
+        for outcome in [
+            "added",
+            "updated",
+            "removed",
+            "unchanged",
+            "rejected",
+            "filtered",
+        ]:
+            refresh_rows.inc(
+                self.dataset, outcome, amount=getattr(stats, outcome)
+            )
+        self._publish(cache)
+
+        return stats
+
+    def adopt(self, cache: SytralAPICache):
+        """
+        Publish a snapshot refreshed somewhere else, see `modules.refresh.publication`.
+        """
+        self._publish(cache)
+
+    def dump_cache(self) -> dict:
+        """
+        The published snapshot as plain JSON data, its records back in their upstream row format.
+        See `load_cache`.
+        """
+        cache = self.cache
+
+        return {
+            "generation": cache.generation,
+            "refreshed_at": cache.refreshed_at.isoformat()
+            if cache.refreshed_at
+            else None,
+            "rows": [
+                [list(key), cache.versions.get(key), entry.to_dict()]
+                for key, entry in cache.entries.items()
+            ],
+        }
+
+    def load_cache(self, document: dict) -> SytralAPICache:
+        """
+        Rebuild the snapshot `dump_cache` dumped, indexes included.
+        """
+        cache = SytralAPICache(
+            type(self).index_fields, generation=document["generation"]
+        )
+        for key, version, row in document["rows"]:
+            cache.add(tuple(key), self.parse_row(row), version=version)
+        if document["refreshed_at"]:
+            cache.refreshed_at = datetime.fromisoformat(
+                document["refreshed_at"]
+            )
+
+        return cache
+
+    def _publish(self, cache: SytralAPICache):
+        self.cache = cache
+
+        for listener in self.refresh_listeners:
+            listener()
+
+    @asynccontextmanager
+    async def client(self) -> AsyncIterator[httpx.AsyncClient]:
+        """
+        Client to fetch pages with, one connection per concurrently fetched page.
+
+        On the worker pool's event loop, where refreshes run, it is the API's long-lived client:
+        its keep-alive connections are reused across pages and refreshes, until `close`.
+        On any other event loop, which its connections can't be used from, a client for this refresh only.
+        """
+        if asyncio.get_running_loop() is not WorkerPool.get_instance().loop:
+            async with self._new_client() as client:
+                yield client
+            return
+
+        # Only ever touched from the pool's event loop thread
+        if self._client is None:
+            self._client = self._new_client()
+        yield self._client
+
+    def close(self):
+        """
+        Close the long-lived client, see `client`. A later refresh opens a new one.
+        """
+        client, self._client = self._client, None
+        if client is not None:
+            WorkerPool.get_instance().run_coroutine(client.aclose()).result()
+
+    def _new_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(
+            headers={"Authorization": f"Basic {self.auth_bytes}"},
+            timeout=self.timeout,
+            limits=httpx.Limits(
+                max_connections=self.max_workers,
+                max_keepalive_connections=self.max_workers,
+                keepalive_expiry=self.keepalive_seconds,
+            ),
+        )
 
     def query(
-        self, start: int, maxfeatures: int | None = None
-    ) -> requests.Response:
+        self,
+        client: httpx.AsyncClient,
+        start: int,
+        maxfeatures: int | None = None,
+        filters: dict[str, str] | None = None,
+    ):
+        """
+        Streamed request for the page starting at start, to use as `async with self.query(...) as response`.
+        filters are extra query parameters, like the `field` and `value` of a server side filter.
+        """
         maxfeatures = maxfeatures if maxfeatures else self.maxfeatures
 
         params = {
             "maxfeatures": maxfeatures,
             "start": start,
             "filename": self.filename,
+            **(filters if filters else {}),
         }
 
-        headers = {"Authorization": f"Basic {self.auth_bytes}"}
-
-        response = requests.get(
+        return client.stream(
+            "GET",
             f"{self.url_base}/{self.route}",
             params=params,
-            headers=headers,
         )
 
-        return response
-
-    def get_all(self) -> list[dict[str, str]]:
-        start = 1
-        all: list[dict[str, str]] = []
-
-        while True:
-            response = self.query(start)
+    async def stream_page(
+        self,
+        client: httpx.AsyncClient,
+        start: int,
+        on_row: Callable[[dict], Awaitable[None]],
+        filters: dict[str, str] | None = None,
+    ) -> tuple[int, int | None]:
+        """
+        Hand the rows of the page starting at start to on_row as they are decoded off the wire.
+        Returns the number of rows in the page and the total number of rows upstream, if it says.
+        """
+        with self._requests_lock:
+            self.requests_made += 1
 
+        started_at = time.perf_counter()
+        async with self.query(client, start, filters=filters) as response:
             if response.status_code != 200:
                 raise RuntimeError(
                     f"Data GrandLyon returned {response.status_code}",
                     dict(response=response),
                 )
 
-            response = response.json()
-            data = response.get("values", [])
+            decoder = JsonRowsDecoder("values")
+            count = 0
+            async for chunk in response.aiter_text():
+                for row in decoder.feed(chunk):
+                    count += 1
+                    await on_row(row)
+            for row in decoder.close():
+                count += 1
+                await on_row(row)
+
+        page_fetch_seconds.observe(
+            time.perf_counter() - started_at, self.dataset
+        )
+        page_bytes.inc(self.dataset, amount=response.num_bytes_downloaded)
+        total = decoder.members.get("nb_results")
+        return count, int(total) if total is not None else None
 
-            if len(data) == 0:
-                break
+    async def iter_rows(
+        self, queries: list[dict[str, str]] | None = None
+    ) -> AsyncIterator[dict[str, str]]:
+        """
+        Yield upstream rows one at a time as they arrive, in no particular order.
+        queries are the filters (see `query`) of each scan to run, one after the other, by default a single full scan.
 
-            for row in data:
-                all.append(row)
+        The first page tells us the page size the server actually uses and, when it reports it, the total number of rows.
+        The following pages are then fetched up to max_workers at a time.
+        Without a total we keep max_workers pages in flight until one comes back short.
 
-            start += len(data)
+        Pages are decoded as they stream in and rows handed over through a queue of at most one page:
+        when the consumer falls behind, reading from the network pauses.
+        Memory is bounded by a page, however big the dataset.
+        """
+        rows: asyncio.Queue = asyncio.Queue(
+            maxsize=self.maxfeatures if self.maxfeatures else 1000
+        )
+        finished = object()
+
+        async def fetch():
+            try:
+                async with self.client() as client:
+                    for filters in queries if queries is not None else [{}]:
+                        await scan(client, filters)
+            finally:
+                await rows.put(finished)
+
+        async def scan(client: httpx.AsyncClient, filters: dict[str, str]):
+            page_size, total = await self.stream_page(
+                client, 1, rows.put, filters
+            )
+            if page_size == 0:
+                return
+
+            next_start = 1 + page_size
+            exhausted = False
+            in_flight: set[asyncio.Task] = set()
+
+            try:
+                while True:
+                    while (
+                        not exhausted
+                        and len(in_flight) < self.max_workers
+                        and (total is None or next_start <= total)
+                    ):
+                        in_flight.add(
+                            asyncio.create_task(
+                                self.stream_page(
+                                    client, next_start, rows.put, filters
+                                )
+                            )
+                        )
+                        next_start += page_size
+
+                    if not in_flight:
+                        break
+
+                    done, in_flight = await asyncio.wait(
+                        in_flight, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        if task.result()[0] < page_size:
+                            exhausted = True
+            finally:
+                for task in in_flight:
+                    task.cancel()
+                await asyncio.gather(*in_flight, return_exceptions=True)
+
+        fetcher = asyncio.create_task(fetch())
+        try:
+            while (row := await rows.get()) is not finished:
+                yield row
+
+            # Raises whatever made fetching stop
+            await fetcher
+        finally:
+            fetcher.cancel()
+            await asyncio.gather(fetcher, return_exceptions=True)
+
+    def get_all(self) -> list[dict[str, str]]:
+        async def collect():
+            return [row async for row in self.iter_rows()]
 
-        return all
+        return asyncio.run(collect())
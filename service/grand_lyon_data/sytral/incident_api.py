@@ -5,7 +5,7 @@ import re
 from grand_lyon_data.sytral.base_stryal_api import SytralAPI
 
 
-@dataclass
+@dataclass(frozen=True, eq=True, slots=True)
 class Incident:
     type: str
     cause: str
@@ -43,10 +43,36 @@ class Incident:
             listeobjet=data["listeobjet"],
         )
 
+    def to_dict(self) -> dict:
+        """
+        Upstream row this record parses from, `from_dict(to_dict())` gives it back.
+        """
+        return {
+            "type": self.type,
+            "cause": self.cause,
+            "debut": self.debut,
+            "fin": self.fin,
+            "mode": self.mode,
+            "ligne_com": self.ligne_com,
+            "ligne_cli": self.ligne_cli,
+            "titre": self.titre,
+            "message": self.message,
+            "last_update_fme": self.last_update_fme.isoformat(),
+            "n": self.n,
+            "typeseverite": self.typeseverite,
+            "niveauseverite": self.niveauseverite,
+            "typeobjet": self.typeobjet,
+            "listeobjet": self.listeobjet,
+        }
+
 
 class GrandLyonIncidentApi(SytralAPI):
     route = "tcl_sytral.tclalertetrafic_2/all.json"
     filename = "alertes-trafic-reseau-transports-commun-lyonnais-v2"
+    index_fields = ("ligne_com",)
+    # One row per alert and line it applies to
+    key_fields = ("n", "ligne_cli")
+    record_type = Incident
 
     _instance: "GrandLyonIncidentApi | None" = None
 
@@ -83,7 +109,4 @@ class GrandLyonIncidentApi(SytralAPI):
         if force_refetch:
             self.refresh_cache()
 
-        return [
-            Incident.from_dict(entry)
-            for entry in self.cache.get_entry("line_com", line_ref)
-        ]
+        return self.cache.get_entry("ligne_com", line_ref)
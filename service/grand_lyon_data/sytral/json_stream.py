@@ -0,0 +1,141 @@
+import json
+from typing import Any, Iterator
+
+WHITESPACE = " \t\n\r"
+
+# Returned when the buffer does not hold a complete value yet, None being a valid one
+INCOMPLETE = object()
+
+
+class JsonRowsDecoder:
+    """
+    Incremental decoder for Grand Lyon pages: `{"nb_results": ..., "values": [{...}, {...}], ...}`.
+
+    Feed it the body chunk by chunk as it arrives: the elements of the array_member array are yielded
+    as soon as they are complete, so a page is never held in memory as a whole.
+    Other top-level members are small and end up in `members`.
+    """
+
+    def __init__(self, array_member: str = "values"):
+        self.array_member = array_member
+        self.members: dict[str, Any] = {}
+
+        self._decoder = json.JSONDecoder()
+        self._buffer = ""
+        self._position = 0
+        self._state = "object_start"
+        self._key: str | None = None
+        self._final = False
+
+    def feed(self, chunk: str) -> Iterator[Any]:
+        self._buffer = self._buffer[self._position :] + chunk
+        self._position = 0
+
+        while self._state != "done":
+            if not self._skip_whitespace():
+                return
+
+            char = self._buffer[self._position]
+            state = self._state
+
+            if state == "object_start":
+                self._expect(char, "{")
+                self._state = "key_or_end"
+            elif state in ["key_or_end", "key"]:
+                if char == "}" and state == "key_or_end":
+                    self._position += 1
+                    self._state = "done"
+                    continue
+
+                key = self._decode()
+                if key is INCOMPLETE:
+                    return
+                self._key = key
+                self._state = "colon"
+            elif state == "colon":
+                self._expect(char, ":")
+                self._state = (
+                    "array_start"
+                    if self._key == self.array_member
+                    else "member_value"
+                )
+            elif state == "member_value":
+                value = self._decode()
+                if value is INCOMPLETE:
+                    return
+                self.members[self._key] = value
+                self._state = "member_separator"
+            elif state == "member_separator":
+                if char == "}":
+                    self._position += 1
+                    self._state = "done"
+                else:
+                    self._expect(char, ",")
+                    self._state = "key"
+            elif state == "array_start":
+                self._expect(char, "[")
+                self._state = "item_or_end"
+            elif state in ["item_or_end", "item"]:
+                if char == "]" and state == "item_or_end":
+                    self._position += 1
+                    self._state = "member_separator"
+                    continue
+
+                item = self._decode()
+                if item is INCOMPLETE:
+                    return
+                self._state = "item_separator"
+                yield item
+            elif state == "item_separator":
+                if char == "]":
+                    self._position += 1
+                    self._state = "member_separator"
+                else:
+                    self._expect(char, ",")
+                    self._state = "item"
+
+    def close(self) -> Iterator[Any]:
+        """
+        Flush what is left once the body is complete, raises ValueError if it was truncated.
+        """
+        self._final = True
+        yield from self.feed("")
+
+        if self._state != "done":
+            raise ValueError(f"Truncated JSON page, stopped at {self._state}")
+
+    def _skip_whitespace(self) -> bool:
+        while (
+            self._position < len(self._buffer)
+            and self._buffer[self._position] in WHITESPACE
+        ):
+            self._position += 1
+
+        return self._position < len(self._buffer)
+
+    def _expect(self, char: str, expected: str):
+        if char != expected:
+            raise ValueError(
+                f"Unexpected {char!r} in JSON page, expected {expected!r}"
+            )
+        self._position += 1
+
+    def _decode(self) -> Any:
+        """
+        Decode the value at the current position, INCOMPLETE if it is not complete yet.
+
+        A value running to the very end of the buffer could be a number cut in half,
+        it is only trusted once something follows it or the body is complete.
+        """
+        try:
+            value, end = self._decoder.raw_decode(self._buffer, self._position)
+        except json.JSONDecodeError:
+            if self._final:
+                raise
+            return INCOMPLETE
+
+        if end == len(self._buffer) and not self._final:
+            return INCOMPLETE
+
+        self._position = end
+        return value
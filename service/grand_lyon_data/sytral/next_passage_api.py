@@ -5,7 +5,7 @@ import re
 from grand_lyon_data.sytral.base_stryal_api import SytralAPI
 
 
-@dataclass(frozen=True, eq=True)
+@dataclass(frozen=True, eq=True, slots=True)
 class NextPassageLine:
     id: int
     type: str
@@ -26,6 +26,17 @@ class NextPassageLine:
     delaipassage: timedelta
     heurepassage: datetime
 
+    @property
+    def trip_ids(self) -> tuple[str, ...]:
+        """
+        What of coursetheorique can be a GTFS trip id: all of it, and each of its `:` separated parts.
+        """
+        parts = self.coursetheorique.split(":")
+
+        return (
+            (self.coursetheorique, *parts) if len(parts) > 1 else tuple(parts)
+        )
+
     @classmethod
     def parse_delaipassage(cls, delta_str: str) -> timedelta:
         if delta_str == "Proche":
@@ -50,6 +61,26 @@ class NextPassageLine:
             delaipassage=cls.parse_delaipassage(data["delaipassage"]),
         )
 
+    def to_dict(self) -> dict:
+        """
+        Upstream row this record parses from, `from_dict(to_dict())` gives it back.
+        """
+        minutes = int(self.delaipassage.total_seconds()) // 60
+
+        return {
+            "id": str(self.id),
+            "type": self.type,
+            "ligne": self.ligne,
+            "direction": self.direction,
+            "idtarretdestination": str(self.idtarretdestination)
+            if self.idtarretdestination is not None
+            else "",
+            "coursetheorique": self.coursetheorique,
+            "last_update_fme": self.last_update_fme.isoformat(),
+            "heurepassage": self.heurepassage.isoformat(),
+            "delaipassage": f"{minutes} min" if minutes else "Proche",
+        }
+
 
 class GrandLyonNextPassageApi(SytralAPI):
     """
@@ -63,6 +94,11 @@ class GrandLyonNextPassageApi(SytralAPI):
 
     route = "tcl_sytral.tclpassagearret/all.json"
     filename = "prochains-passages-reseau-transports-commun-lyonnais-rhonexpress-disponibilites-temps-reel"
+    # `id` is the stop the passage happens at
+    index_fields = ("coursetheorique", "trip_ids", "ligne", "direction", "id")
+    # A passage is a trip at a stop
+    key_fields = ("id", "coursetheorique")
+    record_type = NextPassageLine
 
     def __init__(
         self,
@@ -91,49 +127,62 @@ class GrandLyonNextPassageApi(SytralAPI):
         line_ref: re.Pattern[str] | str | None = None,
         destination: re.Pattern[str] | str | None = None,
         trip_id: str | None = None,
+        stop_id: str | int | None = None,
         force_refetch: bool = False,
     ) -> list[NextPassageLine]:
         """
         Returns next passage info for all specified lines.
         Uses built-in cache by default.
 
+        line_ref and destination are regex searches, stop_id is an exact match.
+        trip_id matches passages whose `coursetheorique` is it or has it as one of its `:` separated
+        parts, an index lookup. Only when none does, it matches those whose `coursetheorique` contains it,
+        the rule we have always used to relate TCL's courses to GTFS trip ids:
+        their formats are not documented to be equal.
+
         If this is your first call or if you need to refresh info either:
         - pass force_refetch=True
         - call refresh_cache before calling get
         """
-        if line_ref is None and destination is None and trip_id is None:
+        if (
+            line_ref is None
+            and destination is None
+            and trip_id is None
+            and stop_id is None
+        ):
             raise RuntimeError(
-                "At least one of line_ref, destination or trip_id must be provided"
+                "At least one of line_ref, destination, trip_id or stop_id must be provided"
             )
 
         if force_refetch:
             self.refresh_cache()
 
-        if trip_id:
-            return [
-                NextPassageLine.from_dict(entry)
-                for entry in self.cache.get_entry("coursetheorique", trip_id)
-            ]
+        if trip_id and stop_id is None:
+            entries = self.cache.get_entry("trip_ids", trip_id, exact=True)
+            if entries:
+                return entries
 
-        if line_ref and destination:
-            all_by_line_ref = self.cache.get_entry("line_ref", line_ref)
-            all_by_destination = self.cache.get_entry("direction", destination)
+            return self.cache.get_entry(
+                "coursetheorique", re.compile(re.escape(trip_id))
+            )
 
-            return [
-                NextPassageLine.from_dict(entry)
-                for entry in all_by_line_ref.intersection(all_by_destination)
-            ]
+        if stop_id is not None:
+            entries = self.cache.get_entry("id", str(stop_id), exact=True)
+            if trip_id:
+                entries = [
+                    entry for entry in entries if trip_id in entry.trip_ids
+                ] or [
+                    entry
+                    for entry in entries
+                    if trip_id in entry.coursetheorique
+                ]
 
-        if line_ref:
-            return [
-                NextPassageLine.from_dict(entry)
-                for entry in self.cache.get_entry("line_ref", line_ref)
-            ]
+            return entries
 
+        criteria = {}
+        if line_ref:
+            criteria["ligne"] = line_ref
         if destination:
-            return [
-                NextPassageLine.from_dict(entry)
-                for entry in self.cache.get_entry("direction", destination)
-            ]
+            criteria["direction"] = destination
 
-        raise RuntimeError("Unreachable")
+        return self.cache.get_entries(criteria)
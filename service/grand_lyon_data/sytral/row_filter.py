@@ -0,0 +1,50 @@
+from dataclasses import dataclass, field
+import re
+
+
+@dataclass(frozen=True)
+class RowFilter:
+    """
+    Which upstream rows are worth keeping, applied by `SytralAPI.refresh_cache` as rows arrive.
+
+    A row is kept when it matches every criterion:
+    - values: str(row[field]) is one of the given values
+    - patterns: `re.search(pattern, str(row[field]))` matches, like regex cache lookups do
+
+    server_field names a field of values the upstream API can filter on itself (`field=...&value=...`),
+    one request per value: rows of other values are then never downloaded at all.
+    """
+
+    values: dict[str, frozenset[str]] = field(default_factory=dict)
+    patterns: dict[str, re.Pattern[str]] = field(default_factory=dict)
+    server_field: str | None = None
+
+    def accepts(self, row: dict) -> bool:
+        for name, accepted in self.values.items():
+            value = row.get(name)
+            if value is None or str(value) not in accepted:
+                return False
+
+        for name, pattern in self.patterns.items():
+            value = row.get(name)
+            if value is None or not pattern.search(str(value)):
+                return False
+
+        return True
+
+    def server_queries(self, max_queries: int) -> list[dict[str, str]]:
+        """
+        Query parameters of each filtered scan to run upstream, a single unfiltered scan when
+        there is no server_field or it would take more than max_queries scans.
+        No scan at all when server_field accepts no value.
+        """
+        if self.server_field not in self.values:
+            return [{}]
+
+        values = sorted(self.values[self.server_field])
+        if len(values) > max_queries:
+            return [{}]
+
+        return [
+            {"field": self.server_field, "value": value} for value in values
+        ]
@@ -0,0 +1,267 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Callable
+
+# Seconds, from a cache lookup to a full refresh of a dataset
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+)
+
+
+@dataclass
+class MetricFamily:
+    """
+    Samples of one metric as rendered by `/metrics`, see the Prometheus text format.
+    samples are (suffix, labels, value), e.g. ("_bucket", {"le": "0.1"}, 3).
+    """
+
+    name: str
+    help: str
+    type: str
+    samples: list[tuple[str, dict[str, str], float]] = field(
+        default_factory=list
+    )
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in self.samples:
+            lines.append(
+                f"{self.name}{suffix}{render_labels(labels)} {render_value(value)}"
+            )
+
+        return "\n".join(lines)
+
+
+def render_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+
+    def escape(value) -> str:
+        return (
+            str(value)
+            .replace("\\", "\\\\")
+            .replace('"', '\\"')
+            .replace("\n", "\\n")
+        )
+
+    return (
+        "{"
+        + ",".join(
+            f'{name}="{escape(value)}"' for name, value in labels.items()
+        )
+        + "}"
+    )
+
+
+def render_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+
+    return str(value)
+
+
+class Counter:
+    """
+    Monotonic count, one per combination of label values.
+    """
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: dict[tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self._lock:
+            self._values[label_values] = (
+                self._values.get(label_values, 0) + amount
+            )
+
+    def collect(self) -> MetricFamily:
+        with self._lock:
+            values = dict(self._values)
+
+        return MetricFamily(
+            self.name,
+            self.help,
+            "counter",
+            [
+                ("", dict(zip(self.labels, label_values)), value)
+                for label_values, value in values.items()
+            ],
+        )
+
+
+class Histogram:
+    """
+    Distribution of observed values (durations, sizes), one per combination of label values.
+    Observing is a bisect and three additions under a lock, cheap enough for every request.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> (count per bucket, the last one is +Inf), sum
+        self._values: dict[tuple[str, ...], tuple[list[int], list[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        bucket = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(
+                label_values, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[bucket] += 1
+            total[0] += value
+
+    @contextmanager
+    def time(self, *label_values: str):
+        """
+        Observe how long the block takes, whether it raises or not.
+        """
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, *label_values)
+
+    def collect(self) -> MetricFamily:
+        with self._lock:
+            values = {
+                label_values: (list(counts), total[0])
+                for label_values, (counts, total) in self._values.items()
+            }
+
+        family = MetricFamily(self.name, self.help, "histogram")
+        for label_values, (counts, total) in values.items():
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                family.samples.append(
+                    (
+                        "_bucket",
+                        {**labels, "le": render_value(bound)},
+                        cumulative,
+                    )
+                )
+            family.samples.append(("_sum", labels, total))
+            family.samples.append(("_count", labels, cumulative))
+
+        return family
+
+
+class Metrics:
+    """
+    Process-wide registry of the metrics served by `/metrics`.
+
+    Hot paths record into counters and histograms declared here.
+    Everything already counted somewhere (worker pool, caches, refresh stats) is read by
+    collectors instead, at scrape time only: leaving metrics on costs nothing between scrapes.
+    """
+
+    _instance: "Metrics | None" = None
+    _instance_lock = threading.Lock()
+
+    # Prefix of every metric name
+    namespace = "home_dashboard"
+
+    def __init__(self):
+        if Metrics._instance is not None:
+            raise RuntimeError("Metrics singleton is already initialised")
+
+        self.metrics: dict[str, Counter | Histogram] = {}
+        # Called on every scrape, each returns the families it knows about
+        self.collectors: list[Callable[[], list[MetricFamily]]] = []
+        self._lock = threading.Lock()
+
+        Metrics._instance = self
+
+    @classmethod
+    def get_instance(cls) -> "Metrics":
+        """
+        Created on first use, like `WorkerPool`: library code records metrics whether or not it runs inside the server.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls()
+
+        return cls._instance
+
+    def counter(
+        self, name: str, help: str, labels: tuple[str, ...] = ()
+    ) -> Counter:
+        return self._register(
+            Counter(f"{Metrics.namespace}_{name}", help, labels)
+        )
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self._register(
+            Histogram(f"{Metrics.namespace}_{name}", help, labels, buckets)
+        )
+
+    def family(self, name: str, help: str, type: str) -> MetricFamily:
+        """
+        Empty family for collectors to fill.
+        """
+        return MetricFamily(f"{Metrics.namespace}_{name}", help, type)
+
+    def render(self) -> str:
+        with self._lock:
+            metrics = list(self.metrics.values())
+            collectors = list(self.collectors)
+
+        families = [metric.collect() for metric in metrics]
+        for collector in collectors:
+            try:
+                families.extend(collector())
+            except Exception as error:
+                # One broken collector must not take the others down
+                print(f"Failed collecting metrics: {error!r}")
+
+        return "\n".join(family.render() for family in families) + "\n"
+
+    def _register(self, metric):
+        """
+        Modules declare their metrics at import, declaring one twice returns the first.
+        """
+        with self._lock:
+            return self.metrics.setdefault(metric.name, metric)
@@ -0,0 +1,327 @@
+import cProfile
+import contextvars
+import itertools
+import marshal
+import os
+import pstats
+import sys
+import threading
+from collections import Counter, deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Callable
+
+# Capture currently profiled in this context, lets `WorkerPool.run` profile the work a request hands over
+active_capture: contextvars.ContextVar["ProfileCapture | None"] = (
+    contextvars.ContextVar("active_capture", default=None)
+)
+
+
+def fold(frame) -> str:
+    """
+    Stack of frame, outermost call first, in the folded format flame graph tools read.
+    """
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        )
+        frame = frame.f_back
+
+    return ";".join(reversed(names))
+
+
+class StackSampler:
+    """
+    Samples the stack of every other thread each interval, from a thread of its own.
+    Costs a few microseconds per thread and sample, only while started.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        # folded stack -> number of samples
+        self.stacks: Counter[str] = Counter()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self) -> Counter[str]:
+        self._stopped.set()
+        self._thread.join()
+
+        return self.stacks
+
+    def _loop(self):
+        names = {}
+        # A first sample right away, blocks shorter than interval still get one
+        while True:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self._thread.ident:
+                    continue
+                if thread_id not in names:
+                    names = {
+                        thread.ident: thread.name
+                        for thread in threading.enumerate()
+                    }
+                thread_name = names.get(thread_id, str(thread_id))
+                self.stacks[f"{thread_name};{fold(frame)}"] += 1
+
+            if self._stopped.wait(self.interval):
+                return
+
+
+@dataclass
+class ProfileCapture:
+    """
+    Profile of the next count runs of a target:
+    - ("route", route template): requests to that route
+    - ("refresh", dataset): TCL cache refreshes of that dataset, any of them if None
+
+    "deterministic" captures record every call with cProfile, downloaded as pstats.
+    "sampled" captures sample stacks, downloaded as folded stacks (flamegraph.pl, speedscope...).
+    """
+
+    id: int
+    target: str
+    key: str | None
+    mode: str
+    count: int
+    created_at: datetime
+    captured: int = 0
+    # One run is profiled at a time, runs arriving meanwhile are left alone
+    busy: bool = False
+    finished_at: datetime | None = None
+    cancelled: bool = False
+    stats: pstats.Stats | None = None
+    stacks: Counter[str] = field(default_factory=Counter)
+
+    @property
+    def pending(self) -> bool:
+        return self.finished_at is None and not self.cancelled
+
+    def matches(self, target: str, key: str | None) -> bool:
+        return (
+            self.pending
+            and not self.busy
+            and self.target == target
+            and (self.key is None or self.key == key)
+        )
+
+    def add_profile(self, profile: cProfile.Profile):
+        if self.stats is None:
+            self.stats = pstats.Stats(profile)
+        else:
+            self.stats.add(profile)
+
+    def download(self) -> tuple[bytes, str, str]:
+        """
+        Content, media type and file name of what was captured.
+        """
+        if self.mode == "sampled":
+            content = "".join(
+                f"{stack} {samples}\n" for stack, samples in self.stacks.items()
+            )
+            return content.encode(), "text/plain", f"profile-{self.id}.folded"
+
+        # What `pstats.Stats.dump_stats` writes, without going through a file
+        stats = self.stats.stats if self.stats else {}
+        return (
+            marshal.dumps(stats),
+            "application/octet-stream",
+            f"profile-{self.id}.pstats",
+        )
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "target": self.target,
+            "key": self.key,
+            "mode": self.mode,
+            "count": self.count,
+            "captured": self.captured,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "cancelled": self.cancelled,
+        }
+
+
+class Profiler:
+    """
+    Profiles what admins ask for, on live traffic: the next requests to a route, the next refresh.
+
+    Nothing is profiled until a capture is armed, and checking `armed` is all hot paths do meanwhile.
+
+    Deterministic request profiles cover the request's event loop thread, whatever else runs on
+    the loop meanwhile included, and the work it hands to the `WorkerPool`.
+    """
+
+    _instance: "Profiler | None" = None
+    _instance_lock = threading.Lock()
+
+    # Seconds between stack samples of "sampled" captures
+    sample_interval = float(os.getenv("PROFILING_SAMPLE_INTERVAL", "0.005"))
+    # Finished captures kept for download
+    max_captures = 10
+
+    def __init__(self):
+        if Profiler._instance is not None:
+            raise RuntimeError("Profiler singleton is already initialised")
+
+        # Whether any capture is pending, read without the lock by hot paths
+        self.armed = False
+        self.captures: deque[ProfileCapture] = deque(
+            maxlen=Profiler.max_captures
+        )
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        # Whether the current thread is running a profiled block
+        self._local = threading.local()
+
+        Profiler._instance = self
+
+    @classmethod
+    def get_instance(cls) -> "Profiler":
+        """
+        Created on first use, like `WorkerPool`: hooks check it whether or not they run inside the server.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls()
+
+        return cls._instance
+
+    def arm(
+        self, target: str, key: str | None, *, count: int, mode: str
+    ) -> ProfileCapture:
+        if target not in ["route", "refresh"]:
+            raise ValueError(f"Can't profile {target}")
+        if mode not in ["deterministic", "sampled"]:
+            raise ValueError("Mode must be one of deterministic or sampled")
+        if count < 1:
+            raise ValueError("Profile at least one run")
+
+        with self._lock:
+            capture = ProfileCapture(
+                id=next(self._ids),
+                target=target,
+                key=key,
+                mode=mode,
+                count=count,
+                created_at=datetime.now(),
+            )
+            self.captures.append(capture)
+            self.armed = True
+
+        return capture
+
+    def cancel(self, capture_id: int) -> ProfileCapture | None:
+        with self._lock:
+            capture = self._get(capture_id)
+            if capture is not None and capture.pending:
+                capture.cancelled = True
+            self._rearm()
+
+        return capture
+
+    def get(self, capture_id: int) -> ProfileCapture | None:
+        with self._lock:
+            return self._get(capture_id)
+
+    def claim(self, target: str, key: str | None) -> ProfileCapture | None:
+        """
+        Pending capture wanting this run of target, marked busy until `release`.
+        """
+        with self._lock:
+            capture = next(
+                (c for c in self.captures if c.matches(target, key)), None
+            )
+            if capture is not None:
+                capture.busy = True
+
+            return capture
+
+    def release(self, capture: ProfileCapture):
+        with self._lock:
+            capture.busy = False
+            capture.captured += 1
+            if capture.captured >= capture.count and capture.pending:
+                capture.finished_at = datetime.now()
+            self._rearm()
+
+    @contextmanager
+    def profile(self, target: str, key: str | None):
+        """
+        Profile the block if a capture wants this run of target, otherwise run it as is.
+
+        Blocks starting while their thread already runs a profiled one (concurrent requests
+        on the event loop) are not profiled: the running profile already sees them,
+        and a thread has a single cProfile at a time.
+        """
+        nested = getattr(self._local, "profiling", False)
+        capture = self.claim(target, key) if self.armed and not nested else None
+        if capture is None:
+            yield
+            return
+
+        token = active_capture.set(capture)
+        self._local.profiling = True
+        try:
+            if capture.mode == "sampled":
+                sampler = StackSampler(Profiler.sample_interval)
+                sampler.start()
+                try:
+                    yield
+                finally:
+                    stacks = sampler.stop()
+                    with self._lock:
+                        capture.stacks.update(stacks)
+            else:
+                with self._profiled(capture):
+                    yield
+        finally:
+            self._local.profiling = False
+            active_capture.reset(token)
+            self.release(capture)
+
+    def wrap(self, fn: Callable) -> Callable:
+        """
+        fn, profiled into the capture of the current context if a deterministic one is running.
+        For work handed to other threads, which cProfile doesn't follow by itself.
+        """
+        capture = active_capture.get()
+        if capture is None or capture.mode != "deterministic":
+            return fn
+
+        def profiled(*args, **kwargs):
+            with self._profiled(capture):
+                return fn(*args, **kwargs)
+
+        return profiled
+
+    @contextmanager
+    def _profiled(self, capture: ProfileCapture):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+: a single profiler for the whole process, already
+            # enabled by the run that handed this work over, and seeing every thread
+            yield
+            return
+
+        try:
+            yield
+        finally:
+            profile.disable()
+            with self._lock:
+                capture.add_profile(profile)
+
+    def _get(self, capture_id: int) -> ProfileCapture | None:
+        return next((c for c in self.captures if c.id == capture_id), None)
+
+    def _rearm(self):
+        self.armed = any(capture.pending for capture in self.captures)
@@ -1,15 +1,57 @@
+import multiprocessing
 import os
+import signal
 import threading
 
 from contextlib import asynccontextmanager
-from fastapi import FastAPI, Depends, HTTPException, status
+from datetime import timedelta
+from fastapi import FastAPI, Depends, HTTPException, Request, status
+from fastapi.responses import JSONResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
 import uvicorn
 import secrets
 from grand_lyon_data.grand_lyon_api import GrandLyonApi
+from instrumentation.metrics import Metrics
+from modules.metrics.collectors import (
+    RequestMetricsMiddleware,
+    collect_gtfs,
+    collect_process,
+    collect_worker_pool,
+    tcl_collector,
+    trips_collector,
+)
+from modules.metrics.metrics import metrics_router
+from modules.profiling.profiling import ProfilingMiddleware, profiling_router
+from modules.refresh.publication import (
+    CacheFollower,
+    CachePublisher,
+    PublishedDemand,
+    publish_demand,
+    SharedSignal,
+)
+from modules.refresh.refresh import refresh_router
+from modules.reload.reload import reload_router
+from modules.reload.reloader import Reloader
+from modules.refresh.scheduler import (
+    DemandTracker,
+    RefreshPolicy,
+    RefreshScheduler,
+)
+from modules.trips.estimate_stream import EstimateBroadcaster
+from modules.trips.estimates import EstimateMaterializer
+from modules.trips.gtfs import Gtfs
+from modules.trips.gtfs_registry import GtfsRegistry
+from modules.trips.relevance import LegRelevance
+from modules.trips.gtfs_snapshot import ensure_snapshot
 from modules.trips.trips import trips_router, Trips
+from worker_pool.worker_pool import (
+    WorkerDeadlineExceeded,
+    WorkerPool,
+    WorkerPoolJobExecutor,
+    WorkerPoolSaturated,
+)
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -18,6 +60,19 @@ security = HTTPBasic()
 USERNAME = os.environ.get("AUTH_USERNAME", "dashboard")
 PASSWORD = os.environ.get("AUTH_PASSWORD", "raspberry")
 
+# Number of processes serving requests. Above 1, a separate refresher process
+# polls upstream for all of them, see `start_server`.
+SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", "1"))
+# "standalone", or in multi-worker mode "worker" and "refresher"
+SERVER_ROLE = os.environ.get("SERVER_ROLE", "standalone")
+
+# Feeds the refresh scheduler: the more the widget polls, the fresher the data
+demand = DemandTracker()
+
+
+def record_demand():
+    demand.record()
+
 
 def verify_credentials(credentials: HTTPBasicCredentials = Depends(security)):
     is_username_correct = secrets.compare_digest(credentials.username, USERNAME)
@@ -32,40 +87,196 @@ def verify_credentials(credentials: HTTPBasicCredentials = Depends(security)):
     return credentials.username
 
 
-scheduler = BackgroundScheduler()
+# Jobs share the request workers rather than spawning threads of their own
+scheduler = BackgroundScheduler(
+    executors={"default": WorkerPoolJobExecutor(WorkerPool.get_instance())}
+)
+
+
+def current_gtfs():
+    return Trips.get_instance().gtfs
+
+
+def prefetch_gtfs_service_days():
+    for gtfs in GtfsRegistry.feeds():
+        gtfs.prefetch_upcoming_service_days()
+
+
+def tcl_apis():
+    return {
+        "next_passages": GrandLyonApi.tcl_delay_api(),
+        "incidents": GrandLyonApi.tcl_incident_api(),
+    }
+
+
+def filter_tcl_caches():
+    """
+    Only keep the TCL rows tracked legs can ask for, see `LegRelevance`.
+    """
+    relevance = LegRelevance(lambda: Trips.get_instance().tracked_legs)
+    apis = tcl_apis()
+    apis["next_passages"].row_filter = relevance.next_passages
+    apis["incidents"].row_filter = relevance.incidents
 
 
-def refresh_tcl_api_cache():
-    print("Refreshing TCL API caches...")
-    GrandLyonApi.tcl_delay_api().refresh_cache()
-    GrandLyonApi.tcl_incident_api().refresh_cache()
-    print("Done refreshing caches !")
+def refresh_policies():
+    return [
+        # Delays change minute to minute during rush hour
+        RefreshPolicy(
+            name="next_passages",
+            api=tcl_apis()["next_passages"],
+            min_interval=timedelta(minutes=1),
+            max_interval=timedelta(minutes=10),
+        ),
+        # Incidents are announced ahead and last for a while
+        RefreshPolicy(
+            name="incidents",
+            api=tcl_apis()["incidents"],
+            min_interval=timedelta(minutes=3),
+            max_interval=timedelta(minutes=20),
+            service_lead=timedelta(minutes=45),
+        ),
+    ]
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     Trips()  # init singleton
+
+    materializer = EstimateMaterializer(
+        lambda: Trips.get_instance().tracked_legs
+    )
+    for api in tcl_apis().values():
+        api.refresh_listeners.append(materializer.invalidate)
+
+    # Streaming clients don't poll, they still count as demand
+    broadcaster = EstimateBroadcaster()
+    materializer.listeners.append(broadcaster.publish)
+    demand.sources.append(broadcaster.requests_per_minute)
+    materializer.start()
+
+    reloader = Reloader(
+        scheduler,
+        # Admin reloads reach a single worker, it passes them on
+        peers=SharedSignal("reload") if SERVER_ROLE == "worker" else None,
+    )
+    reloader.swap_listeners.append(materializer.invalidate)
+    reloader.start()
+
+    # Read on scrape only
+    Metrics.get_instance().collectors.extend(
+        [
+            collect_process,
+            collect_worker_pool,
+            tcl_collector(tcl_apis),
+            collect_gtfs,
+            trips_collector(demand),
+        ]
+    )
+
+    refresh_scheduler = None
+    if SERVER_ROLE == "worker":
+        followers = [
+            CacheFollower(name, api) for name, api in tcl_apis().items()
+        ]
+
+        def follow_refresher():
+            for follower in followers:
+                follower.poll()
+            publish_demand(demand)
+
+        follow_refresher()
+        scheduler.add_job(follow_refresher, "interval", seconds=5)
+    else:
+        filter_tcl_caches()
+        refresh_scheduler = RefreshScheduler(
+            scheduler,
+            policies=refresh_policies(),
+            gtfs_provider=current_gtfs,
+            demand=demand,
+        )
+
+    # No-op when already cached, keeps tomorrow warm well ahead of the 4 am rollover
     scheduler.add_job(
-        refresh_tcl_api_cache,
-        CronTrigger.from_crontab("*/10 * * * *"),  # every 10 minutes
+        prefetch_gtfs_service_days,
+        CronTrigger.from_crontab("30 * * * *"),  # every hour
     )
     scheduler.start()
 
-    # Don't want to block server startup while we initialise cache
-    thread = threading.Thread(target=refresh_tcl_api_cache)
-    thread.daemon = True
-    thread.start()
+    # Runs in the worker pool, doesn't block server startup
+    if refresh_scheduler:
+        refresh_scheduler.start()
+    prefetch_gtfs_service_days()
 
     yield
+    materializer.stop()
+    for api in tcl_apis().values():
+        api.close()
+    # Also shuts the worker pool down
     scheduler.shutdown()
 
 
 app = FastAPI(lifespan=lifespan)
+# Outermost, so profiles cover the metrics middleware too
+app.add_middleware(RequestMetricsMiddleware)
+app.add_middleware(ProfilingMiddleware)
+
+
+@app.exception_handler(WorkerPoolSaturated)
+async def worker_pool_saturated(request: Request, error: WorkerPoolSaturated):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": str(error)},
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.exception_handler(WorkerDeadlineExceeded)
+async def worker_deadline_exceeded(
+    request: Request, error: WorkerDeadlineExceeded
+):
+    return JSONResponse(
+        status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+        content={"detail": str(error)},
+    )
+
 
 app.include_router(
     trips_router,
     prefix="/trips",
     tags=["trips"],
+    dependencies=[Depends(verify_credentials), Depends(record_demand)],
+)
+
+
+app.include_router(
+    refresh_router,
+    prefix="/refresh",
+    tags=["refresh"],
+    dependencies=[Depends(verify_credentials)],
+)
+
+
+app.include_router(
+    reload_router,
+    prefix="/reload",
+    tags=["reload"],
+    dependencies=[Depends(verify_credentials)],
+)
+
+
+app.include_router(
+    metrics_router,
+    prefix="/metrics",
+    tags=["metrics"],
+    dependencies=[Depends(verify_credentials)],
+)
+
+
+app.include_router(
+    profiling_router,
+    prefix="/profiling",
+    tags=["profiling"],
     dependencies=[Depends(verify_credentials)],
 )
 
@@ -75,8 +286,59 @@ def read_root():
     return {"Hello": "World", "status": "ok"}
 
 
+def run_refresher():
+    """
+    Refresher process of the multi-worker mode: the only one polling upstream,
+    it publishes every refreshed TCL cache for the request workers to follow.
+    Demand is the sum of what the workers publish.
+    """
+    Trips()  # init singleton, for the legs to filter on
+    filter_tcl_caches()
+    for name, api in tcl_apis().items():
+        api.refresh_listeners.append(CachePublisher(name, api))
+
+    refresh_scheduler = RefreshScheduler(
+        scheduler,
+        policies=refresh_policies(),
+        gtfs_provider=current_gtfs,
+        demand=PublishedDemand(),
+    )
+    # Filters follow the legs, and the service window the feed
+    Reloader(scheduler, peers=SharedSignal("reload")).start()
+    scheduler.start()
+    refresh_scheduler.start()
+
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+    stopped.wait()
+    for api in tcl_apis().values():
+        api.close()
+    scheduler.shutdown()
+
+
 def start_server():
-    uvicorn.run(app, host="0.0.0.0", port=8000, root_path="/api")
+    if SERVER_WORKERS <= 1:
+        uvicorn.run(app, host="0.0.0.0", port=8000, root_path="/api")
+        return
+
+    # Workers then memory-map the same compiled GTFS instead of each parsing the ZIP
+    ensure_snapshot(Gtfs.default_path)
+
+    refresher = multiprocessing.Process(target=run_refresher, name="refresher")
+    refresher.start()
+
+    os.environ["SERVER_ROLE"] = "worker"
+    try:
+        uvicorn.run(
+            "main:app",
+            host="0.0.0.0",
+            port=8000,
+            root_path="/api",
+            workers=SERVER_WORKERS,
+        )
+    finally:
+        refresher.terminate()
+        refresher.join()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,226 @@
+import time
+from typing import Callable
+
+from grand_lyon_data.sytral.base_stryal_api import SytralAPI
+from instrumentation.metrics import MetricFamily, Metrics
+from modules.refresh.scheduler import DemandTracker
+from modules.trips.estimate_stream import EstimateBroadcaster
+from modules.trips.estimates import EstimateMaterializer
+from modules.trips.gtfs_registry import GtfsRegistry, current_rss_bytes
+from modules.trips.trips import batch_bodies
+from worker_pool.worker_pool import WorkerPool
+
+request_seconds = Metrics.get_instance().histogram(
+    "http_request_seconds",
+    "Time to the first byte of responses, by route template",
+    ("method", "route", "status"),
+)
+
+
+class RequestMetricsMiddleware:
+    """
+    Observes `request_seconds` for every HTTP request.
+
+    Routes are labelled with their template (`/trips/{leg_id}/next`), not the path, to keep
+    the number of series bounded. Streams are timed up to their headers.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started_at = time.perf_counter()
+
+        async def timed_send(message):
+            if message["type"] == "http.response.start":
+                # Set by FastAPI on the scope once a route matched
+                route = scope.get("route")
+                request_seconds.observe(
+                    time.perf_counter() - started_at,
+                    scope["method"],
+                    route.path if route is not None else "unmatched",
+                    str(message["status"]),
+                )
+            await send(message)
+
+        await self.app(scope, receive, timed_send)
+
+
+def collect_process() -> list[MetricFamily]:
+    metrics = Metrics.get_instance()
+    rss = metrics.family(
+        "process_resident_memory_bytes", "Resident set size", "gauge"
+    )
+    rss_bytes = current_rss_bytes()
+    if rss_bytes is not None:
+        rss.samples.append(("", {}, rss_bytes))
+
+    cpu = metrics.family(
+        "process_cpu_seconds_total", "User and system CPU time", "counter"
+    )
+    cpu.samples.append(("", {}, time.process_time()))
+
+    return [rss, cpu]
+
+
+def collect_worker_pool() -> list[MetricFamily]:
+    metrics = Metrics.get_instance()
+    stats = WorkerPool.get_instance().stats()
+
+    families = []
+    for key, type, help in [
+        ("pending", "gauge", "Requests queued or running"),
+        ("max_pending", "gauge", "Requests admitted at most"),
+        ("rejected", "counter", "Requests rejected, the pool being saturated"),
+        ("timed_out", "counter", "Requests past their deadline"),
+        ("completed", "counter", "Requests and jobs done"),
+    ]:
+        family = metrics.family(
+            f"worker_pool_{key}" + ("_total" if type == "counter" else ""),
+            help,
+            type,
+        )
+        family.samples.append(("", {}, stats[key]))
+        families.append(family)
+
+    return families
+
+
+def tcl_collector(
+    apis_provider: Callable[[], dict[str, SytralAPI]],
+) -> Callable[[], list[MetricFamily]]:
+    """
+    Collector of the TCL caches of apis_provider's APIs, labelled with their dataset.
+    """
+
+    def collect() -> list[MetricFamily]:
+        metrics = Metrics.get_instance()
+        entries = metrics.family(
+            "tcl_cache_entries", "Records in the TCL cache", "gauge"
+        )
+        age = metrics.family(
+            "tcl_cache_age_seconds",
+            "Time since the TCL cache was refreshed",
+            "gauge",
+        )
+        generation = metrics.family(
+            "tcl_cache_generation",
+            "Refreshes of the TCL cache since startup",
+            "gauge",
+        )
+        requests = metrics.family(
+            "tcl_upstream_requests_total",
+            "HTTP requests made upstream",
+            "counter",
+        )
+
+        for api in apis_provider().values():
+            labels = {"dataset": api.dataset}
+            cache = api.cache
+            entries.samples.append(("", labels, len(cache.entries)))
+            generation.samples.append(("", labels, cache.generation))
+            requests.samples.append(("", labels, api.requests_made))
+            cache_age = api.cache_age()
+            if cache_age is not None:
+                age.samples.append(("", labels, cache_age.total_seconds()))
+
+        return [entries, age, generation, requests]
+
+    return collect
+
+
+def collect_gtfs() -> list[MetricFamily]:
+    metrics = Metrics.get_instance()
+    load_seconds = metrics.family(
+        "gtfs_load_seconds", "Time it took to load the GTFS feed", "gauge"
+    )
+    memory = metrics.family(
+        "gtfs_memory_bytes", "Deep size of the GTFS feed when loaded", "gauge"
+    )
+    for report in GtfsRegistry.reports():
+        labels = {"feed": report.content_hash[:12], "source": report.source}
+        load_seconds.samples.append(("", labels, report.load_seconds))
+        memory.samples.append(("", labels, report.memory_bytes))
+
+    service_days = {
+        key: metrics.family(f"gtfs_service_day_cache_{key}", help, type)
+        for key, type, help in [
+            ("memory_bytes", "gauge", "Memory used by cached service days"),
+            ("hits_total", "counter", "Service day lookups found cached"),
+            ("misses_total", "counter", "Service day lookups that built it"),
+            ("evictions_total", "counter", "Service days evicted"),
+        ]
+    }
+    for gtfs in GtfsRegistry.feeds():
+        labels = {"feed": gtfs.content_hash[:12]}
+        stats = gtfs.service_days.stats()
+        for key, family in service_days.items():
+            family.samples.append(
+                ("", labels, stats[key.removesuffix("_total")])
+            )
+
+    return [load_seconds, memory, *service_days.values()]
+
+
+def trips_collector(demand: DemandTracker) -> Callable[[], list[MetricFamily]]:
+    """
+    Collector of the estimates served to clients, and of their demand.
+    """
+
+    def collect() -> list[MetricFamily]:
+        metrics = Metrics.get_instance()
+        families = []
+
+        requests_per_minute = metrics.family(
+            "demand_requests_per_minute",
+            "Requests per minute driving TCL refreshes, streams included",
+            "gauge",
+        )
+        requests_per_minute.samples.append(
+            ("", {}, demand.requests_per_minute())
+        )
+        families.append(requests_per_minute)
+
+        materializer = EstimateMaterializer.get_instance()
+        if materializer is not None:
+            snapshots = metrics.family(
+                "estimates_materialized_legs",
+                "Legs with a materialized snapshot",
+                "gauge",
+            )
+            snapshots.samples.append(("", {}, len(materializer.versioned)))
+            families.append(snapshots)
+
+        broadcaster = EstimateBroadcaster.get_instance()
+        if broadcaster is not None:
+            subscribers = metrics.family(
+                "stream_subscribers",
+                "Clients connected to /trips/stream",
+                "gauge",
+            )
+            subscribers.samples.append(("", {}, broadcaster.subscribers()))
+            families.append(subscribers)
+
+        stats = batch_bodies.stats()
+        for key, type, help in [
+            ("entries", "gauge", "Batch bodies cached"),
+            ("memory_bytes", "gauge", "Memory used by cached batch bodies"),
+            ("hits", "counter", "Batch bodies served from the cache"),
+            ("misses", "counter", "Batch bodies assembled"),
+        ]:
+            family = metrics.family(
+                f"batch_body_cache_{key}"
+                + ("_total" if type == "counter" else ""),
+                help,
+                type,
+            )
+            family.samples.append(("", {}, stats[key]))
+            families.append(family)
+
+        return families
+
+    return collect
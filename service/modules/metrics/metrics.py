@@ -0,0 +1,23 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+from instrumentation.metrics import Metrics
+
+metrics_router = APIRouter()
+
+
+# Plain def: collectors take locks, FastAPI runs this in its threadpool, off the event loop
+@metrics_router.get("", response_class=PlainTextResponse)
+def metrics():
+    """
+    Every metric of this process, in the Prometheus text format.
+
+    Metrics are per process: in multi-worker mode (`SERVER_WORKERS` above 1) each scrape
+    reaches one worker, and TCL refreshes are counted by the refresher process, which serves none.
+    """
+    return PlainTextResponse(
+        "# Metrics of this process only, see the /metrics docs for multi-worker mode\n"
+        + Metrics.get_instance().render(),
+        media_type="text/plain; version=0.0.4",
+        headers={"Cache-Control": "no-store"},
+    )
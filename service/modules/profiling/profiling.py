@@ -0,0 +1,140 @@
+from fastapi import APIRouter, HTTPException, Request, Response, status
+from fastapi.routing import APIRoute
+from starlette.routing import Match
+
+from instrumentation.profiling import Profiler
+from modules.refresh.scheduler import RefreshScheduler
+
+profiling_router = APIRouter()
+
+
+class ProfilingMiddleware:
+    """
+    Profiles requests to the routes admins armed a capture for, see `Profiler`.
+    Requests go straight through while nothing is armed.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.profiler = Profiler.get_instance()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self.profiler.armed:
+            await self.app(scope, receive, send)
+            return
+
+        with self.profiler.profile("route", route_template(scope)):
+            await self.app(scope, receive, send)
+
+
+def route_template(scope) -> str | None:
+    """
+    Template of the route scope's request is for (`/trips/{leg_id}/next`), routing hasn't happened yet.
+    """
+    for route in scope["app"].routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+
+    return None
+
+
+@profiling_router.get("/")
+async def profiling_status():
+    return [
+        capture.to_dict()
+        for capture in reversed(Profiler.get_instance().captures)
+    ]
+
+
+@profiling_router.post("/requests")
+async def profile_requests(
+    request: Request,
+    route: str,
+    count: int = 1,
+    mode: str = "deterministic",
+):
+    """
+    Profile the next count requests to route, given as its template: `/trips/{leg_id}/next`.
+    """
+    routes = {
+        app_route.path
+        for app_route in request.app.routes
+        if isinstance(app_route, APIRoute)
+    }
+    if route not in routes:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No route {route}, one of: {', '.join(sorted(routes))}",
+        )
+
+    return arm("route", route, count=count, mode=mode)
+
+
+@profiling_router.post("/refresh")
+async def profile_refresh(
+    dataset: str | None = None, count: int = 1, mode: str = "deterministic"
+):
+    """
+    Profile the next count TCL refreshes, of dataset only if given.
+    """
+    instance = RefreshScheduler.get_instance()
+    if instance is None:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Refreshes run in the refresher process",
+        )
+
+    datasets = {policy.api.dataset for policy in instance.policies.values()}
+    if dataset is not None and dataset not in datasets:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"No dataset {dataset}, one of: {', '.join(sorted(datasets))}",
+        )
+
+    return arm("refresh", dataset, count=count, mode=mode)
+
+
+@profiling_router.get("/{capture_id}")
+async def download(capture_id: int):
+    """
+    The capture, once finished or cancelled: pstats for deterministic ones, folded stacks for sampled ones.
+    """
+    capture = Profiler.get_instance().get(capture_id)
+    if capture is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+    if capture.pending:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Capture not finished, {capture.captured}/{capture.count} runs profiled",
+        )
+
+    content, media_type, filename = capture.download()
+
+    return Response(
+        content,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
+@profiling_router.delete("/{capture_id}")
+async def cancel(capture_id: int):
+    capture = Profiler.get_instance().cancel(capture_id)
+    if capture is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND)
+
+    return capture.to_dict()
+
+
+def arm(target: str, key: str | None, *, count: int, mode: str):
+    try:
+        capture = Profiler.get_instance().arm(
+            target, key, count=count, mode=mode
+        )
+    except ValueError as error:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST, detail=str(error)
+        )
+
+    return capture.to_dict()
@@ -0,0 +1,174 @@
+import glob
+import json
+import os
+import stat
+import time
+
+from grand_lyon_data.sytral.base_stryal_api import SytralAPI
+from modules.refresh.scheduler import DemandTracker
+
+
+def shared_state_directory() -> str:
+    """
+    Where the refresher process and the request workers exchange TCL caches and demand.
+
+    Private to the user running the service: created 0700, and refused if someone else
+    owns it or could write to it, as every worker loads what it finds there.
+    """
+    default_parent = os.getenv(
+        "XDG_RUNTIME_DIR",
+        os.path.dirname(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        ),
+    )
+    directory = os.getenv(
+        "SHARED_STATE_DIR", os.path.join(default_parent, ".shared-state")
+    )
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+
+    status = os.stat(directory)
+    if status.st_uid != os.getuid():
+        raise RuntimeError(
+            f"{directory} is owned by uid {status.st_uid}, refusing to share state through it"
+        )
+    if status.st_mode & (stat.S_IWGRP | stat.S_IWOTH):
+        raise RuntimeError(
+            f"{directory} is writable by other users, refusing to share state through it"
+        )
+
+    return directory
+
+
+def write_atomically(path: str, data: bytes):
+    """
+    Readers either see the previous file or the new one, never a partial write.
+    """
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as file:
+        file.write(data)
+    os.replace(temporary_path, path)
+
+
+class CachePublisher:
+    """
+    Refresh listener writing each new snapshot of api's cache to a file, for `CacheFollower`s to pick up.
+
+    Snapshots are written as JSON rows (see `SytralAPI.dump_cache`): data, never code, crosses processes.
+    """
+
+    def __init__(self, name: str, api: SytralAPI):
+        self.name = name
+        self.api = api
+        self.path = os.path.join(shared_state_directory(), f"{name}.json")
+
+    def __call__(self):
+        write_atomically(self.path, json.dumps(self.api.dump_cache()).encode())
+
+
+class CacheFollower:
+    """
+    Keeps api's cache in sync with what a `CachePublisher` in another process writes,
+    instead of querying upstream. Call `poll` periodically.
+    """
+
+    def __init__(self, name: str, api: SytralAPI):
+        self.name = name
+        self.api = api
+        self.path = os.path.join(shared_state_directory(), f"{name}.json")
+        self._seen_mtime_ns: int | None = None
+
+    def poll(self) -> bool:
+        """
+        Adopt the published snapshot if it changed since the last poll. Returns whether it did.
+        """
+        try:
+            mtime_ns = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return False
+
+        if mtime_ns == self._seen_mtime_ns:
+            return False
+
+        # Followers parse the rows and index them again, like a refresh would
+        with open(self.path, "rb") as file:
+            self.api.adopt(self.api.load_cache(json.load(file)))
+        self._seen_mtime_ns = mtime_ns
+
+        return True
+
+
+class SharedSignal:
+    """
+    Lets a process tell every other process sharing the state directory that something happened,
+    an admin reload for instance. Receivers call `poll` periodically.
+    """
+
+    def __init__(self, name: str):
+        self.path = os.path.join(shared_state_directory(), f"{name}.signal")
+        # Signals sent before this process started are not for it
+        self._seen = self._read()
+
+    def send(self):
+        token = f"{os.getpid()} {time.time_ns()}"
+        write_atomically(self.path, token.encode())
+        # Not for ourselves
+        self._seen = token
+
+    def poll(self) -> bool:
+        """
+        Whether another process sent the signal since the last poll.
+        """
+        token = self._read()
+        if token == self._seen:
+            return False
+
+        self._seen = token
+        return token is not None
+
+    def _read(self) -> str | None:
+        try:
+            with open(self.path) as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+
+def publish_demand(demand: DemandTracker):
+    """
+    Share this worker's request rate with the refresher, see `PublishedDemand`.
+    """
+    write_atomically(
+        os.path.join(shared_state_directory(), f"demand.{os.getpid()}"),
+        str(demand.requests_per_minute()).encode(),
+    )
+
+
+class PublishedDemand(DemandTracker):
+    """
+    Request rate of every worker, as last published by `publish_demand`.
+    Workers that stopped publishing for more than max_age_seconds are ignored.
+    """
+
+    def __init__(self, max_age_seconds: float = 60):
+        super().__init__()
+        self.max_age_seconds = max_age_seconds
+
+    def requests_per_minute(self) -> float:
+        total = super().requests_per_minute()
+        now = time.time()
+
+        for path in glob.glob(
+            os.path.join(shared_state_directory(), "demand.*")
+        ):
+            if path.endswith(".tmp"):
+                continue
+            try:
+                if now - os.stat(path).st_mtime > self.max_age_seconds:
+                    os.remove(path)
+                    continue
+                with open(path) as file:
+                    total += float(file.read())
+            except (OSError, ValueError):
+                continue
+
+        return total
@@ -0,0 +1,15 @@
+from fastapi import APIRouter
+
+from modules.refresh.scheduler import RefreshScheduler
+
+refresh_router = APIRouter()
+
+
+@refresh_router.get("/")
+async def refresh_status():
+    instance = RefreshScheduler.get_instance()
+    if instance is None:
+        # Request workers of the multi-worker mode follow the refresher process' caches
+        return {"detail": "Refreshes run in the refresher process"}
+
+    return instance.status()
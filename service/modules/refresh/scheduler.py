@@ -0,0 +1,299 @@
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Callable
+
+from apscheduler.schedulers.base import BaseScheduler
+
+from grand_lyon_data.sytral.base_stryal_api import RefreshStats, SytralAPI
+from modules.trips.gtfs import Gtfs
+
+
+class DemandTracker:
+    """
+    Sliding window count of API requests, tells the scheduler how much the data is being looked at.
+    """
+
+    def __init__(self, window: timedelta = timedelta(minutes=15)):
+        self.window = window
+        # Standing demand on top of counted requests, in requests per minute: streaming clients for instance
+        self.sources: list[Callable[[], float]] = []
+        self._requests: deque[float] = deque()
+        self._lock = threading.Lock()
+
+    def record(self):
+        with self._lock:
+            self._requests.append(time.monotonic())
+
+    def requests_per_minute(self) -> float:
+        horizon = time.monotonic() - self.window.total_seconds()
+        with self._lock:
+            while self._requests and self._requests[0] < horizon:
+                self._requests.popleft()
+            count = len(self._requests)
+
+        return count / (self.window.total_seconds() / 60) + sum(
+            source() for source in self.sources
+        )
+
+
+@dataclass
+class RefreshPolicy:
+    name: str
+    api: SytralAPI
+    # Interval when the data is looked at a lot and keeps changing
+    min_interval: timedelta
+    # Interval when nobody is looking or nothing changes
+    max_interval: timedelta
+    # Requests per minute at which we refresh every min_interval
+    busy_requests_per_minute: float = 2
+    # Resume polling this long before the first trip of the day
+    service_lead: timedelta = timedelta(minutes=15)
+
+
+@dataclass
+class RefreshDecision:
+    policy: str
+    decided_at: datetime
+    next_run_at: datetime
+    reason: str
+    requests_per_minute: float
+    change_ratio: float | None
+    in_service: bool
+    # Upstream requests made by the last refresh, and over the last hour by every policy
+    last_refresh_requests: int
+    budget_used: int
+
+    def to_dict(self):
+        return {
+            "policy": self.policy,
+            "decided_at": self.decided_at,
+            "next_run_at": self.next_run_at,
+            "interval_seconds": (
+                self.next_run_at - self.decided_at
+            ).total_seconds(),
+            "reason": self.reason,
+            "requests_per_minute": self.requests_per_minute,
+            "change_ratio": self.change_ratio,
+            "in_service": self.in_service,
+            "last_refresh_requests": self.last_refresh_requests,
+            "budget_used": self.budget_used,
+        }
+
+
+class RefreshScheduler:
+    """
+    Schedules each dataset's next refresh from what happened since the last one:
+    - the API request rate: busy means refresh often
+    - the GTFS service window: no trams running means no polling at all
+    - how much the last refresh changed: nothing changing means we can slow down
+    - a global hourly budget of upstream requests shared by every dataset
+
+    Every run schedules the next one as a one-shot job on the given APScheduler instance.
+    """
+
+    _instance: "RefreshScheduler | None" = None
+
+    upstream_requests_per_hour = int(
+        os.getenv("TCL_UPSTREAM_REQUESTS_PER_HOUR", "1200")
+    )
+
+    def __init__(
+        self,
+        scheduler: BaseScheduler,
+        *,
+        policies: list[RefreshPolicy],
+        gtfs_provider: Callable[[], Gtfs | None],
+        demand: DemandTracker | None = None,
+    ):
+        if RefreshScheduler._instance is not None:
+            raise RuntimeError(
+                "RefreshScheduler singleton is already initialised"
+            )
+
+        self.scheduler = scheduler
+        self.policies = {policy.name: policy for policy in policies}
+        self.gtfs_provider = gtfs_provider
+        self.demand = demand if demand else DemandTracker()
+
+        self.decisions: dict[str, RefreshDecision] = {}
+        # (monotonic time, requests) of every refresh within the last hour
+        self._spent: deque[tuple[float, int]] = deque()
+        self._lock = threading.Lock()
+
+        RefreshScheduler._instance = self
+
+    @classmethod
+    def get_instance(cls):
+        return cls._instance
+
+    def start(self):
+        """
+        Refresh every dataset right away, without blocking the caller.
+        """
+        for name in self.policies:
+            self._schedule(name, datetime.now())
+
+    def run(self, name: str):
+        policy = self.policies[name]
+        requests_before = policy.api.requests_made
+        stats = None
+
+        try:
+            stats = policy.api.refresh_cache()
+            print(
+                f"Refreshed {name} in {stats.duration_seconds:.1f}s: "
+                f"{stats.added} added, {stats.updated} updated, {stats.removed} removed"
+            )
+        except Exception as error:
+            # Keep serving the previous snapshot, next run will try again
+            print(
+                f"Failed refreshing {name}, serving cache from {policy.api.cache_refreshed_at}: {error!r}"
+            )
+        finally:
+            decision = self.decide(
+                policy,
+                stats=stats,
+                spent=policy.api.requests_made - requests_before,
+            )
+            self._schedule(name, decision.next_run_at)
+
+    def decide(
+        self,
+        policy: RefreshPolicy,
+        *,
+        stats: RefreshStats | None,
+        spent: int,
+    ) -> RefreshDecision:
+        """
+        Pick when policy should run next, given the outcome of the refresh that just ran:
+        its stats (None if it failed) and how many upstream requests it made.
+        """
+        now = datetime.now()
+        requests_per_minute = self.demand.requests_per_minute()
+        last_refresh_requests = spent
+
+        with self._lock:
+            self._spend(last_refresh_requests)
+            budget_used = sum(spent for _, spent in self._spent)
+
+        def decision(next_run_at: datetime, reason: str, in_service: bool):
+            result = RefreshDecision(
+                policy=policy.name,
+                decided_at=now,
+                next_run_at=next_run_at,
+                reason=reason,
+                requests_per_minute=requests_per_minute,
+                change_ratio=stats.change_ratio if stats else None,
+                in_service=in_service,
+                last_refresh_requests=last_refresh_requests,
+                budget_used=budget_used,
+            )
+            self.decisions[policy.name] = result
+            return result
+
+        next_service_start = self._next_service_start(policy)
+        if next_service_start is not None:
+            return decision(
+                next_service_start - policy.service_lead,
+                "no service until the first trip",
+                in_service=False,
+            )
+
+        # Scale between max_interval (idle) and min_interval (busy)
+        demand = min(1, requests_per_minute / policy.busy_requests_per_minute)
+        interval = policy.max_interval - demand * (
+            policy.max_interval - policy.min_interval
+        )
+        reason = f"demand {demand:.0%}"
+
+        if stats is not None:
+            if stats.change_ratio == 0:
+                interval *= 1.5
+                reason += ", nothing changed"
+            elif stats.change_ratio > 0.2:
+                interval /= 2
+                reason += f", {stats.change_ratio:.0%} changed"
+
+        interval = max(policy.min_interval, min(policy.max_interval, interval))
+
+        # Each policy gets an even share of the hourly budget
+        share = RefreshScheduler.upstream_requests_per_hour / len(self.policies)
+        if last_refresh_requests and share > 0:
+            budget_interval = timedelta(hours=last_refresh_requests / share)
+            if budget_interval > interval:
+                interval = budget_interval
+                reason += ", upstream budget"
+
+        return decision(now + interval, reason, in_service=True)
+
+    def status(self):
+        with self._lock:
+            self._spend(0)
+            budget_used = sum(spent for _, spent in self._spent)
+
+        return {
+            "requests_per_minute": self.demand.requests_per_minute(),
+            "upstream_requests_per_hour": RefreshScheduler.upstream_requests_per_hour,
+            "budget_used": budget_used,
+            "decisions": [
+                decision.to_dict() for decision in self.decisions.values()
+            ],
+        }
+
+    def _spend(self, requests: int):
+        now = time.monotonic()
+        if requests:
+            self._spent.append((now, requests))
+        while self._spent and self._spent[0][0] < now - 3600:
+            self._spent.popleft()
+
+    def _next_service_start(self, policy: RefreshPolicy) -> datetime | None:
+        """
+        When no trip runs now, returns when the next one starts. None while in service.
+        """
+        gtfs = self.gtfs_provider()
+        if gtfs is None:
+            return None
+
+        now = datetime.now(gtfs.tz)
+        today = now.date()
+        # Service days overlap: yesterday's trips run past midnight
+        windows = [
+            gtfs.service_window(day)
+            for day in sorted(
+                {
+                    gtfs.current_service_date(now),
+                    today,
+                    today + timedelta(days=1),
+                }
+            )
+        ]
+        windows = [window for window in windows if window is not None]
+        if not windows:
+            return None
+
+        for start, end in windows:
+            if start - policy.service_lead <= now <= end:
+                return None
+
+        upcoming = [start for start, _ in windows if start > now]
+        if not upcoming:
+            return None
+
+        # Back to the naive local time APScheduler and the rest of the scheduler use
+        return min(upcoming).astimezone().replace(tzinfo=None)
+
+    def _schedule(self, name: str, run_at: datetime):
+        # Each run schedules its successor: a run must never be dropped for being late
+        self.scheduler.add_job(
+            self.run,
+            "date",
+            run_date=run_at,
+            args=[name],
+            name=f"refresh-{name}",
+            misfire_grace_time=None,
+        )
@@ -0,0 +1,25 @@
+from fastapi import APIRouter
+
+from modules.reload.reloader import Reloader
+from worker_pool.worker_pool import WorkerPool
+
+reload_router = APIRouter()
+
+
+@reload_router.get("/")
+async def reload_status():
+    return Reloader.get_instance().status()
+
+
+@reload_router.post("/")
+async def reload():
+    """
+    Reload the legs CSV and the GTFS feed now, rather than waiting for the file watcher.
+    The feed is only loaded again if it changed.
+    """
+    # Loading a whole city's feed takes minutes
+    report = await WorkerPool.get_instance().run(
+        Reloader.get_instance().reload, "admin", deadline_seconds=600
+    )
+
+    return report.to_dict()
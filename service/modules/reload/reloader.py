@@ -0,0 +1,203 @@
+import gc
+import os
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Callable
+
+from apscheduler.schedulers.base import BaseScheduler
+
+from instrumentation.metrics import Metrics
+from modules.refresh.publication import SharedSignal
+from modules.trips.gtfs import Gtfs
+from modules.trips.gtfs_registry import GtfsRegistry, current_rss_bytes
+from modules.trips.trips import Trips
+
+reloads = Metrics.get_instance().counter(
+    "reloads_total", "Legs / GTFS reloads", ("trigger", "result")
+)
+
+
+@dataclass
+class ReloadReport:
+    # "watch" when a file changed, "admin" when asked for, "peer" when another process was
+    trigger: str
+    started_at: datetime
+    duration_seconds: float = 0
+    # Whether the feed changed and was loaded again, otherwise only the legs were
+    gtfs_reloaded: bool = False
+    legs: int = 0
+    # Deep size of the feed in use before and after
+    gtfs_memory_before: int = 0
+    gtfs_memory_after: int = 0
+    # Growth of the process RSS across the reload, None if we can't measure it
+    rss_delta_bytes: int | None = None
+    # Set when the reload failed, the previous state is then still served
+    error: str | None = None
+
+    def to_dict(self):
+        return {
+            "trigger": self.trigger,
+            "started_at": self.started_at,
+            "duration_seconds": self.duration_seconds,
+            "gtfs_reloaded": self.gtfs_reloaded,
+            "legs": self.legs,
+            "gtfs_memory_before": self.gtfs_memory_before,
+            "gtfs_memory_after": self.gtfs_memory_after,
+            "rss_delta_bytes": self.rss_delta_bytes,
+            "error": self.error,
+        }
+
+
+class Reloader:
+    """
+    Picks up a new legs CSV or GTFS feed without restarting the service.
+
+    Both files are polled: once one changed and stayed the same for a whole poll
+    (deploys copy the feed in place, we don't want to read it half written), the new feed
+    is compiled to a snapshot and loaded from it (see `GtfsRegistry`), and the legs built
+    against it, all its indexes included, in the background. Processes sharing the feed
+    compile the snapshot once and all memory-map it, see `ensure_snapshot`. Requests keep being served from the current state meanwhile,
+    which is then swapped for the new one in one go, see `Trips.swap`.
+
+    A reload that fails, a leg that doesn't exist in the new feed for instance,
+    leaves the current state in place. It is not retried until a file changes again.
+
+    With peers, an admin reload is sent to the other processes too, which reload
+    on their next poll.
+    """
+
+    _instance: "Reloader | None" = None
+
+    poll_seconds = float(os.getenv("RELOAD_POLL_SECONDS", "30"))
+
+    def __init__(
+        self, scheduler: BaseScheduler, peers: SharedSignal | None = None
+    ):
+        if Reloader._instance is not None:
+            raise RuntimeError("Reloader singleton is already initialised")
+
+        self.scheduler = scheduler
+        self.peers = peers
+        # Called after every swap, once the new state is served
+        self.swap_listeners: list[Callable[[], None]] = []
+        self.reports: deque[ReloadReport] = deque(maxlen=10)
+
+        # Signatures of the files the current state was loaded from, and as of the last poll
+        self._loaded: dict[str, tuple[int, int] | None] = self._signatures()
+        self._last_seen = self._loaded
+        self._lock = threading.Lock()
+
+        Reloader._instance = self
+
+    @classmethod
+    def get_instance(cls):
+        return cls._instance
+
+    def start(self):
+        self.scheduler.add_job(
+            self.poll, "interval", seconds=Reloader.poll_seconds
+        )
+
+    def watched_files(self) -> list[str]:
+        trips = Trips.get_instance()
+
+        return [
+            os.path.abspath(trips.legs_file),
+            os.path.abspath(
+                trips.gtfs.file_path
+                if trips.gtfs.file_path
+                else Gtfs.default_path
+            ),
+        ]
+
+    def poll(self):
+        if self.peers is not None and self.peers.poll():
+            self.reload("peer")
+
+        signatures = self._signatures()
+        stable = signatures == self._last_seen
+        self._last_seen = signatures
+
+        if stable and signatures != self._loaded:
+            self.reload("watch")
+
+    def reload(self, trigger: str) -> ReloadReport:
+        """
+        Build the state from the files as they are now and swap it in, see `Reloader`.
+        Concurrent calls wait for each other.
+        """
+        if trigger == "admin" and self.peers is not None:
+            self.peers.send()
+
+        with self._lock:
+            trips = Trips.get_instance()
+            report = ReloadReport(trigger=trigger, started_at=datetime.now())
+            report.gtfs_memory_before = trips.gtfs.memory_usage()
+            signatures = self._signatures()
+            rss_before = current_rss_bytes()
+            started_at = time.perf_counter()
+
+            try:
+                gtfs = GtfsRegistry.get(
+                    trips.gtfs.file_path, from_snapshot=True
+                )
+                legs = Trips.load_legs(trips.legs_file, gtfs)
+                gtfs.prefetch_upcoming_service_days()
+
+                report.gtfs_reloaded = gtfs is not trips.gtfs
+                report.legs = len(legs)
+                trips.swap(gtfs, legs)
+
+                for listener in self.swap_listeners:
+                    listener()
+            except Exception as error:
+                report.error = repr(error)
+                print(
+                    f"Failed reloading, still serving the previous state: {error!r}"
+                )
+            finally:
+                # Failed or not, don't try these same files again
+                self._loaded = signatures
+
+            # The previous feed goes as soon as the last request using it is done
+            gc.collect()
+            rss_after = current_rss_bytes()
+            report.duration_seconds = time.perf_counter() - started_at
+            report.gtfs_memory_after = trips.gtfs.memory_usage()
+            report.rss_delta_bytes = (
+                rss_after - rss_before
+                if rss_before is not None and rss_after is not None
+                else None
+            )
+            self.reports.append(report)
+            reloads.inc(trigger, "failed" if report.error else "succeeded")
+
+            if report.error is None:
+                print(
+                    f"Reloaded {report.legs} legs"
+                    + (" and the GTFS feed" if report.gtfs_reloaded else "")
+                    + f" in {report.duration_seconds:.1f}s"
+                )
+
+            return report
+
+    def status(self) -> dict:
+        return {
+            "watched_files": self.watched_files(),
+            "poll_seconds": Reloader.poll_seconds,
+            "reloads": [report.to_dict() for report in reversed(self.reports)],
+        }
+
+    def _signatures(self) -> dict[str, tuple[int, int] | None]:
+        signatures = {}
+        for path in self.watched_files():
+            try:
+                stat = os.stat(path)
+                signatures[path] = (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                signatures[path] = None
+
+        return signatures
@@ -0,0 +1,111 @@
+import argparse
+import json
+import time
+from datetime import datetime, timedelta
+
+from apscheduler.util import ZoneInfo
+from fastapi.encoders import jsonable_encoder
+
+from modules.trips.encoded import EncodedBody, encode_json
+
+
+def sample_snapshot(leg_id: int, estimates: int, incidents: int) -> dict:
+    """
+    A `next_estimates` snapshot of the usual shape and size.
+    """
+    now = datetime.now(ZoneInfo("Europe/Paris"))
+
+    return {
+        "leg": {
+            "id": leg_id,
+            "from_stop": 30000 + leg_id,
+            "to_stop": 31000 + leg_id,
+            "from_stop_name": "Gare Part-Dieu Vivier Merle",
+            "to_stop_name": "Perrache",
+            "line_name": "Gare Part-Dieu Vivier Merle - Perrache",
+            "trip_direction": "Perrache",
+            "line_short_name": "T2",
+        },
+        "estimates": [
+            {
+                "transporter_trip_id": f"{leg_id}A{index:05d}AM",
+                "departure_time": now + timedelta(minutes=4 * index),
+                "arrival_time": now + timedelta(minutes=4 * index + 17),
+                "delay": 60 * index if index % 2 else None,
+            }
+            for index in range(estimates)
+        ],
+        "incidents": [
+            {
+                "title": "Travaux",
+                "message": "Arrêt Perrache non desservi, reporté rue Dugas-Montbel. "
+                * 3,
+                "type": "Perturbation",
+                "severity": 3,
+            }
+            for _ in range(incidents)
+        ],
+        "sot_updated_at": datetime.now(),
+    }
+
+
+def per_request_us(serialize, requests: int) -> float:
+    started_at = time.perf_counter()
+    for _ in range(requests):
+        serialize()
+
+    return (time.perf_counter() - started_at) / requests * 1e6
+
+
+def main():
+    """
+    Compare the serialization CPU of a `/trips/next` response:
+    FastAPI's default encoding, encoding with orjson on every request, and the pre-encoded bytes
+    `EncodedBody` serves (joined once per ETag).
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("--legs", type=int, default=3)
+    parser.add_argument("--estimates", type=int, default=3)
+    parser.add_argument("--incidents", type=int, default=1)
+    parser.add_argument("--requests", type=int, default=2000)
+    args = parser.parse_args()
+
+    snapshots = [
+        sample_snapshot(leg_id, args.estimates, args.incidents)
+        for leg_id in range(1, args.legs + 1)
+    ]
+    body = {"legs": snapshots}
+    encoded = [EncodedBody.of(snapshot) for snapshot in snapshots]
+    joined = EncodedBody.join(encoded, prefix=b'{"legs":[', suffix=b"]}")
+    joined.gzip()
+
+    if json.loads(joined.raw) != json.loads(json.dumps(jsonable_encoder(body))):
+        raise RuntimeError("orjson and FastAPI encode the body differently")
+
+    results = {
+        "jsonable_encoder + json.dumps": per_request_us(
+            lambda: json.dumps(jsonable_encoder(body)).encode(), args.requests
+        ),
+        "orjson": per_request_us(lambda: encode_json(body), args.requests),
+        "pre-encoded, joined per request": per_request_us(
+            lambda: EncodedBody.join(
+                encoded, prefix=b'{"legs":[', suffix=b"]}"
+            ).raw,
+            args.requests,
+        ),
+        "pre-encoded, cached (gzip too)": per_request_us(
+            lambda: joined.gzip(), args.requests
+        ),
+    }
+
+    baseline = results["jsonable_encoder + json.dumps"]
+    print(
+        f"/trips/next body of {args.legs} legs: {len(joined.raw)} bytes, "
+        f"{len(joined.gzip())} gzipped"
+    )
+    for name, us in results.items():
+        print(f"{name:>32}: {us:8.1f} µs/request ({baseline / us:6.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import argparse
+import os
+import time
+
+from modules.trips.gtfs import Gtfs
+from modules.trips.gtfs_snapshot import ensure_snapshot
+
+
+def main():
+    """
+    Compile a GTFS ZIP to the snapshot `Gtfs` loads at startup instead of parsing the ZIP.
+    Run it whenever the ZIP changes, a stale snapshot is ignored anyway.
+    Takes the same lock as the running service, see `ensure_snapshot`.
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument("path", nargs="?", default=Gtfs.default_path)
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="compile again even if the snapshot is up to date",
+    )
+    args = parser.parse_args()
+
+    started_at = time.perf_counter()
+    directory = ensure_snapshot(args.path, force=args.force)
+    size = sum(
+        os.path.getsize(os.path.join(directory, name))
+        for name in os.listdir(directory)
+    )
+
+    print(
+        f"Snapshot of {args.path} in {directory} ready in {time.perf_counter() - started_at:.1f}s "
+        f"({size / 1024 / 1024:.1f} MB)"
+    )
+
+
+if __name__ == "__main__":
+    main()
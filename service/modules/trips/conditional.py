@@ -0,0 +1,105 @@
+import hashlib
+import os
+from datetime import datetime, timezone
+
+from fastapi import Request, Response, status
+
+from modules.trips.encoded import EncodedBody, accepts_gzip, gzip_etag
+
+# How long nginx may serve a response without asking us, see `X-Accel-Expires`
+MICRO_CACHE_SECONDS = int(os.getenv("MICRO_CACHE_SECONDS", "5"))
+
+
+def version_etag(*versions) -> str:
+    """
+    Strong ETag of a response entirely determined by versions: feed hash, TCL cache generations...
+    """
+    digest = hashlib.sha256(
+        "|".join(str(version) for version in versions).encode()
+    ).hexdigest()
+
+    return f'"{digest[:32]}"'
+
+
+def is_not_modified(request: Request, etag: str) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+
+    # Weak comparison, as RFC 9110 requires for If-None-Match
+    candidates = [
+        candidate.strip().removeprefix("W/")
+        for candidate in if_none_match.split(",")
+    ]
+    return "*" in candidates or etag in candidates
+
+
+def matching_etag(request: Request, etag: str) -> str | None:
+    """
+    Variant of etag, identity or gzip (see `gzip_etag`), the client already has and may be answered
+    a 304 for. Only clients accepting gzip may keep a gzip body.
+    """
+    variants = [etag, gzip_etag(etag)] if accepts_gzip(request) else [etag]
+
+    return next(
+        (variant for variant in variants if is_not_modified(request, variant)),
+        None,
+    )
+
+
+def seconds_until(moment: datetime | None) -> int | None:
+    if moment is None:
+        return None
+
+    return max(0, int((moment - datetime.now(timezone.utc)).total_seconds()))
+
+
+def conditional_response(
+    request: Request,
+    body,
+    *,
+    etag: str | None,
+    micro_cache_seconds: int | None = None,
+) -> Response:
+    """
+    body as JSON with caching headers, or an empty 304 if the client already has this etag.
+    Pass an `EncodedBody` for bodies served many times, it is sent as is.
+
+    Clients always revalidate (`no-cache`), which costs them a 304 when nothing changed.
+    The gzip variant has an ETag of its own, see `gzip_etag`.
+    nginx caches responses for micro_cache_seconds (`MICRO_CACHE_SECONDS` at most), then revalidates them the same way.
+    """
+    micro_cache_seconds = min(
+        MICRO_CACHE_SECONDS,
+        micro_cache_seconds
+        if micro_cache_seconds is not None
+        else MICRO_CACHE_SECONDS,
+    )
+    headers = {
+        "Cache-Control": "private, no-cache",
+        # nginx only, it doesn't pass it on
+        "X-Accel-Expires": str(micro_cache_seconds if etag else 0),
+        "Vary": "Accept-Encoding",
+    }
+    if etag is not None:
+        matching = matching_etag(request, etag)
+        if matching is not None:
+            headers["ETag"] = matching
+            return Response(
+                status_code=status.HTTP_304_NOT_MODIFIED, headers=headers
+            )
+
+    encoded = body if isinstance(body, EncodedBody) else EncodedBody.of(body)
+    content, encoding_headers = encoded.for_request(request)
+    if etag is not None:
+        headers["ETag"] = (
+            gzip_etag(etag)
+            if encoding_headers.get("Content-Encoding") == "gzip"
+            else etag
+        )
+
+    return Response(
+        content,
+        media_type="application/json",
+        headers={**headers, **encoding_headers},
+    )
@@ -0,0 +1,123 @@
+import gzip
+import threading
+from collections import OrderedDict
+from typing import Callable
+
+import orjson
+from fastapi import Request
+
+
+def encode_json(body) -> bytes:
+    """
+    Same JSON as FastAPI's `jsonable_encoder` then `json.dumps` for our bodies
+    (datetimes as ISO 8601), without walking them in Python first.
+    """
+    return orjson.dumps(
+        body, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+    )
+
+
+def accepts_gzip(request: Request) -> bool:
+    return "gzip" in request.headers.get("accept-encoding", "")
+
+
+def gzip_etag(etag: str) -> str:
+    """
+    Strong ETag of the gzip variant of the response etag identifies: validators differ per content coding.
+    """
+    return etag.removesuffix('"') + '-gzip"'
+
+
+class EncodedBody:
+    """
+    A response body encoded to JSON bytes once, to be sent as is to every request for it.
+    The gzip variant is made on first use, then kept alongside.
+    """
+
+    # Below this, compressing costs more than it saves
+    min_gzip_bytes = 1024
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self._gzip: bytes | None = None
+
+    @classmethod
+    def of(cls, body) -> "EncodedBody":
+        return EncodedBody(encode_json(body))
+
+    @classmethod
+    def join(
+        cls, parts: list["EncodedBody"], prefix: bytes, suffix: bytes
+    ) -> "EncodedBody":
+        """
+        Paste already encoded parts together, e.g. into a list: `prefix + a,b,c + suffix`.
+        """
+        return EncodedBody(
+            prefix + b",".join(part.raw for part in parts) + suffix
+        )
+
+    def gzip(self) -> bytes:
+        # Two threads racing both compress, either result is the same
+        if self._gzip is None:
+            self._gzip = gzip.compress(self.raw, compresslevel=6)
+
+        return self._gzip
+
+    def for_request(self, request: Request) -> tuple[bytes, dict[str, str]]:
+        """
+        The variant request accepts, and the headers that go with it.
+        """
+        headers = {"Vary": "Accept-Encoding"}
+        if len(self.raw) >= EncodedBody.min_gzip_bytes and accepts_gzip(
+            request
+        ):
+            headers["Content-Encoding"] = "gzip"
+            return self.gzip(), headers
+
+        return self.raw, headers
+
+    def memory_usage(self) -> int:
+        return len(self.raw) + (len(self._gzip) if self._gzip else 0)
+
+
+class EncodedBodyCache:
+    """
+    Bounded LRU of bodies keyed by ETag, for responses assembled per request
+    that are the same as long as their ETag is.
+    """
+
+    def __init__(self, max_entries: int = 32):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, EncodedBody] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, etag: str, build: Callable[[], EncodedBody]) -> EncodedBody:
+        with self._lock:
+            encoded = self._entries.get(etag)
+            if encoded is not None:
+                self._entries.move_to_end(etag)
+                self.hits += 1
+                return encoded
+            self.misses += 1
+
+        encoded = build()
+        with self._lock:
+            self._entries[etag] = encoded
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return encoded
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "memory_bytes": sum(
+                    encoded.memory_usage() for encoded in self._entries.values()
+                ),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
@@ -0,0 +1,183 @@
+import asyncio
+import json
+import os
+import threading
+
+from modules.trips.encoded import encode_json
+
+
+def fingerprint(snapshot: dict) -> dict:
+    """
+    What subscribers care about in a `next_estimates` snapshot: estimates, delays and incidents,
+    not when the TCL cache it was computed from was refreshed.
+    """
+    return {
+        key: value for key, value in snapshot.items() if key != "sot_updated_at"
+    }
+
+
+class Subscription:
+    """
+    One client of `EstimateBroadcaster`, following leg_ids (every leg if None).
+
+    Changes are coalesced per leg until the client reads them: a slow client only ever
+    has one pending payload per leg, never a backlog of events.
+    """
+
+    def __init__(
+        self, loop: asyncio.AbstractEventLoop, leg_ids: set[int] | None
+    ):
+        self.loop = loop
+        self.leg_ids = leg_ids
+        # leg id -> serialized snapshot, None once the leg is gone
+        self._pending: dict[int, str | None] = {}
+        self._lock = threading.Lock()
+        self._ready = asyncio.Event()
+
+    def follows(self, leg_id: int) -> bool:
+        return self.leg_ids is None or leg_id in self.leg_ids
+
+    def push(self, changes: dict[int, str | None]):
+        """
+        Called from any thread.
+        """
+        changes = {
+            leg_id: payload
+            for leg_id, payload in changes.items()
+            if self.follows(leg_id)
+        }
+        if not changes:
+            return
+
+        with self._lock:
+            self._pending.update(changes)
+        self.loop.call_soon_threadsafe(self._ready.set)
+
+    async def next_event(self, timeout: float) -> str | None:
+        """
+        Next SSE event, None if nothing changed within timeout.
+        """
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+        self._ready.clear()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return None
+
+        legs = [payload for payload in pending.values() if payload is not None]
+        removed = [
+            leg_id for leg_id, payload in pending.items() if payload is None
+        ]
+
+        # Payloads are already JSON, they are pasted in rather than encoded again
+        return (
+            "event: legs\n"
+            f'data: {{"legs":[{",".join(legs)}],"removed":{json.dumps(removed)}}}\n\n'
+        )
+
+
+class EstimateBroadcaster:
+    """
+    Pushes leg snapshots to streaming clients (see `/trips/stream`) when, and only when, they change.
+
+    Fed by `EstimateMaterializer` after each recompute: snapshots are compared with the
+    previous ones and the changed ones serialized, once per change whatever the number
+    of subscribers, then handed to every subscription following them.
+    """
+
+    _instance: "EstimateBroadcaster | None" = None
+
+    # How often idle streams get a comment, keeps proxies from closing them
+    heartbeat_seconds = float(os.getenv("STREAM_HEARTBEAT_SECONDS", "15"))
+    # Demand each subscriber stands for, about what a widget polling every minute used to generate
+    requests_per_minute_per_subscriber = 1
+
+    def __init__(self):
+        if EstimateBroadcaster._instance is not None:
+            raise RuntimeError(
+                "EstimateBroadcaster singleton is already initialised"
+            )
+
+        # leg id -> fingerprint, and serialized snapshot, of what was last published
+        self._fingerprints: dict[int, dict] = {}
+        self._payloads: dict[int, str] = {}
+        self._subscriptions: set[Subscription] = set()
+        self._lock = threading.Lock()
+
+        EstimateBroadcaster._instance = self
+
+    @classmethod
+    def get_instance(cls):
+        return cls._instance
+
+    def publish(self, snapshots: dict[int, dict], leg_ids: set[int]):
+        """
+        Materializer listener: diff snapshots against the last ones and push the changes.
+
+        leg_ids are the tracked legs, only legs no longer tracked are removed.
+        Those that failed to compute (missing from snapshots) keep their last snapshot.
+        """
+        fingerprints = {
+            leg_id: fingerprint(snapshot)
+            for leg_id, snapshot in snapshots.items()
+        }
+        changes: dict[int, str | None] = {
+            leg_id: encode_json(snapshots[leg_id]).decode()
+            for leg_id, leg_fingerprint in fingerprints.items()
+            if self._fingerprints.get(leg_id) != leg_fingerprint
+        }
+        for leg_id in self._fingerprints.keys() - fingerprints.keys():
+            if leg_id in leg_ids:
+                fingerprints[leg_id] = self._fingerprints[leg_id]
+            else:
+                changes[leg_id] = None
+
+        if not changes:
+            return
+
+        with self._lock:
+            self._fingerprints = fingerprints
+            self._payloads = {
+                leg_id: payload
+                for leg_id, payload in {**self._payloads, **changes}.items()
+                if payload is not None
+            }
+            subscriptions = list(self._subscriptions)
+
+        for subscription in subscriptions:
+            subscription.push(changes)
+
+    def subscribe(
+        self, loop: asyncio.AbstractEventLoop, leg_ids: set[int] | None
+    ) -> Subscription:
+        """
+        New subscription, its first event holds the current snapshot of every leg it follows.
+        """
+        subscription = Subscription(loop, leg_ids)
+        with self._lock:
+            self._subscriptions.add(subscription)
+            current = dict(self._payloads)
+        subscription.push(current)
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    def subscribers(self) -> int:
+        with self._lock:
+            return len(self._subscriptions)
+
+    def requests_per_minute(self) -> float:
+        """
+        Demand of the connected clients, see `DemandTracker.sources`.
+        """
+        return (
+            self.subscribers()
+            * EstimateBroadcaster.requests_per_minute_per_subscriber
+        )
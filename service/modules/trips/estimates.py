@@ -0,0 +1,310 @@
+import threading
+from dataclasses import dataclass
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Callable
+
+from grand_lyon_data.sytral.incident_api import Incident
+from grand_lyon_data.sytral.next_passage_api import NextPassageLine
+from instrumentation.metrics import Metrics
+from modules.trips.conditional import version_etag
+from modules.trips.encoded import EncodedBody
+from modules.trips.leg import SingleLeg
+
+
+class SharedLookups:
+    """
+    Memoizes the lookups legs have in common while computing several of them at once:
+    one departure search per pair of stops, one incident lookup per line and one delay lookup per trip.
+    TCL lookups are memoized per cache generation: a refresh landing meanwhile is never hidden.
+    """
+
+    def __init__(self, utc_timestamp: datetime | None = None):
+        self.utc_timestamp = (
+            utc_timestamp if utc_timestamp else datetime.now(timezone.utc)
+        )
+        self._departures: dict[tuple, list[tuple[str, datetime, date]]] = {}
+        self._incidents: dict[tuple, list[Incident]] = {}
+        self._delays: dict[tuple, NextPassageLine | None] = {}
+
+    def departures(self, leg: SingleLeg) -> list[tuple[str, datetime, date]]:
+        key = (id(leg.gtfs), leg.from_stop, leg.to_stop)
+        if key not in self._departures:
+            self._departures[key] = leg.get_departures(self.utc_timestamp)
+
+        return self._departures[key]
+
+    def incidents(self, leg: SingleLeg) -> list[Incident]:
+        key = (
+            id(leg.incident_api),
+            leg.incident_api.cache.generation,
+            leg.line_short_name,
+        )
+        if key not in self._incidents:
+            self._incidents[key] = leg.get_incidents()
+
+        return self._incidents[key]
+
+    def delay(self, leg: SingleLeg, trip_id: str) -> NextPassageLine | None:
+        key = (id(leg.delay_api), leg.delay_api.cache.generation, trip_id)
+        if key not in self._delays:
+            self._delays[key] = leg.get_delays(trip_id)
+
+        return self._delays[key]
+
+
+def next_estimates(leg: SingleLeg, shared: SharedLookups | None = None) -> dict:
+    """
+    Body of `/trips/{leg_id}/next`: next departures of leg with their delays, and the line's incidents.
+    Pass the same shared lookups when computing several legs.
+    """
+    shared = shared if shared else SharedLookups()
+    estimates = []
+
+    incidents = shared.incidents(leg)
+    for trip_id, departure_time, arrival_time in leg.get_estimates(
+        departures=shared.departures(leg)
+    ):
+        delay = shared.delay(leg, trip_id)
+
+        delay_seconds = (
+            int(delay.delaipassage.total_seconds()) if delay else None
+        )
+
+        estimates.append(
+            {
+                "transporter_trip_id": trip_id,
+                "departure_time": departure_time,
+                "arrival_time": arrival_time,
+                "delay": delay_seconds,
+            }
+        )
+
+    return {
+        "leg": leg.to_dict(),
+        "estimates": estimates,
+        "incidents": [
+            {
+                "title": incident.titre,
+                "message": incident.message,
+                "type": incident.typeseverite,
+                "severity": incident.niveauseverite,
+            }
+            for incident in incidents
+        ],
+        "sot_updated_at": leg.delay_api.cache_refreshed_at,
+    }
+
+
+def data_versions(leg: SingleLeg) -> tuple:
+    """
+    Versions of everything `next_estimates` of leg reads, but the clock.
+    """
+    return (
+        leg.gtfs.content_hash,
+        leg.from_stop,
+        leg.to_stop,
+        leg.delay_api.cache.generation,
+        leg.incident_api.cache.generation,
+    )
+
+
+def estimates_etag(versions: tuple, snapshot: dict) -> str:
+    """
+    ETag of a `next_estimates` snapshot computed from versions.
+    With the same data, estimates only change once the head departure leaves.
+    """
+    estimates = snapshot["estimates"]
+    head_departure = estimates[0]["departure_time"] if estimates else None
+
+    return version_etag(*versions, head_departure)
+
+
+@dataclass(frozen=True)
+class VersionedEstimates:
+    """
+    A `next_estimates` snapshot, its ETag (None when it can't be cached) and its JSON, encoded once.
+    """
+
+    etag: str | None
+    snapshot: dict
+    encoded: EncodedBody
+
+    @classmethod
+    def of(cls, etag: str | None, snapshot: dict) -> "VersionedEstimates":
+        return VersionedEstimates(
+            etag=etag, snapshot=snapshot, encoded=EncodedBody.of(snapshot)
+        )
+
+
+# Computations of a leg's estimates before giving up on getting them under a single version
+consistent_attempts = 3
+
+
+def versioned_estimates(
+    leg: SingleLeg, shared: SharedLookups | None = None
+) -> VersionedEstimates:
+    """
+    `next_estimates` along with its ETag and encoded JSON.
+
+    Versions are read before and after computing: a refresh landing meanwhile may have mixed
+    old and new data, the estimates are then computed again. If the data keeps changing,
+    the last snapshot is returned without an ETag, it is not cached.
+    """
+    shared = shared if shared else SharedLookups()
+    for _ in range(consistent_attempts):
+        versions = data_versions(leg)
+        snapshot = next_estimates(leg, shared)
+        if data_versions(leg) == versions:
+            return VersionedEstimates.of(
+                estimates_etag(versions, snapshot), snapshot
+            )
+
+    return VersionedEstimates.of(None, snapshot)
+
+
+recompute_seconds = Metrics.get_instance().histogram(
+    "estimates_recompute_seconds",
+    "Duration of materializing every leg's estimates",
+)
+
+
+class EstimateMaterializer:
+    """
+    Keeps a ready-to-serialize `next_estimates` snapshot of every tracked leg in memory,
+    so that serving one is a dictionary lookup.
+
+    Snapshots are all recomputed, by a single background thread, whenever:
+    - a TCL cache refresh lands (call `invalidate`)
+    - the head departure of a leg leaves
+    - the GTFS day rolls over, at midnight and at 4 am
+    Triggers arriving while a recompute runs are coalesced into the next one.
+
+    Listeners are called with the new snapshots, and the ids of the tracked legs, after every recompute.
+    Legs failing to compute are tracked but have no snapshot.
+    """
+
+    _instance: "EstimateMaterializer | None" = None
+
+    def __init__(self, legs_provider: Callable[[], list[SingleLeg]]):
+        if EstimateMaterializer._instance is not None:
+            raise RuntimeError(
+                "EstimateMaterializer singleton is already initialised"
+            )
+
+        self.legs_provider = legs_provider
+        # leg id -> snapshot with its ETag and JSON, replaced as a whole after each recompute
+        self.versioned: dict[int, VersionedEstimates] = {}
+        self.computed_at: datetime | None = None
+        self.next_deadline: datetime | None = None
+        # Called with the snapshots and the tracked leg ids after every recompute
+        self.listeners: list[Callable[[dict[int, dict], set[int]], None]] = []
+
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread: threading.Thread | None = None
+
+        EstimateMaterializer._instance = self
+
+    @classmethod
+    def get_instance(cls):
+        return cls._instance
+
+    @property
+    def snapshots(self) -> dict[int, dict]:
+        return {
+            leg_id: versioned.snapshot
+            for leg_id, versioned in self.versioned.items()
+        }
+
+    def get(self, leg_id: int) -> dict | None:
+        versioned = self.versioned.get(leg_id)
+        return versioned.snapshot if versioned else None
+
+    def get_versioned(self, leg_id: int) -> VersionedEstimates | None:
+        return self.versioned.get(leg_id)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped = True
+        self._wake.set()
+
+    def invalidate(self):
+        self._wake.set()
+
+    def recompute(self):
+        versioned = {}
+        legs = self.legs_provider()
+        shared = SharedLookups()
+
+        with recompute_seconds.time():
+            for leg in legs:
+                try:
+                    versioned[leg.id] = versioned_estimates(leg, shared)
+                except Exception as error:
+                    # Requests for this leg fall back to computing it live
+                    print(f"Failed materializing leg {leg.id}: {error!r}")
+
+        self.versioned = versioned
+        snapshots = self.snapshots
+        self.computed_at = datetime.now()
+        self.next_deadline = self._deadline(legs, snapshots)
+
+        leg_ids = {leg.id for leg in legs}
+        for listener in self.listeners:
+            listener(snapshots, leg_ids)
+
+    def _deadline(
+        self, legs: list[SingleLeg], snapshots: dict[int, dict]
+    ) -> datetime | None:
+        """
+        Earliest of the next head departure and the next GTFS day rollover.
+        """
+        if not legs:
+            return None
+
+        now = datetime.now(legs[0].gtfs.tz)
+        deadlines = [
+            datetime.combine(
+                now.date() + timedelta(days=1), time(0), now.tzinfo
+            )
+        ]
+        rollover = datetime.combine(now.date(), time(4), now.tzinfo)
+        deadlines.append(
+            rollover if rollover > now else rollover + timedelta(days=1)
+        )
+
+        for snapshot in snapshots.values():
+            if snapshot["estimates"]:
+                # Just after it leaves, so it is not the next departure anymore
+                deadlines.append(
+                    snapshot["estimates"][0]["departure_time"]
+                    + timedelta(seconds=1)
+                )
+
+        return min(deadlines)
+
+    def _loop(self):
+        while not self._stopped:
+            try:
+                self.recompute()
+                timeout = (
+                    max(
+                        0,
+                        (
+                            self.next_deadline
+                            - datetime.now(self.next_deadline.tzinfo)
+                        ).total_seconds(),
+                    )
+                    if self.next_deadline is not None
+                    else None
+                )
+            except Exception as error:
+                print(f"Failed materializing estimates: {error!r}")
+                timeout = 60
+
+            self._wake.wait(timeout)
+            self._wake.clear()
@@ -1,113 +1,273 @@
+import os
+
 from apscheduler.util import ZoneInfo
 import gtfs_kit as gk
-import pandas as pd
+import numpy as np
 from datetime import date, datetime, time, timedelta
 
+from instrumentation.metrics import Metrics
+from modules.trips.gtfs_compact import compact_feed
+from modules.trips.gtfs_snapshot import (
+    file_content_hash,
+    load_snapshot,
+    load_snapshot_index,
+)
+from modules.trips.service_calendar import ServiceCalendar
+from modules.trips.service_day_cache import ServiceDay, ServiceDayCache
+from modules.trips.stop_index import ServiceDayIndex, StopTimesIndex
+from modules.trips.topology import StopLine, StopTopology
+
+stop_times_lookup_seconds = Metrics.get_instance().histogram(
+    "gtfs_stop_times_lookup_seconds",
+    "Duration of next departures / arrivals lookups at a stop",
+    ("column",),
+)
+
 
 class Gtfs:
     default_path = "assets/GTFS_TCL.ZIP"
+    # Upper bound of the memory used by cached service days, in MB.
+    # A day is a view of the feed-wide stop times index, 16 bytes per stop time running that day
+    # (time and trip code, of departures and arrivals):
+    # unset, the budget fits `service_days_cached` days running every trip of the feed.
+    service_day_cache_mb = os.getenv("GTFS_SERVICE_DAY_CACHE_MB")
+    # The days `prefetch_upcoming_service_days` warms, and one more
+    service_days_cached = 4
+
+    def __init__(
+        self, path: str | None = None, *, content_hash: str | None = None
+    ):
+        """
+        Prefer `GtfsRegistry.get` over instantiating this directly: parsing a
+        feed is expensive and the result is meant to be shared.
 
-    def __init__(self, path: str | None = None):
+        Opens the compiled snapshot of the feed if there is an up to date one (see `compile_gtfs`),
+        otherwise parses the ZIP.
+        Either way the feed is compact (see `compact_feed`): stop times are int32 seconds.
+        """
         self.file_path = path
-        self.feed = gk.read_feed(
-            self.file_path if self.file_path else Gtfs.default_path,
-            dist_units="km",
+        zip_path = self.file_path if self.file_path else Gtfs.default_path
+        self.content_hash = (
+            content_hash if content_hash else file_content_hash(zip_path)
+        )
+
+        feed = load_snapshot(zip_path, self.content_hash)
+        self.source = "snapshot" if feed is not None else "zip"
+        # Snapshots are compacted when compiled, the report is then empty
+        self.feed, self.compaction = compact_feed(
+            feed
+            if feed is not None
+            else gk.read_feed(zip_path, dist_units="km")
         )
 
-        self.stop_time_cache: dict[date, pd.DataFrame] = {}
-        fields = self.feed.list_fields()
-        all_tz_string = fields.loc[fields["column"] == "agency_timezone"]
+        all_tz_string = self.feed.agency["agency_timezone"].unique()
         if len(all_tz_string) > 1:
             raise RuntimeError(
                 "Too many agencies TZ to choose from, don't know what to do. Make me smarter !"
             )
 
-        tz_string = fields.loc[
-            fields["column"] == "agency_timezone", "max_value"
-        ].iloc[0]
-        self.tz = ZoneInfo(tz_string)
-        now = datetime.now(self.tz)
+        self.tz = ZoneInfo(str(all_tz_string[0]))
+        self.date = self.current_service_date()
+
+        self.trips = self.feed.get_trips().drop_duplicates("trip_id")
+        self.routes = self.feed.get_routes()
+        self.stops = self.feed.get_stops()
 
-        # Our use-case for trips is to get estimates for the next passage of a given line.
-        # Naturally, we are interested in today's passages ...
-        # It is useful to cache that in RAM.
-        # Trams and buses run from about 4 am to 2 am next day
-        # The feed actually has 26 hour days instead of 24,
-        # therefore if we are very early in the morning it is more relevant to see data from yesterday
-        self.date = (
-            (now - timedelta(days=1)).date()
-            if now.hour < 4
-            else now.today().date()
+        # Which trips run on a given day is a lookup in the calendar's bitmap,
+        # each day's stop times are then a view of the feed-wide index
+        self.calendar = ServiceCalendar(
+            self.feed.calendar, self.feed.calendar_dates
         )
+        # Memory-mapped from the snapshot when there is one, shared by every process using it
+        snapshot_index = (
+            load_snapshot_index(zip_path, self.content_hash)
+            if self.source == "snapshot"
+            else None
+        )
+        self.stop_times_index = (
+            snapshot_index
+            if snapshot_index is not None
+            else StopTimesIndex.from_feed(self.feed)
+        )
+        self.service_days = ServiceDayCache(
+            self._load_service_day,
+            max_bytes=int(Gtfs.service_day_cache_mb) * 1024 * 1024
+            if Gtfs.service_day_cache_mb
+            else Gtfs.service_days_cached
+            * self.stop_times_index.day_view_bytes(),
+        )
+        # Service of each trip code of the index
+        self.trip_service_codes = self.calendar.service_codes(
+            self.trips.assign(trip_id=self.trips["trip_id"].astype(str))
+            .set_index("trip_id")["service_id"]
+            .reindex(self.stop_times_index.trip_ids)
+        )
+        # Leg validation and stop info are lookups in it rather than stop_times scans
+        self.topology = StopTopology.build(
+            self.stop_times_index,
+            trips=self.trips,
+            routes=self.routes,
+            stops=self.stops,
+        )
+
+        self.service_days.get(self.date)
+
+    def current_service_date(self, now: datetime | None = None) -> date:
+        """
+        Our use-case for trips is to get estimates for the next passage of a given line.
+        Naturally, we are interested in today's passages ...
+        Trams and buses run from about 4 am to 2 am next day
+        The feed actually has 26 hour days instead of 24,
+        therefore if we are very early in the morning it is more relevant to see data from yesterday
+        """
+        now = now if now else datetime.now(self.tz)
 
-        self.stop_time_cache[self.date] = self.feed.get_stop_times(
-            self.date.strftime("%Y%m%d")
+        return (now - timedelta(days=1)).date() if now.hour < 4 else now.date()
+
+    def prefetch_upcoming_service_days(self):
+        """
+        Warm the cache in the background for the days requests are about to need:
+        the current service day, today's calendar date and tomorrow,
+        which `SingleLeg.get_estimates` falls back to once today's last trip is gone.
+
+        No-op for days already cached.
+        """
+        now = datetime.now(self.tz)
+        for service_date in sorted(
+            {
+                self.current_service_date(now),
+                now.date(),
+                now.date() + timedelta(days=1),
+            }
+        ):
+            self.service_days.prefetch(service_date)
+
+    def service_window(
+        self, service_date: date
+    ) -> tuple[datetime, datetime] | None:
+        """
+        Returns when the first trip of service_date leaves and when its last trip arrives,
+        None if nothing runs that day.
+        """
+        index = self._get_service_day(service_date)
+        if index.first_seconds is None or index.last_seconds is None:
+            return None
+
+        midnight = datetime.combine(service_date, time(0), tzinfo=self.tz)
+        return (
+            midnight + timedelta(seconds=index.first_seconds),
+            midnight + timedelta(seconds=index.last_seconds),
+        )
+
+    def active_trips(self, service_date: date) -> np.ndarray:
+        """
+        Mask over the trip codes of `stop_times_index` of the trips running on service_date.
+        """
+        # Services unknown to the calendar have code -1, which picks the trailing False
+        return np.append(self.calendar.active_services(service_date), False)[
+            self.trip_service_codes
+        ]
+
+    def memory_usage(self) -> int:
+        """
+        Deep size in bytes of the feed tables, their indexes and cached service days.
+        """
+        tables = [
+            getattr(self.feed, name)
+            for name in [
+                "agency",
+                "stops",
+                "routes",
+                "trips",
+                "stop_times",
+                "calendar",
+                "calendar_dates",
+                "shapes",
+            ]
+        ]
+
+        return (
+            int(
+                sum(
+                    table.memory_usage(deep=True).sum()
+                    for table in tables
+                    if table is not None
+                )
+            )
+            + self.calendar.memory_usage()
+            + self.stop_times_index.memory_usage()
+            + self.topology.memory_usage()
+            + self.service_days.memory_usage()
         )
-        self.trips = self.feed.get_trips()
-        self.routes = self.feed.get_routes()
-        self.stops = self.feed.get_stops()
 
     def on_same_transit_line(
         self, stop_a: int | str, stop_b: int | str
     ) -> bool:
-        stop_a = str(stop_a)
-        stop_b = str(stop_b)
-
-        stop_times = self._get_stop_times()
+        """
+        Whether a trip stops at both stops, in either order, on any day.
+        """
+        return bool(
+            self.topology.lines_between(stop_a, stop_b)
+            or self.topology.lines_between(stop_b, stop_a)
+        )
 
-        df_stop_a = stop_times.loc[(stop_times["stop_id"] == stop_a)]
-        df_stop_b = stop_times.loc[(stop_times["stop_id"] == stop_b)]
+    def get_stop_lines(
+        self,
+        stop_id: int | str,
+        *,
+        towards_stop_id: int | str | None = None,
+    ) -> list[StopLine]:
+        """
+        Lines serving stop_id, the busiest first.
+        With towards_stop_id, only those with trips going on to towards_stop_id.
+        """
+        if towards_stop_id is None:
+            return self.topology.lines_at_stop(stop_id)
 
-        # To read: Is there a shared trip ID ?
-        return df_stop_b["trip_id"].isin(df_stop_a["trip_id"].unique()).any()
+        return self.topology.lines_between(stop_id, towards_stop_id)
 
-    def get_stop_info(self, stop_id: int | str) -> tuple[str, str, str, str]:
+    def get_stop_info(
+        self,
+        stop_id: int | str,
+        *,
+        towards_stop_id: int | str | None = None,
+    ) -> tuple[str, str, str, str]:
         """
         Get information about a stop including its name, route long name, trip headsign, and route short name.
 
         Args:
             stop_id: The ID of the stop to look up
+            towards_stop_id: Describe the line taking us from stop_id to this stop.
+                Otherwise, of the lines serving stop_id, the busiest one.
 
         Returns:
             tuple: (stop_name, route_long_name, trip_headsign, route_short_name)
 
         Raises:
-            ValueError: If the stop ID is not found in the stops data
+            ValueError: If the stop ID is not found in the stops data, or no line serves it (towards towards_stop_id)
         """
-        stop_id = str(stop_id)
-
-        stop_times = self._get_stop_times()
-        stop_to_trip = pd.merge(
-            stop_times[["stop_id", "trip_id"]],
-            self.trips[["trip_id", "route_id", "trip_headsign"]],
-            on="trip_id",
-        )
-        stop_to_route = pd.merge(
-            stop_to_trip,
-            self.routes[["route_id", "route_long_name", "route_short_name"]],
-            on="route_id",
-        )
-        stop_routes = stop_to_route[
-            stop_to_route["stop_id"] == stop_id
-        ].drop_duplicates(["route_id"])
-        if self.stops[self.stops["stop_id"] == stop_id].empty:
+        stop_name = self.topology.stop_name(stop_id)
+        if stop_name is None:
             raise ValueError(f"Stop ID {stop_id} not found in stops data")
 
-        stop_name = self.stops[self.stops["stop_id"] == stop_id][
-            "stop_name"
-        ].iloc[0]
-        result = []
-        for _, row in stop_routes.iterrows():
-            result.append(
-                (
-                    stop_name,
-                    row["route_long_name"],
-                    row["trip_headsign"],
-                    row["route_short_name"],
+        lines = self.get_stop_lines(stop_id, towards_stop_id=towards_stop_id)
+        if not lines:
+            raise ValueError(
+                f"No line serves stop {stop_id}"
+                + (
+                    f" towards stop {towards_stop_id}"
+                    if towards_stop_id is not None
+                    else ""
                 )
             )
-        # Assume simple stops belonging to a single line
-        return result[0]
+
+        line = lines[0]
+        return (
+            stop_name,
+            line.route_long_name,
+            line.trip_headsign,
+            line.route_short_name,
+        )
 
     def parse_gtfs_time(self, date: date, time_str: str) -> datetime:
         """
@@ -125,25 +285,16 @@ class Gtfs:
             date, time(hours_normalized, minutes, seconds), tzinfo=self.tz
         ) + timedelta(days=days_to_add)
 
-    def _get_stop_times(self, date: date | None = None) -> pd.DataFrame:
-        """
-        Return the cached stop times for date.
-        If date is None, return any stop times which is useful when you just need a random one
+    def _load_service_day(self, date: date) -> ServiceDay:
+        return ServiceDay.build(
+            date, self.stop_times_index, self.active_trips(date)
+        )
 
-        Side effects: wipe the cache when we reach 50 elems. If it grows infinitely one day we will run out of RAM...
+    def _get_service_day(self, date: date) -> ServiceDayIndex:
         """
-
-        if not date:
-            return list(self.stop_time_cache.values())[0]
-
-        if len(self.stop_time_cache) == 50:
-            self.stop_time_cache.clear()
-
-        stop_times = self.feed.get_stop_times(date.strftime("%Y%m%d"))
-
-        self.stop_time_cache[self.date] = stop_times
-
-        return stop_times
+        Return the per-stop index of date's service day, building it on first use.
+        """
+        return self.service_days.get(date).index
 
     def _next_stop_times_at_stop(
         self,
@@ -151,8 +302,10 @@ class Gtfs:
         stop_id: str | int,
         column_name: str,
         trip_id: str | None = None,
+        towards_stop_id: str | int | None = None,
         count: int = -1,
         local_timestamp: datetime,
+        service_date: date | None = None,
     ) -> list[tuple[str, datetime]]:
         stop_id = str(stop_id)
         if column_name not in ["departure_time", "arrival_time"]:
@@ -160,39 +313,61 @@ class Gtfs:
                 "Column name must be one of departure_time or arrival_time"
             )
 
-        stop_times = self._get_stop_times(local_timestamp.date())
-
-        df = stop_times.loc[(stop_times["stop_id"] == stop_id)]
-        if trip_id:
-            df = df.loc[df["trip_id"] == trip_id]
-        df = df.loc[
-            df[column_name] > local_timestamp.time().strftime("%H:%M:%S")
-        ]
-        sorted_df = df.sort_values(by=[column_name])
-        list_of_tuples = [
-            (
-                next_stop["trip_id"],
-                self.parse_gtfs_time(
-                    local_timestamp.date(), next_stop[column_name]
-                ),
+        with stop_times_lookup_seconds.time(column_name):
+            service_date = (
+                service_date if service_date else local_timestamp.date()
             )
-            for _, next_stop in sorted_df.iterrows()
-        ]
-        if count > -1:
-            return list_of_tuples[:count]
-        return list_of_tuples
+            service_day = self._get_service_day(service_date)
+            # Seconds since the service day's midnight, past 24:00 on the next calendar day.
+            # Same wall clock arithmetic as parse_gtfs_time, both ways.
+            midnight = datetime.combine(service_date, time(0), tzinfo=self.tz)
+            after_seconds = int(
+                (
+                    local_timestamp.replace(tzinfo=self.tz) - midnight
+                ).total_seconds()
+            )
+
+            if trip_id:
+                next_stop_times = [
+                    (trip_id, seconds)
+                    for seconds in service_day.trip_times_at_stop(
+                        trip_id, stop_id, column=column_name
+                    )
+                    if seconds > after_seconds
+                ]
+                if count > -1:
+                    next_stop_times = next_stop_times[:count]
+            else:
+                next_stop_times = service_day.next_at_stop(
+                    stop_id,
+                    column=column_name,
+                    after_seconds=after_seconds,
+                    count=count,
+                    trip_mask=self.topology.trip_mask_between(
+                        stop_id, towards_stop_id
+                    )
+                    if towards_stop_id is not None
+                    else None,
+                )
+
+            return [
+                (next_trip_id, midnight + timedelta(seconds=seconds))
+                for next_trip_id, seconds in next_stop_times
+            ]
 
     def next_departures_at_stop(
         self,
         stop_id: str | int,
         *,
         trip_id: str | None = None,
+        towards_stop_id: str | int | None = None,
         count: int = -1,
         local_timestamp: datetime,
     ) -> list[tuple[str, datetime]]:
         """
         Return the count next departures at transport station stop_id, happening after timestamp.
         If trip_id is specified, filter such that only departures on trip trip_id are returned.
+        If towards_stop_id is specified, only departures of trips later stopping at towards_stop_id are returned.
 
         Times are in the timezone local to the GTFS file.
 
@@ -204,6 +379,7 @@ class Gtfs:
             stop_id=stop_id,
             column_name="departure_time",
             trip_id=trip_id,
+            towards_stop_id=towards_stop_id,
             count=count,
             local_timestamp=local_timestamp,
         )
@@ -215,10 +391,13 @@ class Gtfs:
         trip_id: str | None = None,
         count: int = -1,
         local_timestamp: datetime,
+        service_date: date | None = None,
     ) -> list[tuple[str, datetime]]:
         """
         Return the count next arrivals at transport station stop_id, happening after timestamp.
         If trip_id is specified, filter such that only arrivals on trip trip_id are returned.
+        service_date is the service day to look in, timestamp's date by default:
+        pass the trip's for arrivals past midnight (24:xx) of a trip of the day before.
 
         Returns list of tuples:
             - trip_id
@@ -230,4 +409,5 @@ class Gtfs:
             trip_id=trip_id,
             count=count,
             local_timestamp=local_timestamp,
+            service_date=service_date,
         )
@@ -0,0 +1,120 @@
+from dataclasses import dataclass, field
+
+import gtfs_kit as gk
+import numpy as np
+import pandas as pd
+
+from modules.trips.stop_index import NO_TIME, gtfs_times_to_seconds
+
+# Columns something in the service reads, directly or through gtfs_kit. Everything else is dropped.
+USED_COLUMNS = {
+    "agency": ["agency_id", "agency_name", "agency_timezone"],
+    "stops": ["stop_id", "stop_name"],
+    "routes": ["route_id", "route_short_name", "route_long_name"],
+    "trips": ["trip_id", "route_id", "service_id", "trip_headsign"],
+    "stop_times": [
+        "trip_id",
+        "stop_id",
+        "stop_sequence",
+        "arrival_time",
+        "departure_time",
+    ],
+    "calendar": [
+        "service_id",
+        "monday",
+        "tuesday",
+        "wednesday",
+        "thursday",
+        "friday",
+        "saturday",
+        "sunday",
+        "start_date",
+        "end_date",
+    ],
+    "calendar_dates": ["service_id", "date", "exception_type"],
+}
+
+# Ids repeated over many rows, interned as categoricals
+ID_COLUMNS = {
+    "trips": ["trip_id", "route_id", "service_id", "trip_headsign"],
+    "stop_times": ["trip_id", "stop_id"],
+}
+
+TIME_COLUMNS = ["arrival_time", "departure_time"]
+
+
+@dataclass
+class CompactionReport:
+    # table -> (bytes before, bytes after)
+    tables: dict[str, tuple[int, int]] = field(default_factory=dict)
+
+    @property
+    def bytes_before(self) -> int:
+        return sum(before for before, _ in self.tables.values())
+
+    @property
+    def bytes_after(self) -> int:
+        return sum(after for _, after in self.tables.values())
+
+    def to_dict(self):
+        return {
+            "bytes_before": self.bytes_before,
+            "bytes_after": self.bytes_after,
+            "tables": {
+                table: {"bytes_before": before, "bytes_after": after}
+                for table, (before, after) in self.tables.items()
+            },
+        }
+
+    def __str__(self):
+        return (
+            f"{self.bytes_before / 1024 / 1024:.1f} MB -> "
+            f"{self.bytes_after / 1024 / 1024:.1f} MB"
+        )
+
+
+def is_compact(feed: gk.Feed) -> bool:
+    return feed.stop_times is not None and pd.api.types.is_integer_dtype(
+        feed.stop_times["departure_time"].dtype
+    )
+
+
+def compact_feed(feed: gk.Feed) -> tuple[gk.Feed, CompactionReport]:
+    """
+    Shrink feed to what the service queries:
+    - unused tables (shapes...) and columns are dropped
+    - stop times become int32 seconds since the start of the service day, NO_TIME when empty
+    - repeated ids become categoricals
+    - stop_sequence becomes int32
+
+    A feed that is already compact, e.g. loaded from a snapshot, is returned as is.
+    """
+    report = CompactionReport()
+    if is_compact(feed):
+        return feed, report
+
+    tables = {}
+    for table, columns in USED_COLUMNS.items():
+        df = getattr(feed, table)
+        if df is None:
+            continue
+
+        before = int(df.memory_usage(deep=True).sum())
+        df = df[[column for column in columns if column in df.columns]].copy()
+
+        for column in ID_COLUMNS.get(table, []):
+            if column in df.columns:
+                df[column] = df[column].astype("category")
+
+        if table == "stop_times":
+            for column in TIME_COLUMNS:
+                known = df[column].notna().to_numpy()
+                seconds = np.full(len(df), NO_TIME, dtype=np.int32)
+                seconds[known] = gtfs_times_to_seconds(df.loc[known, column])
+                df[column] = seconds
+            df["stop_sequence"] = df["stop_sequence"].astype(np.int32)
+
+        tables[table] = df
+        report.tables[table] = (before, int(df.memory_usage(deep=True).sum()))
+
+    return gk.Feed(dist_units=feed.dist_units, **tables), report
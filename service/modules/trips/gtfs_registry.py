@@ -0,0 +1,192 @@
+import os
+import threading
+import time
+from dataclasses import dataclass
+
+from modules.trips.gtfs import Gtfs
+from modules.trips.gtfs_snapshot import ensure_snapshot, file_content_hash
+
+
+def current_rss_bytes() -> int | None:
+    """
+    Resident set size of the current process, None when /proc is not available.
+    """
+    try:
+        with open("/proc/self/statm") as file:
+            resident_pages = int(file.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return resident_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+@dataclass(frozen=True)
+class GtfsLoadReport:
+    path: str
+    content_hash: str
+    # "snapshot" or "zip"
+    source: str
+    load_seconds: float
+    # Deep size of the feed's DataFrames
+    memory_bytes: int
+    # Growth of the process RSS while loading, None if we can't measure it
+    rss_delta_bytes: int | None
+    # Size of the feed's tables before and after `compact_feed`, None when loaded already compact
+    compaction: dict | None
+
+    def to_dict(self):
+        return {
+            "path": self.path,
+            "content_hash": self.content_hash,
+            "source": self.source,
+            "load_seconds": self.load_seconds,
+            "memory_bytes": self.memory_bytes,
+            "rss_delta_bytes": self.rss_delta_bytes,
+            "compaction": self.compaction,
+        }
+
+
+class GtfsRegistry:
+    """
+    Process-wide registry of loaded GTFS feeds.
+
+    Parsing a feed is expensive (minutes and hundreds of MB for a whole city),
+    so each feed is loaded once per (path, content hash) and the same `Gtfs`
+    instance is shared by every leg and router asking for it.
+    """
+
+    _feeds: dict[tuple[str, str], Gtfs] = {}
+    _reports: dict[tuple[str, str], GtfsLoadReport] = {}
+    # Feeds being loaded, concurrent callers wait on the event instead of loading them twice
+    _loading: dict[tuple[str, str], threading.Event] = {}
+    # Avoid re-hashing a file we already know: (path) -> (mtime, size, hash)
+    _hashes: dict[str, tuple[float, int, str]] = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def get(
+        cls, path: str | None = None, *, from_snapshot: bool = False
+    ) -> Gtfs:
+        """
+        The feed at path, loaded on first use.
+        from_snapshot compiles its snapshot first if missing (see `ensure_snapshot`) and loads from it.
+
+        Loading happens outside the registry lock: `reports` and `feeds` stay readable
+        meanwhile. Concurrent callers for the same feed wait for the one loading it.
+        """
+        path = os.path.abspath(path if path else Gtfs.default_path)
+        key = (path, cls._content_hash(path))
+
+        while True:
+            with cls._lock:
+                gtfs = cls._feeds.get(key)
+                if gtfs is not None:
+                    return gtfs
+
+                loading = cls._loading.get(key)
+                if loading is None:
+                    loading = threading.Event()
+                    cls._loading[key] = loading
+                    break
+
+            # Somebody else is loading it, wait and retry the lookup
+            loading.wait()
+
+        try:
+            if from_snapshot:
+                cls._ensure_snapshot(path, key[1])
+            gtfs, report = cls._load(path, key[1])
+
+            with cls._lock:
+                # A new version of the file replaces the previous one
+                for stale_key in [k for k in cls._feeds if k[0] == path]:
+                    del cls._feeds[stale_key]
+                    del cls._reports[stale_key]
+
+                cls._feeds[key] = gtfs
+                cls._reports[key] = report
+        finally:
+            with cls._lock:
+                del cls._loading[key]
+            loading.set()
+
+        return gtfs
+
+    @classmethod
+    def reports(cls) -> list[GtfsLoadReport]:
+        with cls._lock:
+            return list(cls._reports.values())
+
+    @classmethod
+    def feeds(cls) -> list[Gtfs]:
+        with cls._lock:
+            return list(cls._feeds.values())
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            cls._feeds = {}
+            cls._reports = {}
+            cls._hashes = {}
+
+    @classmethod
+    def _load(cls, path: str, content_hash: str) -> tuple[Gtfs, GtfsLoadReport]:
+        rss_before = current_rss_bytes()
+        started_at = time.perf_counter()
+        gtfs = Gtfs(path, content_hash=content_hash)
+        load_seconds = time.perf_counter() - started_at
+        rss_after = current_rss_bytes()
+
+        report = GtfsLoadReport(
+            path=path,
+            content_hash=content_hash,
+            source=gtfs.source,
+            load_seconds=load_seconds,
+            memory_bytes=gtfs.memory_usage(),
+            rss_delta_bytes=rss_after - rss_before
+            if rss_before is not None and rss_after is not None
+            else None,
+            compaction=gtfs.compaction.to_dict()
+            if gtfs.compaction.tables
+            else None,
+        )
+
+        print(
+            f"Loaded GTFS feed {path} from {gtfs.source} in {load_seconds:.1f}s "
+            f"({report.memory_bytes / 1024 / 1024:.1f} MB)"
+        )
+        if gtfs.compaction.tables:
+            print(f"Compacted GTFS feed {path}: {gtfs.compaction}")
+
+        return gtfs, report
+
+    @classmethod
+    def _ensure_snapshot(cls, path: str, content_hash: str):
+        started_at = time.perf_counter()
+        try:
+            ensure_snapshot(path, content_hash)
+        except OSError as error:
+            # A read-only snapshot directory for instance, the ZIP is parsed instead
+            print(f"Failed compiling the GTFS snapshot of {path}: {error!r}")
+            return
+
+        print(
+            f"GTFS snapshot of {path} ready in {time.perf_counter() - started_at:.1f}s"
+        )
+
+    @classmethod
+    def _content_hash(cls, path: str) -> str:
+        """
+        Hashing happens outside the registry lock, callers racing on a new file may both hash it.
+        """
+        stat = os.stat(path)
+        with cls._lock:
+            known = cls._hashes.get(path)
+        if known and known[0] == stat.st_mtime and known[1] == stat.st_size:
+            return known[2]
+
+        content_hash = file_content_hash(path)
+        with cls._lock:
+            cls._hashes[path] = (stat.st_mtime, stat.st_size, content_hash)
+
+        return content_hash
@@ -0,0 +1,223 @@
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+
+import gtfs_kit as gk
+import numpy as np
+import pandas as pd
+
+from modules.trips.gtfs_compact import USED_COLUMNS, compact_feed
+from modules.trips.stop_index import StopTimesIndex
+
+# Bump whenever the layout of the files changes, older snapshots are then ignored
+SNAPSHOT_VERSION = 3
+
+# Tables the service uses, the others (shapes...) are not worth the disk or RAM
+TABLES = list(USED_COLUMNS)
+
+# Strings of the big tables stay Categoricals backed by the memory-mapped codes.
+# Small tables get plain strings back: gtfs_kit compares some of their columns
+# (calendar dates...) with < and >, which unordered Categoricals don't support.
+CATEGORICAL_TABLES = ["trips", "stop_times"]
+
+# In the snapshot root, held while a process checks for or compiles a snapshot
+LOCK_FILE = ".lock"
+
+
+def file_content_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def snapshot_root(zip_path: str) -> str:
+    root = os.getenv("GTFS_SNAPSHOT_DIR")
+    if root:
+        return os.path.join(root, os.path.basename(zip_path) + ".snapshot")
+
+    return zip_path + ".snapshot"
+
+
+def snapshot_directory(zip_path: str, content_hash: str) -> str:
+    """
+    Snapshots live in a directory named after the hash of the ZIP they were compiled from,
+    a new ZIP never picks up a stale snapshot.
+    """
+    return os.path.join(snapshot_root(zip_path), content_hash)
+
+
+def compile_snapshot(zip_path: str, content_hash: str | None = None) -> str:
+    """
+    Compile the GTFS ZIP at zip_path to a columnar snapshot that `load_snapshot` can memory-map.
+    The feed is compacted first (see `compact_feed`), so loading it needs no conversion.
+
+    Every column is stored as its own .npy file:
+    - string columns as integer codes plus their distinct values, like a pandas Categorical
+    - other columns as is
+
+    See CATEGORICAL_TABLES for how string columns are loaded back.
+    The feed-wide `StopTimesIndex` is saved alongside, see `load_snapshot_index`.
+
+    The manifest is written last so that a half written snapshot is never loaded.
+    Returns the snapshot directory.
+    """
+    content_hash = content_hash if content_hash else file_content_hash(zip_path)
+    directory = snapshot_directory(zip_path, content_hash)
+    if os.path.exists(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+
+    feed, _ = compact_feed(gk.read_feed(zip_path, dist_units="km"))
+    manifest = {
+        "version": SNAPSHOT_VERSION,
+        "content_hash": content_hash,
+        "dist_units": feed.dist_units,
+        "tables": {},
+    }
+
+    for table in TABLES:
+        df = getattr(feed, table)
+        if df is None:
+            continue
+
+        columns = []
+        for column in df.columns:
+            prefix = os.path.join(directory, f"{table}.{column}")
+            series = df[column]
+
+            if not pd.api.types.is_numeric_dtype(series.dtype):
+                categorical = pd.Categorical(series)
+                np.save(f"{prefix}.codes.npy", categorical.codes)
+                np.save(
+                    f"{prefix}.categories.npy",
+                    np.array(categorical.categories.astype(str), dtype=str),
+                )
+                columns.append(
+                    {
+                        "name": column,
+                        "kind": "categorical"
+                        if table in CATEGORICAL_TABLES
+                        else "strings",
+                    }
+                )
+            else:
+                np.save(f"{prefix}.npy", series.to_numpy())
+                columns.append({"name": column, "kind": "values"})
+
+        manifest["tables"][table] = {"rows": len(df), "columns": columns}
+
+    StopTimesIndex.from_feed(feed).save(directory)
+
+    with open(os.path.join(directory, "manifest.json"), "w") as file:
+        json.dump(manifest, file, indent=2)
+
+    # Only the snapshot of the current ZIP is of any use
+    root = snapshot_root(zip_path)
+    for other in os.listdir(root):
+        if other not in [content_hash, LOCK_FILE]:
+            shutil.rmtree(os.path.join(root, other), ignore_errors=True)
+
+    return directory
+
+
+def ensure_snapshot(
+    zip_path: str, content_hash: str | None = None, *, force: bool = False
+) -> str:
+    """
+    Directory of the up to date snapshot of the ZIP at zip_path, compiled first if missing,
+    or in any case with force.
+
+    Processes sharing the feed all call this when the ZIP changes: the lock makes the first
+    one compile it while the others wait, then they all memory-map the same snapshot.
+    Returns the snapshot directory.
+    """
+    content_hash = content_hash if content_hash else file_content_hash(zip_path)
+    root = snapshot_root(zip_path)
+    os.makedirs(root, exist_ok=True)
+
+    with open(os.path.join(root, LOCK_FILE), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if force or read_manifest(zip_path, content_hash) is None:
+            compile_snapshot(zip_path, content_hash)
+
+    return snapshot_directory(zip_path, content_hash)
+
+
+def read_manifest(zip_path: str, content_hash: str) -> dict | None:
+    """
+    Manifest of the snapshot compiled from the ZIP at zip_path, None if it is missing or stale.
+    """
+    manifest_path = os.path.join(
+        snapshot_directory(zip_path, content_hash), "manifest.json"
+    )
+    if not os.path.exists(manifest_path):
+        return None
+
+    with open(manifest_path) as file:
+        manifest = json.load(file)
+
+    if (
+        manifest.get("version") != SNAPSHOT_VERSION
+        or manifest.get("content_hash") != content_hash
+    ):
+        return None
+
+    return manifest
+
+
+def load_snapshot_index(
+    zip_path: str, content_hash: str
+) -> StopTimesIndex | None:
+    """
+    Memory-map the `StopTimesIndex` compiled with the snapshot, None if there is no up to date snapshot.
+    """
+    if read_manifest(zip_path, content_hash) is None:
+        return None
+
+    return StopTimesIndex.load(snapshot_directory(zip_path, content_hash))
+
+
+def load_snapshot(zip_path: str, content_hash: str) -> gk.Feed | None:
+    """
+    Open the snapshot compiled from the ZIP at zip_path, None if it is missing or stale.
+
+    Columns are memory-mapped rather than read: pages are only loaded when accessed,
+    and processes opening the same snapshot share them through the page cache.
+    """
+    manifest = read_manifest(zip_path, content_hash)
+    if manifest is None:
+        return None
+
+    directory = snapshot_directory(zip_path, content_hash)
+
+    tables = {}
+    for table, spec in manifest["tables"].items():
+        columns = {}
+        for column in spec["columns"]:
+            prefix = os.path.join(directory, f"{table}.{column['name']}")
+
+            if column["kind"] in ["categorical", "strings"]:
+                categories = np.load(f"{prefix}.categories.npy")
+                categorical = pd.Categorical.from_codes(
+                    np.load(f"{prefix}.codes.npy", mmap_mode="r"),
+                    categories=categories.astype(object),
+                    validate=False,
+                )
+                columns[column["name"]] = (
+                    categorical
+                    if column["kind"] == "categorical"
+                    else np.asarray(categorical, dtype=object)
+                )
+            else:
+                columns[column["name"]] = np.load(
+                    f"{prefix}.npy", mmap_mode="r"
+                )
+
+        tables[table] = pd.DataFrame(columns, copy=False)
+
+    return gk.Feed(dist_units=manifest["dist_units"], **tables)
@@ -1,6 +1,7 @@
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 from modules.trips.gtfs import Gtfs
+from modules.trips.gtfs_registry import GtfsRegistry
 from grand_lyon_data.grand_lyon_api import GrandLyonApi
 from grand_lyon_data.sytral.incident_api import GrandLyonIncidentApi
 from grand_lyon_data.sytral.next_passage_api import (
@@ -19,7 +20,7 @@ class SingleLeg:
         transport_incident_api: GrandLyonIncidentApi | None = None,
         delay_api: GrandLyonNextPassageApi | None = None,
     ):
-        self.gtfs = gtfs if gtfs is not None else Gtfs()
+        self.gtfs = gtfs if gtfs is not None else GtfsRegistry.get()
         self.delay_api = (
             delay_api if delay_api else GrandLyonApi.tcl_delay_api()
         )
@@ -34,8 +35,9 @@ class SingleLeg:
                 f"Station {from_stop} and Station {to_stop} are on different transit lines"
             )
 
+        # The line taking us there, when several serve the origin
         from_stop_name, line_long_name, trip_direction, line_short_name = (
-            self.gtfs.get_stop_info(from_stop)
+            self.gtfs.get_stop_info(from_stop, towards_stop_id=to_stop)
         )
         to_stop_name, _, _, _ = self.gtfs.get_stop_info(to_stop)
 
@@ -60,23 +62,27 @@ class SingleLeg:
             "line_short_name": self.line_short_name,
         }
 
-    def get_estimates(
+    def get_departures(
         self,
         utc_timestamp: datetime | None = None,
         count: int = 3,
-    ) -> list[tuple[str, datetime, datetime]]:
+    ) -> list[tuple[str, datetime, date]]:
         """
+        Returns the count next departures from origin, of trips going on to destination.
+        Legs between the same stops can share them.
+
         Returns list of tuple:
             - trip ID
             - datetime of departure from origin (using local TZ of the GTFS file)
-            - datetime of corresponding arrival at destination (using local TZ of the GTFS file)
+            - service date of the trip, the day before the departure's for times past 24:00
         """
-
         utc_timestamp = utc_timestamp if utc_timestamp else datetime.now()
         local_timestamp = utc_timestamp.astimezone(self.gtfs.tz)
+        service_date = local_timestamp.date()
 
         next_departures_from_origin = self.gtfs.next_departures_at_stop(
             self.from_stop,
+            towards_stop_id=self.to_stop,
             count=count,
             local_timestamp=local_timestamp,
         )
@@ -84,21 +90,48 @@ class SingleLeg:
         if len(next_departures_from_origin) == 0:
             # No results possibly means we have no more trips today
             # Let's return tomorrow's first trips instead
+            service_date += timedelta(days=1)
             next_departures_from_origin = self.gtfs.next_departures_at_stop(
                 self.from_stop,
+                towards_stop_id=self.to_stop,
                 count=count,
                 local_timestamp=(local_timestamp + timedelta(days=1)).replace(
                     hour=0, minute=0, second=0
                 ),
             )
 
+        return [
+            (trip_id, departure_time, service_date)
+            for trip_id, departure_time in next_departures_from_origin
+        ]
+
+    def get_estimates(
+        self,
+        utc_timestamp: datetime | None = None,
+        count: int = 3,
+        *,
+        departures: list[tuple[str, datetime, date]] | None = None,
+    ) -> list[tuple[str, datetime, datetime]]:
+        """
+        Pass departures from `get_departures` if you already have them.
+
+        Returns list of tuple:
+            - trip ID
+            - datetime of departure from origin (using local TZ of the GTFS file)
+            - datetime of corresponding arrival at destination (using local TZ of the GTFS file)
+        """
+        if departures is None:
+            departures = self.get_departures(utc_timestamp, count)
+
         estimates = []
-        for trip_id, departure_time in next_departures_from_origin:
+        for trip_id, departure_time, service_date in departures:
+            # On the trip's service day: after midnight, the calendar date is the next one
             _, arrival_time = self.gtfs.next_arrivals_at_stop(
                 self.to_stop,
                 trip_id=trip_id,
                 count=1,
                 local_timestamp=departure_time,
+                service_date=service_date,
             )[0]
 
             estimates.append((trip_id, departure_time, arrival_time))
@@ -108,8 +141,10 @@ class SingleLeg:
     def get_delays(self, trip_id: str, force_refetch: bool = False):
         # short line can be something like C8
         # While cannonical commercial name can be C8A
+        # The trip passes other stops too, its delay at the origin is the one we are after
         delays = self.delay_api.get(
             trip_id=trip_id,
+            stop_id=self.from_stop,
             force_refetch=force_refetch,
         )
 
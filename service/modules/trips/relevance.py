@@ -0,0 +1,65 @@
+import re
+import threading
+from typing import Callable
+
+from grand_lyon_data.sytral.row_filter import RowFilter
+from modules.trips.leg import SingleLeg
+
+
+class LegRelevance:
+    """
+    Row filters keeping the TCL caches down to what tracked legs can ask for:
+    - next passages at the legs' stops, of any trip: delay lookups match trips on
+      course ids containing them, not on exact GTFS trip ids
+    - incidents of the legs' lines
+
+    legs is called on every refresh, filters follow the tracked legs as they change.
+    They are only recomputed when the legs do.
+    """
+
+    def __init__(self, legs: Callable[[], list[SingleLeg]]):
+        self.legs = legs
+        self._lock = threading.Lock()
+        self._key: tuple | None = None
+        self._filters: dict[str, RowFilter] = {}
+
+    def next_passages(self) -> RowFilter:
+        return self._get("next_passages")
+
+    def incidents(self) -> RowFilter:
+        return self._get("incidents")
+
+    def _get(self, name: str) -> RowFilter:
+        legs = self.legs()
+        key = tuple(
+            (leg.from_stop, leg.to_stop, leg.line_short_name) for leg in legs
+        )
+
+        with self._lock:
+            if key != self._key:
+                self._filters = LegRelevance.build(legs)
+                self._key = key
+                print(f"TCL caches now filtered for {len(legs)} legs")
+
+            return self._filters[name]
+
+    @classmethod
+    def build(cls, legs: list[SingleLeg]) -> dict[str, RowFilter]:
+        stops = {
+            str(stop) for leg in legs for stop in [leg.from_stop, leg.to_stop]
+        }
+
+        # Incident lookups are regex searches on the line, "C8" also matches "C8A"
+        lines = sorted({leg.line_short_name for leg in legs})
+        line_pattern = (
+            re.compile("|".join(re.escape(line) for line in lines))
+            if lines
+            else re.compile(r"(?!)")
+        )
+
+        return {
+            "next_passages": RowFilter(
+                values={"id": frozenset(stops)}, server_field="id"
+            ),
+            "incidents": RowFilter(patterns={"ligne_com": line_pattern}),
+        }
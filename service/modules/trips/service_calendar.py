@@ -0,0 +1,116 @@
+from datetime import date, datetime
+
+import numpy as np
+import pandas as pd
+
+WEEKDAYS = [
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+]
+
+
+def parse_gtfs_dates(dates: pd.Series) -> pd.Series:
+    return pd.to_datetime(dates.astype(str), format="%Y%m%d").dt.date
+
+
+class ServiceCalendar:
+    """
+    Which services run on which day, precomputed from calendar and calendar_dates.
+
+    One row of bits per service_id over every day the feed covers:
+    "which services run on date D" is a column of the bitmap instead of re-evaluating
+    weekday flags, date ranges and exceptions for every query.
+    """
+
+    def __init__(
+        self,
+        calendar: pd.DataFrame | None,
+        calendar_dates: pd.DataFrame | None,
+    ):
+        calendar = (
+            calendar
+            if calendar is not None
+            else pd.DataFrame(
+                columns=["service_id", "start_date", "end_date", *WEEKDAYS]
+            )
+        )
+        calendar_dates = (
+            calendar_dates
+            if calendar_dates is not None
+            else pd.DataFrame(columns=["service_id", "date", "exception_type"])
+        )
+
+        self.service_ids = pd.Index(
+            [
+                *calendar["service_id"].astype(str),
+                *calendar_dates["service_id"].astype(str),
+            ]
+        ).unique()
+
+        start_dates = parse_gtfs_dates(calendar["start_date"])
+        end_dates = parse_gtfs_dates(calendar["end_date"])
+        exception_dates = parse_gtfs_dates(calendar_dates["date"])
+
+        all_dates = [*start_dates, *end_dates, *exception_dates]
+        self.first_date: date | None = min(all_dates) if all_dates else None
+        days = (max(all_dates) - self.first_date).days + 1 if all_dates else 0
+
+        # service code -> day offset from first_date -> runs
+        self.bitmap = np.zeros((len(self.service_ids), days), dtype=bool)
+        if not days:
+            return
+
+        weekdays = (self.first_date.weekday() + np.arange(days)) % 7
+        service_codes = self.service_ids.get_indexer(
+            calendar["service_id"].astype(str)
+        )
+        flags = calendar[WEEKDAYS].astype(int).to_numpy(dtype=bool)
+        for code, start, end, runs_on in zip(
+            service_codes, start_dates, end_dates, flags
+        ):
+            first = (start - self.first_date).days
+            last = (end - self.first_date).days + 1
+            self.bitmap[code, first:last] |= runs_on[weekdays[first:last]]
+
+        # exception_type 1 adds the date, 2 removes it
+        exception_codes = self.service_ids.get_indexer(
+            calendar_dates["service_id"].astype(str)
+        )
+        exception_days = np.array(
+            [(d - self.first_date).days for d in exception_dates], dtype=int
+        )
+        exception_types = calendar_dates["exception_type"].astype(int)
+        added = (exception_types == 1).to_numpy()
+        removed = (exception_types == 2).to_numpy()
+        self.bitmap[exception_codes[added], exception_days[added]] = True
+        self.bitmap[exception_codes[removed], exception_days[removed]] = False
+
+    def active_services(self, service_date: date | datetime) -> np.ndarray:
+        """
+        Mask over service_ids of the services running on service_date.
+        """
+        if isinstance(service_date, datetime):
+            service_date = service_date.date()
+
+        if self.first_date is None:
+            return np.zeros(len(self.service_ids), dtype=bool)
+
+        day = (service_date - self.first_date).days
+        if day < 0 or day >= self.bitmap.shape[1]:
+            return np.zeros(len(self.service_ids), dtype=bool)
+
+        return self.bitmap[:, day]
+
+    def service_codes(self, service_ids: pd.Series) -> np.ndarray:
+        """
+        Code of each of service_ids, -1 for services the calendar doesn't know: they never run.
+        """
+        return self.service_ids.get_indexer(service_ids.astype(str))
+
+    def memory_usage(self) -> int:
+        return self.bitmap.nbytes
@@ -0,0 +1,146 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from datetime import date
+from typing import Callable
+
+import numpy as np
+
+from modules.trips.stop_index import ServiceDayIndex, StopTimesIndex
+from worker_pool.worker_pool import WorkerPool
+
+
+@dataclass
+class ServiceDay:
+    service_date: date
+    index: ServiceDayIndex
+    memory_bytes: int
+    # Time spent restricting the feed-wide index to the day
+    build_seconds: float = 0
+
+    @classmethod
+    def build(
+        cls,
+        service_date: date,
+        stop_times_index: StopTimesIndex,
+        active_trips: np.ndarray,
+    ):
+        started_at = time.perf_counter()
+        index = ServiceDayIndex(service_date, stop_times_index, active_trips)
+
+        return ServiceDay(
+            service_date=service_date,
+            index=index,
+            memory_bytes=index.memory_usage(),
+            build_seconds=time.perf_counter() - started_at,
+        )
+
+
+class ServiceDayCache:
+    """
+    Date-keyed LRU cache of service days, bounded by memory rather than by number of entries.
+
+    Building a service day (restricting the feed-wide stop times index to the trips running that day)
+    is the most expensive thing we do at request time, `prefetch` allows doing it in the background ahead of time.
+    The most recently used day is never evicted, even if it alone exceeds max_bytes.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[date], ServiceDay],
+        *,
+        max_bytes: int,
+    ):
+        self.loader = loader
+        self.max_bytes = max_bytes
+
+        self._entries: OrderedDict[date, ServiceDay] = OrderedDict()
+        # Days currently being built, concurrent callers wait on the event instead of building it twice
+        self._building: dict[date, threading.Event] = {}
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, service_date: date) -> ServiceDay:
+        while True:
+            with self._lock:
+                entry = self._entries.get(service_date)
+                if entry is not None:
+                    self._entries.move_to_end(service_date)
+                    self.hits += 1
+                    return entry
+
+                building = self._building.get(service_date)
+                if building is None:
+                    self.misses += 1
+                    building = threading.Event()
+                    self._building[service_date] = building
+                    break
+
+            # Somebody else (usually a prefetch) is building it, wait and retry the lookup
+            building.wait()
+
+        try:
+            entry = self.loader(service_date)
+            self._insert(entry)
+        finally:
+            with self._lock:
+                del self._building[service_date]
+            building.set()
+
+        return entry
+
+    def peek(self) -> ServiceDay | None:
+        """
+        Most recently used service day without touching the LRU order or the counters.
+        """
+        with self._lock:
+            if not self._entries:
+                return None
+            return next(reversed(self._entries.values()))
+
+    def prefetch(self, service_date: date) -> Future | None:
+        """
+        Build service_date in the worker pool unless it is already cached or being built.
+        """
+        with self._lock:
+            if service_date in self._entries or service_date in self._building:
+                return None
+
+        return WorkerPool.get_instance().submit(self.get, service_date)
+
+    def memory_usage(self) -> int:
+        with self._lock:
+            return sum(entry.memory_bytes for entry in self._entries.values())
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": [d.isoformat() for d in self._entries],
+                "memory_bytes": sum(
+                    entry.memory_bytes for entry in self._entries.values()
+                ),
+                "max_bytes": self.max_bytes,
+                "build_seconds": {
+                    d.isoformat(): entry.build_seconds
+                    for d, entry in self._entries.items()
+                },
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def _insert(self, entry: ServiceDay):
+        with self._lock:
+            self._entries[entry.service_date] = entry
+            self._entries.move_to_end(entry.service_date)
+
+            total = sum(e.memory_bytes for e in self._entries.values())
+            while total > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                total -= evicted.memory_bytes
+                self.evictions += 1
@@ -0,0 +1,327 @@
+import os
+from datetime import date
+
+import gtfs_kit as gk
+import numpy as np
+import pandas as pd
+
+# Stands for a stop time the feed leaves empty, times are never negative
+NO_TIME = -1
+
+
+def gtfs_times_to_seconds(times: pd.Series) -> np.ndarray:
+    """
+    Vectorised version of `Gtfs.parse_gtfs_time`.
+    Convert "HH:MM:SS" strings (hours can exceed 24) to seconds since the start of the service day.
+    """
+    parts = times.str.split(":", expand=True)
+    seconds = parts[0].astype("int32") * 3600 + parts[1].astype("int32") * 60
+    if parts.shape[1] > 2:
+        seconds += parts[2].fillna(0).astype("int32")
+
+    return seconds.to_numpy(dtype=np.int32)
+
+
+def group_offsets(sorted_codes: np.ndarray, size: int) -> np.ndarray:
+    """
+    Offsets of each code's rows in sorted_codes: rows of code c are [offsets[c], offsets[c + 1]).
+    """
+    return np.searchsorted(sorted_codes, np.arange(size + 1)).astype(np.int64)
+
+
+class StopTimesIndex:
+    """
+    Feed-wide index of stop times, every trip of every day, built once per feed.
+
+    Rows are kept in flat arrays sorted by stop then time (and by trip then stop_sequence),
+    with per-stop and per-trip offsets. Ids are replaced by integer codes:
+    trip codes are positions in trip_ids, so that a day's active trips are a boolean mask over them.
+
+    Being plain arrays, it can be saved next to a GTFS snapshot and memory-mapped back (see `save` and `load`).
+    """
+
+    columns = ["departure_time", "arrival_time"]
+    trip_arrays = ["offsets", "stop_codes", "arrivals", "departures"]
+    stop_arrays = ["offsets", "seconds", "trip_codes"]
+
+    def __init__(
+        self,
+        *,
+        trip_ids: pd.Index,
+        stop_ids: pd.Index,
+        row_trip_codes: np.ndarray,
+        by_stop: dict[str, tuple[np.ndarray, np.ndarray, np.ndarray]],
+        by_trip: tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+    ):
+        self.trip_ids = trip_ids
+        # Same, as a plain array: indexing a pd.Index costs more than the whole lookup
+        self.trip_id_values = trip_ids.to_numpy(dtype=object)
+        self.stop_ids = stop_ids
+        # Trip code of every row of stop_times, -1 for trips missing from the trips table
+        self.row_trip_codes = row_trip_codes
+        # column -> (per-stop offsets, times, trip codes)
+        self._by_stop = by_stop
+        # (per-trip offsets, stop codes, arrivals, departures), NO_TIME where the feed gives no time
+        self._by_trip = by_trip
+
+        self._trip_codes = {
+            trip_id: code for code, trip_id in enumerate(trip_ids)
+        }
+        self._stop_codes = {
+            stop_id: code for code, stop_id in enumerate(stop_ids)
+        }
+
+    @classmethod
+    def build(
+        cls, stop_times: pd.DataFrame, trip_ids: pd.Index
+    ) -> "StopTimesIndex":
+        """
+        stop_times must be compact (see `compact_feed`).
+        """
+        stops = pd.Categorical(stop_times["stop_id"])
+        stop_ids = pd.Index(stops.categories.astype(str))
+        row_trip_codes = pd.Categorical(
+            stop_times["trip_id"], categories=trip_ids
+        ).codes.astype(np.int32)
+        stop_codes = stops.codes.astype(np.int32)
+        known = row_trip_codes >= 0
+
+        by_stop = {}
+        for column in StopTimesIndex.columns:
+            seconds = stop_times[column].to_numpy(dtype=np.int32)
+            rows = np.flatnonzero(known & (seconds != NO_TIME))
+            rows = rows[np.lexsort((seconds[rows], stop_codes[rows]))]
+
+            by_stop[column] = (
+                group_offsets(stop_codes[rows], len(stop_ids)),
+                seconds[rows],
+                row_trip_codes[rows],
+            )
+
+        rows = np.flatnonzero(known)
+        rows = rows[
+            np.lexsort(
+                (
+                    stop_times["stop_sequence"].to_numpy()[rows],
+                    row_trip_codes[rows],
+                )
+            )
+        ]
+        by_trip = (
+            group_offsets(row_trip_codes[rows], len(trip_ids)),
+            stop_codes[rows],
+            stop_times["arrival_time"].to_numpy(dtype=np.int32)[rows],
+            stop_times["departure_time"].to_numpy(dtype=np.int32)[rows],
+        )
+
+        return StopTimesIndex(
+            trip_ids=trip_ids,
+            stop_ids=stop_ids,
+            row_trip_codes=row_trip_codes,
+            by_stop=by_stop,
+            by_trip=by_trip,
+        )
+
+    @classmethod
+    def from_feed(cls, feed: gk.Feed) -> "StopTimesIndex":
+        """
+        Index feed's stop times, with trip codes following the order of its trips table.
+        """
+        return StopTimesIndex.build(
+            feed.stop_times,
+            pd.Index(feed.trips["trip_id"].astype(str).unique()),
+        )
+
+    def save(self, directory: str, prefix: str = "index"):
+        def path(name: str):
+            return os.path.join(directory, f"{prefix}.{name}.npy")
+
+        np.save(path("trip_ids"), np.array(self.trip_ids, dtype=str))
+        np.save(path("stop_ids"), np.array(self.stop_ids, dtype=str))
+        np.save(path("row_trip_codes"), self.row_trip_codes)
+        for column, arrays in self._by_stop.items():
+            for name, array in zip(StopTimesIndex.stop_arrays, arrays):
+                np.save(path(f"{column}.{name}"), array)
+        for name, array in zip(StopTimesIndex.trip_arrays, self._by_trip):
+            np.save(path(f"trip.{name}"), array)
+
+    @classmethod
+    def load(cls, directory: str, prefix: str = "index") -> "StopTimesIndex":
+        """
+        Memory-map an index written by `save`: processes loading the same one share its pages.
+        """
+
+        def load(name: str, **kwargs):
+            return np.load(
+                os.path.join(directory, f"{prefix}.{name}.npy"), **kwargs
+            )
+
+        return StopTimesIndex(
+            trip_ids=pd.Index(load("trip_ids").astype(object)),
+            stop_ids=pd.Index(load("stop_ids").astype(object)),
+            row_trip_codes=load("row_trip_codes", mmap_mode="r"),
+            by_stop={
+                column: tuple(
+                    load(f"{column}.{name}", mmap_mode="r")
+                    for name in StopTimesIndex.stop_arrays
+                )
+                for column in StopTimesIndex.columns
+            },
+            by_trip=tuple(
+                load(f"trip.{name}", mmap_mode="r")
+                for name in StopTimesIndex.trip_arrays
+            ),
+        )
+
+    def stop_code(self, stop_id: str) -> int | None:
+        return self._stop_codes.get(stop_id)
+
+    def trip_code(self, trip_id: str) -> int | None:
+        return self._trip_codes.get(trip_id)
+
+    def trip_stop_sequences(self) -> tuple[np.ndarray, np.ndarray]:
+        """
+        (per-trip offsets, stop codes): the stops of each trip, in stop_sequence order.
+        """
+        offsets, stop_codes, _, _ = self._by_trip
+
+        return offsets, stop_codes
+
+    def trip_times_at_stop(
+        self, trip_code: int, stop_code: int, *, column: str
+    ) -> list[int]:
+        offsets, stop_codes, arrivals, departures = self._by_trip
+        start, end = offsets[trip_code], offsets[trip_code + 1]
+        seconds = (departures if column == "departure_time" else arrivals)[
+            start:end
+        ]
+        matches = seconds[
+            (stop_codes[start:end] == stop_code) & (seconds != NO_TIME)
+        ]
+
+        return sorted(matches.tolist())
+
+    def day_view(
+        self, column: str, active_trips: np.ndarray
+    ) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        (per-stop offsets, times, trip codes) of column restricted to active_trips, a mask over trip codes.
+        Filtering keeps each stop's times sorted.
+        """
+        offsets, seconds, trip_codes = self._by_stop[column]
+        keep = active_trips[trip_codes]
+        kept_before = np.concatenate(([0], np.cumsum(keep)))
+
+        return kept_before[offsets], seconds[keep], trip_codes[keep]
+
+    def day_view_bytes(self) -> int:
+        """
+        Memory used by the views (see `day_view`) of a day every trip runs, an upper bound of any day's.
+        """
+        by_stop = sum(
+            array.nbytes
+            for arrays in self._by_stop.values()
+            for array in arrays
+        )
+
+        # Plus the mask of active trips
+        return by_stop + len(self.trip_ids)
+
+    def memory_usage(self) -> int:
+        arrays = [self.row_trip_codes, *self._by_trip]
+        for by_stop in self._by_stop.values():
+            arrays.extend(by_stop)
+
+        return sum(array.nbytes for array in arrays)
+
+
+class ServiceDayIndex:
+    """
+    Per-stop departure and arrival index of a single service day.
+
+    A view of the feed-wide `StopTimesIndex` restricted to the trips running that day:
+    for each stop, times are time-sorted int32 seconds since midnight alongside the matching trip codes,
+    so that "next N passages after t" is a `searchsorted` and a slice.
+    """
+
+    def __init__(
+        self,
+        service_date: date,
+        stop_times_index: StopTimesIndex,
+        active_trips: np.ndarray,
+    ):
+        self.service_date = service_date
+        self.stop_times_index = stop_times_index
+        self.active_trips = active_trips
+
+        # column -> (per-stop offsets, sorted times, trip codes)
+        self._by_stop = {
+            column: stop_times_index.day_view(column, active_trips)
+            for column in StopTimesIndex.columns
+        }
+
+        # First departure and last arrival of the day, None when nothing runs
+        departures = self._by_stop["departure_time"][1]
+        arrivals = self._by_stop["arrival_time"][1]
+        self.first_seconds = int(departures.min()) if len(departures) else None
+        self.last_seconds = int(arrivals.max()) if len(arrivals) else None
+
+    def next_at_stop(
+        self,
+        stop_id: str,
+        *,
+        column: str,
+        after_seconds: int,
+        count: int = -1,
+        trip_mask: np.ndarray | None = None,
+    ) -> list[tuple[str, int]]:
+        """
+        Returns the count first (trip_id, seconds) at stop_id strictly after after_seconds.
+        trip_mask, a mask over trip codes, restricts them to some trips.
+        """
+        stop_code = self.stop_times_index.stop_code(stop_id)
+        if stop_code is None:
+            return []
+
+        offsets, seconds, trip_codes = self._by_stop[column]
+        first, last = offsets[stop_code], offsets[stop_code + 1]
+        start = first + int(
+            np.searchsorted(seconds[first:last], after_seconds, side="right")
+        )
+        if trip_mask is None:
+            end = last if count < 0 else min(last, start + count)
+            rows = np.arange(start, end)
+        else:
+            rows = start + np.flatnonzero(trip_mask[trip_codes[start:last]])
+            rows = rows if count < 0 else rows[:count]
+
+        return list(
+            zip(
+                self.stop_times_index.trip_id_values[trip_codes[rows]].tolist(),
+                seconds[rows].tolist(),
+            )
+        )
+
+    def trip_times_at_stop(
+        self, trip_id: str, stop_id: str, *, column: str
+    ) -> list[int]:
+        """
+        Returns the sorted times of trip_id at stop_id, a trip can serve the same stop twice.
+        """
+        trip_code = self.stop_times_index.trip_code(trip_id)
+        stop_code = self.stop_times_index.stop_code(stop_id)
+        if trip_code is None or stop_code is None:
+            return []
+        if not self.active_trips[trip_code]:
+            return []
+
+        return self.stop_times_index.trip_times_at_stop(
+            trip_code, stop_code, column=column
+        )
+
+    def memory_usage(self) -> int:
+        total = self.active_trips.nbytes
+        for arrays in self._by_stop.values():
+            total += sum(array.nbytes for array in arrays)
+
+        return total
@@ -0,0 +1,252 @@
+import threading
+import time
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+from modules.trips.stop_index import StopTimesIndex
+
+
+@dataclass(frozen=True, eq=True, slots=True)
+class StopLine:
+    """
+    A line serving a stop, in one direction.
+    """
+
+    route_id: str
+    route_short_name: str
+    route_long_name: str
+    trip_headsign: str
+
+
+def text(values: pd.Series) -> np.ndarray:
+    """
+    values as strings, missing ones (optional GTFS columns) as "".
+    """
+    values = values.astype(object)
+
+    return values.where(values.notna(), "").astype(str).to_numpy()
+
+
+class StopTopology:
+    """
+    Which lines serve which stops, and in what order, built once per feed.
+
+    Trips are grouped into route patterns: trips of the same line and headsign stopping
+    at the same stops in the same order. A feed has a few thousand patterns for a
+    few hundred thousand trips, so questions about stops are answered from patterns:
+    - lines serving a stop
+    - trips going from one stop to another (stop pair), memoized once asked
+
+    Stops served by several lines are fine: every line is kept, rather than the first one found.
+    """
+
+    def __init__(
+        self,
+        *,
+        stop_times_index: StopTimesIndex,
+        stop_names: dict[str, str],
+        pattern_lines: list[StopLine],
+        pattern_stops: list[np.ndarray],
+        pattern_trips: list[np.ndarray],
+    ):
+        self.stop_times_index = stop_times_index
+        self.stop_names = stop_names
+        # Line, stop codes in visiting order, and trip codes of each pattern
+        self.pattern_lines = pattern_lines
+        self.pattern_stops = pattern_stops
+        self.pattern_trips = pattern_trips
+
+        # stop code -> pattern -> (first, last) position of the stop in the pattern
+        self._stop_patterns: dict[int, dict[int, tuple[int, int]]] = {}
+        for pattern, stops in enumerate(pattern_stops):
+            for position, stop_code in enumerate(stops.tolist()):
+                positions = self._stop_patterns.setdefault(stop_code, {})
+                first, _ = positions.get(pattern, (position, position))
+                positions[pattern] = (first, position)
+
+        # (from stop code, to stop code) -> patterns going from one to the other
+        self._between: dict[tuple[int, int], list[int]] = {}
+        # (from stop code, to stop code) -> mask over trip codes, see `trip_mask_between`
+        self._trip_masks: dict[tuple[int, int], np.ndarray] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def build(
+        cls,
+        stop_times_index: StopTimesIndex,
+        *,
+        trips: pd.DataFrame,
+        routes: pd.DataFrame,
+        stops: pd.DataFrame,
+    ) -> "StopTopology":
+        started_at = time.perf_counter()
+
+        trip_lines = (
+            trips.assign(trip_id=trips["trip_id"].astype(str))
+            .set_index("trip_id")
+            .reindex(stop_times_index.trip_ids)
+        )
+        route_ids = text(trip_lines["route_id"])
+        headsigns = text(
+            trip_lines.get(
+                "trip_headsign", pd.Series("", index=trip_lines.index)
+            )
+        )
+        route_names = dict(
+            zip(
+                text(routes["route_id"]),
+                zip(
+                    text(routes.get("route_short_name", routes["route_id"])),
+                    text(routes.get("route_long_name", routes["route_id"])),
+                ),
+            )
+        )
+
+        offsets, stop_codes = stop_times_index.trip_stop_sequences()
+        patterns: dict[tuple, int] = {}
+        pattern_lines: list[StopLine] = []
+        pattern_stops: list[np.ndarray] = []
+        pattern_trips: list[list[int]] = []
+        for trip_code in range(len(stop_times_index.trip_ids)):
+            start, end = offsets[trip_code], offsets[trip_code + 1]
+            if start == end:
+                continue
+
+            key = (
+                route_ids[trip_code],
+                headsigns[trip_code],
+                stop_codes[start:end].tobytes(),
+            )
+            pattern = patterns.get(key)
+            if pattern is None:
+                pattern = patterns[key] = len(pattern_lines)
+                short_name, long_name = route_names.get(key[0], ("", ""))
+                pattern_lines.append(
+                    StopLine(
+                        route_id=key[0],
+                        route_short_name=short_name,
+                        route_long_name=long_name,
+                        trip_headsign=key[1],
+                    )
+                )
+                pattern_stops.append(np.array(stop_codes[start:end]))
+                pattern_trips.append([])
+            pattern_trips[pattern].append(trip_code)
+
+        topology = StopTopology(
+            stop_times_index=stop_times_index,
+            stop_names=dict(
+                zip(
+                    stops["stop_id"].astype(str), stops["stop_name"].astype(str)
+                )
+            ),
+            pattern_lines=pattern_lines,
+            pattern_stops=pattern_stops,
+            pattern_trips=[
+                np.array(codes, dtype=np.int32) for codes in pattern_trips
+            ],
+        )
+        print(
+            f"Built stop topology in {time.perf_counter() - started_at:.1f}s: "
+            f"{len(pattern_lines)} route patterns"
+        )
+
+        return topology
+
+    def stop_name(self, stop_id: int | str) -> str | None:
+        return self.stop_names.get(str(stop_id))
+
+    def lines_at_stop(self, stop_id: int | str) -> list[StopLine]:
+        """
+        Every line serving stop_id, the busiest first.
+        """
+        stop_code = self.stop_times_index.stop_code(str(stop_id))
+        if stop_code is None:
+            return []
+
+        return self._lines(list(self._stop_patterns.get(stop_code, {})))
+
+    def lines_between(
+        self, from_stop_id: int | str, to_stop_id: int | str
+    ) -> list[StopLine]:
+        """
+        Lines with trips stopping at from_stop_id then at to_stop_id, the busiest first.
+        """
+        return self._lines(self._patterns_between(from_stop_id, to_stop_id))
+
+    def trips_between(
+        self, from_stop_id: int | str, to_stop_id: int | str
+    ) -> np.ndarray:
+        """
+        Codes of the trips stopping at from_stop_id then at to_stop_id, whatever the day.
+        """
+        patterns = self._patterns_between(from_stop_id, to_stop_id)
+        if not patterns:
+            return np.array([], dtype=np.int32)
+
+        return np.concatenate([self.pattern_trips[p] for p in patterns])
+
+    def trip_mask_between(
+        self, from_stop_id: int | str, to_stop_id: int | str
+    ) -> np.ndarray:
+        """
+        `trips_between` as a mask over trip codes, memoized.
+        """
+        key = self._stop_pair(from_stop_id, to_stop_id)
+        mask = self._trip_masks.get(key)
+        if mask is None:
+            mask = np.zeros(len(self.stop_times_index.trip_ids), dtype=bool)
+            mask[self.trips_between(from_stop_id, to_stop_id)] = True
+            with self._lock:
+                self._trip_masks[key] = mask
+
+        return mask
+
+    def memory_usage(self) -> int:
+        return sum(
+            stops.nbytes + trips.nbytes
+            for stops, trips in zip(self.pattern_stops, self.pattern_trips)
+        ) + sum(mask.nbytes for mask in self._trip_masks.values())
+
+    def _stop_pair(
+        self, from_stop_id: int | str, to_stop_id: int | str
+    ) -> tuple[int, int]:
+        index = self.stop_times_index
+
+        return (
+            index.stop_code(str(from_stop_id)),
+            index.stop_code(str(to_stop_id)),
+        )
+
+    def _patterns_between(
+        self, from_stop_id: int | str, to_stop_id: int | str
+    ) -> list[int]:
+        key = self._stop_pair(from_stop_id, to_stop_id)
+        patterns = self._between.get(key)
+        if patterns is not None:
+            return patterns
+
+        from_code, to_code = key
+        from_patterns = self._stop_patterns.get(from_code, {})
+        to_patterns = self._stop_patterns.get(to_code, {})
+        patterns = [
+            pattern
+            for pattern, (first, _) in from_patterns.items()
+            if pattern in to_patterns and first < to_patterns[pattern][1]
+        ]
+        with self._lock:
+            self._between[key] = patterns
+
+        return patterns
+
+    def _lines(self, patterns: list[int]) -> list[StopLine]:
+        trip_counts: dict[StopLine, int] = {}
+        for pattern in patterns:
+            line = self.pattern_lines[pattern]
+            trip_counts[line] = trip_counts.get(line, 0) + len(
+                self.pattern_trips[pattern]
+            )
+
+        return sorted(trip_counts, key=lambda line: -trip_counts[line])
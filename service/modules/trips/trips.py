@@ -1,11 +1,40 @@
+import asyncio
 import os
 import csv
 from datetime import datetime, timezone
+from instrumentation.metrics import Metrics
+from modules.trips.conditional import (
+    conditional_response,
+    matching_etag,
+    seconds_until,
+    version_etag,
+)
+from modules.trips.encoded import EncodedBody, EncodedBodyCache
+from modules.trips.estimates import (
+    EstimateMaterializer,
+    SharedLookups,
+    VersionedEstimates,
+    versioned_estimates,
+)
+from modules.trips.estimate_stream import EstimateBroadcaster
+from modules.trips.gtfs import Gtfs
+from modules.trips.gtfs_registry import GtfsRegistry
 from modules.trips.leg import SingleLeg
-from fastapi import APIRouter
+from fastapi import APIRouter, Query, Request
+from fastapi.responses import StreamingResponse
+from worker_pool.worker_pool import WorkerPool
 
 trips_router = APIRouter()
 
+# Batch bodies are pasted together from each leg's encoded snapshot, once per ETag
+batch_bodies = EncodedBodyCache()
+
+estimate_lookups = Metrics.get_instance().counter(
+    "estimate_lookups_total",
+    "Leg estimates served, from the materialized snapshot or computed live",
+    ("source",),
+)
+
 
 class Trips:
     _instance: "Trips | None" = None
@@ -14,36 +43,74 @@ class Trips:
         if Trips._instance is not None:
             raise RuntimeError("Trips singleton is already initialised")
 
-        legs_file = os.getenv("LEGS_FILE", file_path)
+        self.legs_file = os.getenv("LEGS_FILE", file_path)
+        # Loaded once and shared by every leg
+        self.gtfs = GtfsRegistry.get()
+        self.tracked_legs = Trips.load_legs(self.legs_file, self.gtfs)
+        # Incremented by every swap, versions the legs
+        self.generation = 0
+
+        Trips._instance = self
+
+    @classmethod
+    def get_instance(cls):
+        if cls._instance is None:
+            raise RuntimeError("Trips singleton is not initialised")
 
+        return cls._instance
+
+    @classmethod
+    def load_legs(cls, legs_file: str, gtfs: Gtfs) -> list[SingleLeg]:
+        """
+        Raises ValueError if a leg doesn't make sense in gtfs, see `SingleLeg`.
+        """
         # CSV format must be as follows:
         #     id,from_stop_id,to_stop_id
         #     1,2,3
         with open(legs_file, "r") as file:
             csv_reader = csv.DictReader(file)
-            self.tracked_legs = [
+            return [
                 SingleLeg(
                     id=int(row["id"]),
                     from_stop=int(row["from_stop_id"]),
                     to_stop=int(row["to_stop_id"]),
+                    gtfs=gtfs,
                 )
                 for row in csv_reader
             ]
-        Trips._instance = self
 
-    @classmethod
-    def get_instance(cls):
-        if cls._instance is None:
-            raise RuntimeError("Trips singleton is not initialised")
+    def swap(self, gtfs: Gtfs, legs: list[SingleLeg]):
+        """
+        Start serving legs, built against gtfs, in place of the current ones.
+
+        Each leg holds its own feed: a request that already picked up a leg
+        keeps a consistent leg and feed pair, whichever side of the swap it is on.
+        """
+        self.gtfs = gtfs
+        self.tracked_legs = legs
+        self.generation += 1
+
+    def legs_etag(self) -> str:
+        return version_etag(self.gtfs.content_hash, self.generation)
 
-        return cls._instance
+
+def head_departure_seconds(snapshot: dict) -> int | None:
+    """
+    Seconds until the snapshot's head departure leaves, and with it the snapshot goes stale.
+    """
+    estimates = snapshot["estimates"]
+    return seconds_until(estimates[0]["departure_time"]) if estimates else None
 
 
 @trips_router.get("/")
-async def list_legs():
-    return {
-        "legs": [leg.to_dict() for leg in Trips.get_instance().tracked_legs]
-    }
+async def list_legs(request: Request):
+    instance = Trips.get_instance()
+
+    return conditional_response(
+        request,
+        {"legs": [leg.to_dict() for leg in instance.tracked_legs]},
+        etag=instance.legs_etag(),
+    )
 
 
 @trips_router.post("/force_refresh")
@@ -53,71 +120,181 @@ async def force_refresh():
         raise RuntimeError("No legs currently tracked...")
 
     line = instance.tracked_legs[0]
-    line.delay_api.refresh_cache()
-    line.incident_api.refresh_cache()
+    pool = WorkerPool.get_instance()
+    # A refresh takes a few upstream round trips, well past the default deadline
+    await pool.run(line.delay_api.refresh_cache, deadline_seconds=120)
+    await pool.run(line.incident_api.refresh_cache, deadline_seconds=120)
 
     return {"updated_at": line.delay_api.cache_refreshed_at}
 
 
-@trips_router.get("/{leg_id}")
-async def get_legs(leg_id: int):
-    return next(
-        (
-            leg.to_dict()
-            for leg in Trips.get_instance().tracked_legs
-            if leg.id == leg_id
+@trips_router.get("/next")
+async def get_next_batch(
+    request: Request, ids: list[int] | None = Query(default=None)
+):
+    """
+    `/{leg_id}/next` for every tracked leg, or for the legs listed as `?ids=1&ids=2`, in one call.
+    Legs that can't be computed are returned with an error and no estimates.
+    """
+    materializer = EstimateMaterializer.get_instance()
+    legs = [
+        leg
+        for leg in Trips.get_instance().tracked_legs
+        if ids is None or leg.id in ids
+    ]
+
+    versioned = {
+        leg.id: materializer.get_versioned(leg.id) if materializer else None
+        for leg in legs
+    }
+    missing = [leg for leg in legs if versioned[leg.id] is None]
+    estimate_lookups.inc("materialized", amount=len(legs) - len(missing))
+    estimate_lookups.inc("computed", amount=len(missing))
+    if missing:
+        versioned.update(
+            await WorkerPool.get_instance().run(compute_estimates, missing)
+        )
+
+    etags = [versioned[leg.id].etag for leg in legs]
+    # Errors are not cached
+    etag = version_etag(*etags) if None not in etags else None
+    stale_in = [
+        head_departure_seconds(versioned[leg.id].snapshot) for leg in legs
+    ]
+
+    def build() -> EncodedBody:
+        return EncodedBody.join(
+            [versioned[leg.id].encoded for leg in legs],
+            prefix=b'{"legs":[',
+            suffix=b"]}",
+        )
+
+    return conditional_response(
+        request,
+        batch_bodies.get(etag, build) if etag else build(),
+        etag=etag,
+        micro_cache_seconds=min(
+            (seconds for seconds in stale_in if seconds is not None),
+            default=None,
         ),
-        None,
     )
 
 
-@trips_router.get("/{leg_id}/next")
-async def get_next(leg_id: int):
-    leg = next(
-        (leg for leg in Trips.get_instance().tracked_legs if leg.id == leg_id),
-        None,
+def compute_estimates(
+    legs: list[SingleLeg],
+) -> dict[int, VersionedEstimates]:
+    """
+    `versioned_estimates` of legs by leg id, with an error entry and no ETag for those that fail.
+    """
+    shared = SharedLookups()
+    results = {}
+    for leg in legs:
+        try:
+            results[leg.id] = versioned_estimates(leg, shared)
+        except Exception as error:
+            results[leg.id] = VersionedEstimates.of(
+                None,
+                {
+                    "leg": leg.to_dict(),
+                    "estimates": [],
+                    "incidents": [],
+                    "sot_updated_at": leg.delay_api.cache_refreshed_at,
+                    "error": repr(error),
+                },
+            )
+
+    return results
+
+
+@trips_router.get("/stream")
+async def stream(request: Request, ids: list[int] | None = Query(default=None)):
+    """
+    Server-sent events of the legs listed as `?ids=1&ids=2`, every tracked leg by default.
+
+    The first event holds the current `/{leg_id}/next` of every leg, the next ones only
+    the legs whose estimates, delays or incidents changed, and the ids of legs no longer tracked:
+    `{"legs": [...], "removed": [...]}`.
+    """
+    broadcaster = EstimateBroadcaster.get_instance()
+    subscription = broadcaster.subscribe(
+        asyncio.get_running_loop(), set(ids) if ids else None
     )
 
-    if leg is None:
-        return None
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                event = await subscription.next_event(
+                    EstimateBroadcaster.heartbeat_seconds
+                )
+                yield event if event else ": keep-alive\n\n"
+        finally:
+            broadcaster.unsubscribe(subscription)
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # Proxies must neither cache nor buffer it
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    estimates = []
 
-    incidents = leg.get_incidents()
-    for trip_id, departure_time, arrival_time in leg.get_estimates():
-        delay = leg.get_delays(trip_id)
+@trips_router.get("/{leg_id}")
+async def get_legs(request: Request, leg_id: int):
+    instance = Trips.get_instance()
 
-        delay_seconds = (
-            int(delay.delaipassage.total_seconds()) if delay else None
+    return conditional_response(
+        request,
+        next(
+            (
+                leg.to_dict()
+                for leg in instance.tracked_legs
+                if leg.id == leg_id
+            ),
+            None,
+        ),
+        etag=instance.legs_etag(),
+    )
+
+
+@trips_router.get("/{leg_id}/next")
+async def get_next(request: Request, leg_id: int):
+    """
+    Answered from the materialized snapshot when there is one:
+    a request carrying its ETag gets a 304 without anything being computed.
+    """
+    materializer = EstimateMaterializer.get_instance()
+    versioned = materializer.get_versioned(leg_id) if materializer else None
+
+    if versioned is None:
+        leg = next(
+            (
+                leg
+                for leg in Trips.get_instance().tracked_legs
+                if leg.id == leg_id
+            ),
+            None,
         )
 
-        estimates.append(
-            {
-                "transporter_trip_id": trip_id,
-                "departure_time": departure_time,
-                "arrival_time": arrival_time,
-                "delay": delay_seconds,
-            }
+        if leg is None:
+            return None
+
+        versioned = await WorkerPool.get_instance().run(
+            versioned_estimates, leg
         )
+        estimate_lookups.inc("computed")
+    else:
+        estimate_lookups.inc("materialized")
 
-    return {
-        "leg": leg.to_dict(),
-        "estimates": estimates,
-        "incidents": [
-            {
-                "title": incident.titre,
-                "message": incident.message,
-                "type": incident.typeseverite,
-                "severity": incident.niveauseverite,
-            }
-            for incident in incidents
-        ],
-        "sot_updated_at": leg.delay_api.cache_refreshed_at,
-    }
+    return conditional_response(
+        request,
+        versioned.encoded,
+        etag=versioned.etag,
+        micro_cache_seconds=head_departure_seconds(versioned.snapshot),
+    )
 
 
 @trips_router.get("/{leg_id}/{utc_time_string}/{count}")
-async def get(leg_id: int, utc_time_string: str, count: int):
+async def get(request: Request, leg_id: int, utc_time_string: str, count: int):
     leg = next(
         (leg for leg in Trips.get_instance().tracked_legs if leg.id == leg_id),
         None,
@@ -126,24 +303,42 @@ async def get(leg_id: int, utc_time_string: str, count: int):
     if leg is None:
         return None
 
+    # Passages at a given time only depend on the feed (the rest of the URL is the query),
+    # the TCL cache only for sot_updated_at
+    etag = version_etag(
+        leg.gtfs.content_hash,
+        leg.from_stop,
+        leg.to_stop,
+        leg.delay_api.cache.generation,
+    )
+    if matching_etag(request, etag) is not None:
+        return conditional_response(request, None, etag=etag)
+
     utc_timestamp = datetime.fromtimestamp(
         float(utc_time_string), tz=timezone.utc
     )
 
+    # Arbitrary dates can need a service day that is not cached yet
+    next_passages = await WorkerPool.get_instance().run(
+        leg.get_estimates,
+        utc_timestamp=utc_timestamp,
+        count=count,
+    )
     estimates = [
         {
             "transporter_trip_id": trip_id,
             "departure_time": departure_time,
             "arrival_time": arrival_time,
         }
-        for trip_id, departure_time, arrival_time in leg.get_estimates(
-            utc_timestamp=utc_timestamp,
-            count=count,
-        )
+        for trip_id, departure_time, arrival_time in next_passages
     ]
 
-    return {
-        "leg": leg.to_dict(),
-        "estimates": estimates,
-        "sot_updated_at": leg.delay_api.cache_refreshed_at,
-    }
+    return conditional_response(
+        request,
+        {
+            "leg": leg.to_dict(),
+            "estimates": estimates,
+            "sot_updated_at": leg.delay_api.cache_refreshed_at,
+        },
+        etag=etag,
+    )
@@ -0,0 +1,185 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Coroutine
+
+from apscheduler.executors.pool import BasePoolExecutor
+
+from instrumentation.profiling import Profiler
+
+
+class WorkerPoolSaturated(RuntimeError):
+    pass
+
+
+class WorkerDeadlineExceeded(TimeoutError):
+    pass
+
+
+class WorkerPool:
+    """
+    Process-wide bounded pool running everything that would block the event loop:
+    GTFS queries, TCL cache lookups, upstream refreshes.
+
+    Requests go through `run`, which is admission controlled: at most max_pending of them
+    are queued or running at once, the next ones are rejected right away with `WorkerPoolSaturated`.
+    Each one also gets a deadline, past which the caller gets `WorkerDeadlineExceeded`.
+
+    Background work (scheduler jobs, prefetches, reloads) goes through `submit` and is never rejected.
+    It runs on threads of its own, background_workers of them: however much of it is queued,
+    requests keep all max_workers threads.
+
+    Upstream fetches are I/O bound, they don't hold a thread each: their coroutines all run
+    on the pool's event loop, in one more thread, see `run_coroutine`.
+
+    Threads rather than processes: the GTFS feed is shared in memory, and its numpy work releases the GIL.
+    """
+
+    _instance: "WorkerPool | None" = None
+    _instance_lock = threading.Lock()
+
+    max_workers = int(os.getenv("WORKER_POOL_SIZE", "4"))
+    background_workers = int(os.getenv("WORKER_POOL_BACKGROUND_SIZE", "2"))
+    max_pending = int(os.getenv("WORKER_POOL_MAX_PENDING", "16"))
+    deadline_seconds = float(os.getenv("WORKER_POOL_DEADLINE_SECONDS", "10"))
+
+    def __init__(self):
+        if WorkerPool._instance is not None:
+            raise RuntimeError("WorkerPool singleton is already initialised")
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=WorkerPool.max_workers, thread_name_prefix="worker"
+        )
+        self.background = ThreadPoolExecutor(
+            max_workers=WorkerPool.background_workers,
+            thread_name_prefix="background",
+        )
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(
+            target=self.loop.run_forever, name="upstream", daemon=True
+        )
+        self._loop_thread.start()
+        # Requests queued or running
+        self.pending = 0
+        self.rejected = 0
+        self.timed_out = 0
+        # Requests and background jobs done
+        self.completed = 0
+        self._lock = threading.Lock()
+
+        WorkerPool._instance = self
+
+    @classmethod
+    def get_instance(cls) -> "WorkerPool":
+        """
+        Unlike other singletons the pool is created on first use: library code submits to it,
+        whether or not it runs inside the server.
+        """
+        with cls._instance_lock:
+            if cls._instance is None:
+                cls()
+
+        return cls._instance
+
+    def submit(self, fn: Callable, *args, **kwargs) -> Future:
+        future = self.background.submit(fn, *args, **kwargs)
+        future.add_done_callback(self._complete)
+
+        return future
+
+    def run_coroutine(self, coroutine: Coroutine) -> Future:
+        """
+        Run coroutine on the pool's event loop, from any thread.
+        Its result is awaited with the returned future, its task cancelled if the future is.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def run(
+        self,
+        fn: Callable,
+        *args,
+        deadline_seconds: float | None = None,
+        **kwargs,
+    ):
+        """
+        Run fn in the pool and await its result without blocking the event loop.
+
+        Raises `WorkerPoolSaturated` when too many requests are already waiting,
+        `WorkerDeadlineExceeded` when fn takes longer than deadline_seconds (default `deadline_seconds`).
+        Work that already started when its deadline passes is not interrupted, it still holds its slot until it returns.
+        """
+        deadline_seconds = (
+            deadline_seconds
+            if deadline_seconds is not None
+            else WorkerPool.deadline_seconds
+        )
+
+        with self._lock:
+            if self.pending >= WorkerPool.max_pending:
+                self.rejected += 1
+                raise WorkerPoolSaturated(
+                    f"{self.pending} requests already waiting for a worker"
+                )
+            self.pending += 1
+
+        profiler = Profiler.get_instance()
+        if profiler.armed:
+            fn = profiler.wrap(fn)
+
+        future = self.executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(self._release)
+
+        try:
+            # Cancels future on timeout if it has not started yet
+            return await asyncio.wait_for(
+                asyncio.wrap_future(future), deadline_seconds
+            )
+        except asyncio.TimeoutError:
+            with self._lock:
+                self.timed_out += 1
+            raise WorkerDeadlineExceeded(
+                f"No result within {deadline_seconds}s"
+            )
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_workers": WorkerPool.max_workers,
+                "background_workers": WorkerPool.background_workers,
+                "max_pending": WorkerPool.max_pending,
+                "pending": self.pending,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "completed": self.completed,
+            }
+
+    def shutdown(self, wait: bool = True):
+        self.executor.shutdown(wait=wait, cancel_futures=True)
+        self.background.shutdown(wait=wait, cancel_futures=True)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        if wait:
+            self._loop_thread.join()
+
+    def _release(self, future: Future):
+        with self._lock:
+            self.pending -= 1
+        self._complete(future)
+
+    def _complete(self, future: Future):
+        # Cancelled before starting: past their deadline, or on shutdown
+        if future.cancelled():
+            return
+
+        with self._lock:
+            self.completed += 1
+
+
+class WorkerPoolJobExecutor(BasePoolExecutor):
+    """
+    APScheduler executor running jobs in the `WorkerPool`, instead of the scheduler's own threads.
+    Jobs go through `WorkerPool.submit`, and are counted with the rest.
+    """
+
+    def __init__(self, pool: WorkerPool):
+        super().__init__(pool)
@@ -0,0 +1,126 @@
+import json
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+# The service is run from its own directory, its modules import each other from there
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(__file__)), "service")
+)
+
+from grand_lyon_data.sytral.incident_api import GrandLyonIncidentApi  # noqa: E402
+from grand_lyon_data.sytral.next_passage_api import (  # noqa: E402
+    GrandLyonNextPassageApi,
+)
+
+
+def passage_row(**overrides) -> dict:
+    """
+    A row of the TCL next passages dataset, as upstream sends it.
+    """
+    return {
+        "id": "30211",
+        "type": "E",
+        "ligne": "T1",
+        "direction": "IUT Feyssine",
+        "idtarretdestination": "30199",
+        "coursetheorique": "T1-A-2105",
+        "last_update_fme": "2026-10-18T08:00:00",
+        "heurepassage": "2026-10-18T08:12:00",
+        "delaipassage": "2 min",
+        **overrides,
+    }
+
+
+@pytest.fixture
+def next_passage_api():
+    GrandLyonNextPassageApi._instance = None
+    api = GrandLyonNextPassageApi(url_base="http://127.0.0.1:1")
+    yield api
+    GrandLyonNextPassageApi._instance = None
+
+
+@pytest.fixture
+def incident_api():
+    GrandLyonIncidentApi._instance = None
+    api = GrandLyonIncidentApi(url_base="http://127.0.0.1:1")
+    yield api
+    GrandLyonIncidentApi._instance = None
+
+
+class FakeGrandLyon(ThreadingHTTPServer):
+    """
+    Local stand-in for the Grand Lyon API, serving rows page by page like it does.
+    """
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeGrandLyonHandler)
+        self.rows: list[dict] = []
+        # Whether pages say how many rows there are in total
+        self.reports_total = True
+        # Start of the page answered with a 500, if any
+        self.failing_start: int | None = None
+        # Connections accepted, requests are kept alive on them
+        self.connections = 0
+        # Query parameters of every page request
+        self.queries: list[dict[str, list[str]]] = []
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+    @property
+    def url_base(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+
+class FakeGrandLyonHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        start = int(params["start"][0])
+        maxfeatures = int(params["maxfeatures"][0])
+        self.server.queries.append(params)
+
+        if start == self.server.failing_start:
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        rows = self.server.rows
+        if "field" in params:
+            # Server side filter
+            field, value = params["field"][0], params["value"][0]
+            rows = [row for row in rows if str(row.get(field)) == value]
+
+        page = {"values": rows[start - 1 : start - 1 + maxfeatures]}
+        if self.server.reports_total:
+            page = {"nb_results": len(rows), **page}
+        body = json.dumps(page).encode()
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def upstream():
+    server = FakeGrandLyon()
+    thread = threading.Thread(
+        target=server.serve_forever, kwargs={"poll_interval": 0.01}, daemon=True
+    )
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,79 @@
+import gzip
+
+from fastapi import Request
+
+from modules.trips.conditional import conditional_response
+from modules.trips.encoded import EncodedBody
+
+ETAG = '"0123456789abcdef"'
+BIG = {"estimates": ["x" * 2000]}
+
+
+def request(**headers) -> Request:
+    return Request(
+        {
+            "type": "http",
+            "method": "GET",
+            "path": "/trips/next",
+            "headers": [
+                (name.replace("_", "-").encode(), value.encode())
+                for name, value in headers.items()
+            ],
+        }
+    )
+
+
+def test_identity_response_carries_the_etag():
+    response = conditional_response(request(), BIG, etag=ETAG)
+
+    assert response.status_code == 200
+    assert response.headers["etag"] == ETAG
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert "content-encoding" not in response.headers
+
+
+def test_gzip_variant_has_its_own_etag():
+    response = conditional_response(
+        request(accept_encoding="gzip, deflate"), BIG, etag=ETAG
+    )
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.headers["etag"] == '"0123456789abcdef-gzip"'
+    assert gzip.decompress(response.body) == EncodedBody.of(BIG).raw
+
+
+def test_small_bodies_are_not_compressed():
+    response = conditional_response(
+        request(accept_encoding="gzip"), {"estimates": []}, etag=ETAG
+    )
+
+    assert "content-encoding" not in response.headers
+    assert response.headers["etag"] == ETAG
+
+
+def test_not_modified_answers_the_variant_the_client_has():
+    for accept_encoding, etag in [
+        ("", ETAG),
+        ("gzip", ETAG),
+        ("gzip", '"0123456789abcdef-gzip"'),
+    ]:
+        response = conditional_response(
+            request(accept_encoding=accept_encoding, if_none_match=etag),
+            None,
+            etag=ETAG,
+        )
+
+        assert response.status_code == 304
+        assert response.headers["etag"] == etag
+        assert response.headers["vary"] == "Accept-Encoding"
+        assert response.body == b""
+
+
+def test_gzip_etag_without_gzip_gets_the_identity_body():
+    response = conditional_response(
+        request(if_none_match='"0123456789abcdef-gzip"'), BIG, etag=ETAG
+    )
+
+    assert response.status_code == 200
+    assert response.headers["etag"] == ETAG
+    assert response.body == EncodedBody.of(BIG).raw
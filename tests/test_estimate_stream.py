@@ -0,0 +1,64 @@
+import asyncio
+import json
+
+import pytest
+
+from modules.trips.estimate_stream import EstimateBroadcaster
+
+
+@pytest.fixture
+def broadcaster():
+    EstimateBroadcaster._instance = None
+    broadcaster = EstimateBroadcaster()
+    yield broadcaster
+    EstimateBroadcaster._instance = None
+
+
+def snapshot(leg_id: int, delay: int) -> dict:
+    return {"leg": {"id": leg_id}, "estimates": [{"delay": delay}]}
+
+
+def events(broadcaster, publications) -> list[dict]:
+    """
+    Events a subscriber to every leg receives while publications are published.
+    """
+
+    async def follow():
+        subscription = broadcaster.subscribe(asyncio.get_running_loop(), None)
+        received = []
+        for snapshots, leg_ids in publications:
+            broadcaster.publish(snapshots, leg_ids)
+            event = await subscription.next_event(timeout=0.1)
+            if event is not None:
+                received.append(json.loads(event.split("data: ", 1)[1]))
+
+        return received
+
+    return asyncio.run(follow())
+
+
+def test_leg_failing_to_compute_is_not_removed(broadcaster):
+    received = events(
+        broadcaster,
+        [
+            ({1: snapshot(1, 0), 2: snapshot(2, 0)}, {1, 2}),
+            # Leg 2 failed to compute
+            ({1: snapshot(1, 60)}, {1, 2}),
+            ({1: snapshot(1, 60), 2: snapshot(2, 0)}, {1, 2}),
+        ],
+    )
+
+    assert [event["removed"] for event in received] == [[], []]
+    assert received[1]["legs"] == [snapshot(1, 60)]
+
+
+def test_untracked_leg_is_removed(broadcaster):
+    received = events(
+        broadcaster,
+        [
+            ({1: snapshot(1, 0), 2: snapshot(2, 0)}, {1, 2}),
+            ({1: snapshot(1, 0)}, {1}),
+        ],
+    )
+
+    assert received[-1] == {"legs": [], "removed": [2]}
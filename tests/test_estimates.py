@@ -0,0 +1,226 @@
+import threading
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from modules.trips import estimates
+
+from tests.test_leg import TZ
+
+
+def fake_leg():
+    return SimpleNamespace(
+        gtfs=SimpleNamespace(content_hash="feed"),
+        from_stop=1,
+        to_stop=2,
+        delay_api=SimpleNamespace(cache=SimpleNamespace(generation=1)),
+        incident_api=SimpleNamespace(cache=SimpleNamespace(generation=1)),
+    )
+
+
+def computing(snapshots, refreshes):
+    """
+    next_estimates returning snapshots in turn, the delays cache refreshing during the first refreshes calls.
+    """
+    calls = iter(snapshots)
+
+    def next_estimates(leg, shared=None):
+        snapshot = next(calls)
+        if refreshes:
+            refreshes.pop()
+            leg.delay_api.cache.generation += 1
+
+        return snapshot
+
+    return next_estimates
+
+
+def test_refresh_while_computing_computes_again(monkeypatch):
+    leg = fake_leg()
+    monkeypatch.setattr(
+        estimates,
+        "next_estimates",
+        computing([{"estimates": ["old"]}, {"estimates": []}], [True]),
+    )
+
+    versioned = estimates.versioned_estimates(leg)
+
+    assert versioned.snapshot == {"estimates": []}
+    assert versioned.etag == estimates.estimates_etag(
+        ("feed", 1, 2, 2, 1), {"estimates": []}
+    )
+
+
+def test_data_changing_on_every_attempt_is_not_cached(monkeypatch):
+    leg = fake_leg()
+    attempts = estimates.consistent_attempts
+    monkeypatch.setattr(
+        estimates,
+        "next_estimates",
+        computing([{"estimates": []}] * attempts, [True] * attempts),
+    )
+
+    assert estimates.versioned_estimates(leg).etag is None
+
+
+@pytest.fixture
+def materializer(monkeypatch):
+    """
+    Materializer of legs 1 to 3, leg 3 failing to compute, leg 1 departing in 10 minutes.
+    """
+    monkeypatch.setattr(estimates.EstimateMaterializer, "_instance", None)
+    departure = datetime.now(TZ) + timedelta(minutes=10)
+
+    def versioned_estimates(leg, shared):
+        if leg.id == 3:
+            raise RuntimeError("not in the feed")
+        snapshot = {
+            "estimates": [{"departure_time": departure}] if leg.id == 1 else []
+        }
+        return estimates.VersionedEstimates.of(f'"{leg.id}"', snapshot)
+
+    monkeypatch.setattr(estimates, "versioned_estimates", versioned_estimates)
+    legs = [
+        SimpleNamespace(id=leg_id, gtfs=SimpleNamespace(tz=TZ))
+        for leg_id in [1, 2, 3]
+    ]
+    materializer = estimates.EstimateMaterializer(lambda: legs)
+    materializer.departure = departure
+    yield materializer
+    materializer.stop()
+
+
+def test_recompute_materializes_every_leg(materializer):
+    published = []
+    materializer.listeners.append(
+        lambda snapshots, leg_ids: published.append((snapshots, leg_ids))
+    )
+
+    materializer.recompute()
+
+    assert materializer.get_versioned(1).etag == '"1"'
+    assert materializer.get(2) == {"estimates": []}
+    # Computed live by requests instead
+    assert materializer.get(3) is None
+    assert published == [(materializer.snapshots, {1, 2, 3})]
+
+
+def test_next_recompute_is_just_after_the_head_departure(materializer):
+    materializer.recompute()
+
+    assert materializer.next_deadline == materializer.departure + timedelta(
+        seconds=1
+    )
+
+
+def test_without_departures_next_recompute_is_the_day_rollover(
+    materializer, monkeypatch
+):
+    monkeypatch.setattr(
+        estimates,
+        "versioned_estimates",
+        lambda leg, shared: estimates.VersionedEstimates.of(
+            None, {"estimates": []}
+        ),
+    )
+
+    materializer.recompute()
+
+    now = datetime.now(TZ)
+    assert materializer.next_deadline - now <= timedelta(days=1)
+    assert (
+        materializer.next_deadline.hour,
+        materializer.next_deadline.minute,
+    ) in [
+        (0, 0),
+        (4, 0),
+    ]
+
+
+def test_invalidate_recomputes_right_away(materializer):
+    recomputed = threading.Semaphore(0)
+    materializer.listeners.append(lambda *_: recomputed.release())
+
+    materializer.start()
+    assert recomputed.acquire(timeout=1)
+
+    materializer.invalidate()
+
+    # Well before the head departure
+    assert recomputed.acquire(timeout=1)
+
+
+def network():
+    """
+    The feed and TCL APIs legs share.
+    """
+    return SimpleNamespace(
+        gtfs=SimpleNamespace(),
+        delay_api=SimpleNamespace(cache=SimpleNamespace(generation=1)),
+        incident_api=SimpleNamespace(cache=SimpleNamespace(generation=1)),
+    )
+
+
+class CountingLeg(SimpleNamespace):
+    """
+    Leg of T1 between two stops, counting the lookups made through it in `calls`.
+    """
+
+    def __init__(self, calls: list, network, *, stops=(1, 2)):
+        super().__init__(
+            gtfs=network.gtfs,
+            delay_api=network.delay_api,
+            incident_api=network.incident_api,
+            from_stop=stops[0],
+            to_stop=stops[1],
+            line_short_name="T1",
+        )
+        self.calls = calls
+
+    def get_departures(self, utc_timestamp):
+        self.calls.append(("departures", self.from_stop, self.to_stop))
+        return []
+
+    def get_incidents(self):
+        self.calls.append(("incidents", self.line_short_name))
+        return []
+
+    def get_delays(self, trip_id):
+        self.calls.append(("delay", trip_id))
+        return None
+
+
+def test_legs_share_lookups_they_have_in_common():
+    calls = []
+    shared_network = network()
+    legs = [
+        CountingLeg(calls, shared_network),
+        CountingLeg(calls, shared_network),
+        CountingLeg(calls, shared_network, stops=(1, 3)),
+    ]
+    shared = estimates.SharedLookups()
+
+    for leg in legs:
+        shared.departures(leg)
+        shared.incidents(leg)
+        shared.delay(leg, "T1-A-2105")
+
+    assert calls == [
+        ("departures", 1, 2),
+        ("incidents", "T1"),
+        ("delay", "T1-A-2105"),
+        ("departures", 1, 3),
+    ]
+
+
+def test_refresh_landing_is_not_hidden_by_shared_lookups():
+    calls = []
+    leg = CountingLeg(calls, network())
+    shared = estimates.SharedLookups()
+
+    shared.delay(leg, "T1-A-2105")
+    leg.delay_api.cache.generation += 1
+    shared.delay(leg, "T1-A-2105")
+
+    assert calls == [("delay", "T1-A-2105")] * 2
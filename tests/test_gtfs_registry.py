@@ -0,0 +1,99 @@
+import threading
+import time
+import zipfile
+
+import pytest
+
+from modules.trips import gtfs_registry
+from modules.trips.gtfs_registry import GtfsRegistry
+
+from tests.test_leg import FEED
+
+
+def write_feed(path, feed: dict[str, str]):
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, content in feed.items():
+            archive.writestr(name, content)
+
+
+@pytest.fixture
+def feed_path(tmp_path):
+    GtfsRegistry.clear()
+    path = tmp_path / "GTFS.ZIP"
+    write_feed(path, FEED)
+    yield str(path)
+    GtfsRegistry.clear()
+
+
+def test_feed_is_loaded_once_and_reported(feed_path):
+    gtfs = GtfsRegistry.get(feed_path)
+
+    assert GtfsRegistry.get(feed_path) is gtfs
+    (report,) = GtfsRegistry.reports()
+    assert report.path == feed_path
+    assert report.content_hash == gtfs.content_hash
+    assert report.source == "zip"
+    assert report.memory_bytes == gtfs.memory_usage()
+    assert report.compaction["bytes_after"] < report.compaction["bytes_before"]
+
+
+def test_changed_file_replaces_the_previous_feed(feed_path):
+    previous = GtfsRegistry.get(feed_path)
+
+    write_feed(
+        feed_path,
+        {
+            **FEED,
+            "stops.txt": FEED["stops.txt"] + "3,Bellecour,45.75,4.83\n",
+        },
+    )
+    gtfs = GtfsRegistry.get(feed_path)
+
+    assert gtfs is not previous
+    assert gtfs.content_hash != previous.content_hash
+    assert GtfsRegistry.feeds() == [gtfs]
+    assert [report.content_hash for report in GtfsRegistry.reports()] == [
+        gtfs.content_hash
+    ]
+
+
+def test_concurrent_callers_share_one_load(feed_path, monkeypatch):
+    loads = []
+    load = GtfsRegistry._load.__func__
+
+    def slow_load(cls, path, content_hash):
+        loads.append(path)
+        time.sleep(0.05)
+        return load(cls, path, content_hash)
+
+    monkeypatch.setattr(GtfsRegistry, "_load", classmethod(slow_load))
+    feeds = []
+    threads = [
+        threading.Thread(
+            target=lambda: feeds.append(GtfsRegistry.get(feed_path))
+        )
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert loads == [feed_path]
+    assert len(feeds) == 4 and all(gtfs is feeds[0] for gtfs in feeds)
+
+
+def test_unchanged_file_is_not_hashed_again(feed_path, monkeypatch):
+    hashed = []
+    file_content_hash = gtfs_registry.file_content_hash
+
+    def counting_hash(path):
+        hashed.append(path)
+        return file_content_hash(path)
+
+    monkeypatch.setattr(gtfs_registry, "file_content_hash", counting_hash)
+
+    GtfsRegistry.get(feed_path)
+    GtfsRegistry.get(feed_path)
+
+    assert hashed == [feed_path]
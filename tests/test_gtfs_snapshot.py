@@ -0,0 +1,113 @@
+import fcntl
+import os
+import sys
+import threading
+from datetime import datetime
+
+import gtfs_kit as gk
+import pytest
+
+from modules.trips import compile_gtfs, gtfs_snapshot
+from modules.trips.gtfs import Gtfs
+from modules.trips.gtfs_compact import compact_feed
+from modules.trips.gtfs_snapshot import (
+    LOCK_FILE,
+    ensure_snapshot,
+    file_content_hash,
+    load_snapshot,
+    snapshot_root,
+)
+
+from tests.test_gtfs_registry import write_feed
+from tests.test_leg import FEED, TZ
+
+
+@pytest.fixture
+def feed_path(tmp_path, monkeypatch):
+    monkeypatch.delenv("GTFS_SNAPSHOT_DIR", raising=False)
+    path = tmp_path / "GTFS.ZIP"
+    write_feed(path, FEED)
+    return str(path)
+
+
+@pytest.fixture
+def compiles(monkeypatch):
+    """
+    ZIPs compiled to a snapshot, in order.
+    """
+    compiled = []
+    compile_snapshot = gtfs_snapshot.compile_snapshot
+
+    def counting_compile(zip_path, content_hash=None):
+        compiled.append(zip_path)
+        return compile_snapshot(zip_path, content_hash)
+
+    monkeypatch.setattr(gtfs_snapshot, "compile_snapshot", counting_compile)
+    return compiled
+
+
+def test_snapshot_holds_the_compacted_feed(feed_path):
+    ensure_snapshot(feed_path)
+
+    snapshot = load_snapshot(feed_path, file_content_hash(feed_path))
+    compacted, _ = compact_feed(gk.read_feed(feed_path, dist_units="km"))
+
+    for table in ["stops", "trips", "stop_times", "calendar"]:
+        loaded, expected = getattr(snapshot, table), getattr(compacted, table)
+        assert list(loaded.columns) == list(expected.columns)
+        assert loaded.astype(str).equals(expected.astype(str))
+
+
+def test_feed_loaded_from_the_snapshot_answers_the_same(feed_path):
+    from_zip = Gtfs(feed_path)
+    ensure_snapshot(feed_path)
+    from_snapshot = Gtfs(feed_path)
+    at = datetime(2026, 10, 18, 20, 0, tzinfo=TZ)
+
+    assert (from_zip.source, from_snapshot.source) == ("zip", "snapshot")
+    assert from_snapshot.next_departures_at_stop(
+        1, local_timestamp=at
+    ) == from_zip.next_departures_at_stop(1, local_timestamp=at)
+
+
+def test_stale_snapshot_is_replaced(feed_path, compiles):
+    stale = ensure_snapshot(feed_path)
+    write_feed(
+        feed_path,
+        {**FEED, "stops.txt": FEED["stops.txt"] + "3,Bellecour,45.75,4.83\n"},
+    )
+
+    assert load_snapshot(feed_path, file_content_hash(feed_path)) is None
+
+    directory = ensure_snapshot(feed_path)
+
+    assert directory != stale
+    assert not os.path.exists(stale)
+    assert compiles == [feed_path, feed_path]
+
+
+def test_up_to_date_snapshot_is_compiled_only_when_forced(feed_path, compiles):
+    ensure_snapshot(feed_path)
+    ensure_snapshot(feed_path)
+    assert len(compiles) == 1
+
+    ensure_snapshot(feed_path, force=True)
+    assert len(compiles) == 2
+
+
+def test_command_line_waits_for_the_lock(feed_path, compiles, monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["compile_gtfs", feed_path])
+    os.makedirs(snapshot_root(feed_path), exist_ok=True)
+
+    with open(os.path.join(snapshot_root(feed_path), LOCK_FILE), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        command = threading.Thread(target=compile_gtfs.main)
+        command.start()
+        command.join(0.2)
+
+        # Another process is compiling
+        assert command.is_alive()
+        assert compiles == []
+
+    command.join()
+    assert compiles == [feed_path]
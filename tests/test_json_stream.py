@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from grand_lyon_data.sytral.json_stream import JsonRowsDecoder
+
+PAGE = {
+    "nb_results": 3,
+    "values": [
+        {"id": "1", "message": 'Arrêt "Perrache" déplacé, voir \\ plan'},
+        {"id": "2", "message": "Ligne\nfermée été \\u0041"},
+        {"id": "3", "delay": -12.5e1, "tags": ["a,b", "]}"], "note": None},
+    ],
+    "table_href": "https://data.grandlyon.com/",
+}
+
+
+def decode(chunks: list[str]) -> tuple[list, dict]:
+    decoder = JsonRowsDecoder("values")
+    rows = [row for chunk in chunks for row in decoder.feed(chunk)]
+    rows.extend(decoder.close())
+
+    return rows, decoder.members
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64])
+def test_rows_cut_anywhere(size):
+    body = json.dumps(PAGE, ensure_ascii=False, indent=1)
+    chunks = [body[start : start + size] for start in range(0, len(body), size)]
+
+    rows, members = decode(chunks)
+
+    assert rows == PAGE["values"]
+    assert members == {
+        "nb_results": 3,
+        "table_href": "https://data.grandlyon.com/",
+    }
+
+
+def test_cut_inside_an_escape():
+    body = json.dumps(PAGE)
+    # Right after the backslash of the first \" of the first message
+    cut = body.index('\\"') + 1
+
+    rows, _ = decode([body[:cut], body[cut:]])
+
+    assert rows == PAGE["values"]
+
+
+def test_number_cut_at_a_chunk_boundary():
+    rows, members = decode(['{"nb_results": 1', '2, "values": []}'])
+
+    assert rows == []
+    assert members == {"nb_results": 12}
+
+
+def test_truncated_page_raises():
+    body = json.dumps(PAGE)
+
+    with pytest.raises(ValueError):
+        decode([body[: len(body) // 2]])
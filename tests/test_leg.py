@@ -0,0 +1,65 @@
+import zipfile
+from datetime import date, datetime
+
+import pytest
+from apscheduler.util import ZoneInfo
+
+from modules.trips.gtfs import Gtfs
+from modules.trips.leg import SingleLeg
+
+TZ = ZoneInfo("Europe/Paris")
+
+FEED = {
+    "agency.txt": "agency_id,agency_name,agency_url,agency_timezone\n"
+    "TCL,TCL,https://www.tcl.fr,Europe/Paris\n",
+    "stops.txt": "stop_id,stop_name,stop_lat,stop_lon\n"
+    "1,Perrache,45.74,4.82\n2,Part-Dieu,45.76,4.86\n",
+    "routes.txt": "route_id,agency_id,route_short_name,route_long_name,route_type\n"
+    "T2,TCL,T2,Perrache - Part-Dieu,0\n",
+    "calendar.txt": "service_id,monday,tuesday,wednesday,thursday,friday,"
+    "saturday,sunday,start_date,end_date\n"
+    "DAILY,1,1,1,1,1,1,1,20260101,20261231\n",
+    "trips.txt": "route_id,service_id,trip_id,trip_headsign,direction_id\n"
+    "T2,DAILY,evening,Part-Dieu,0\nT2,DAILY,late,Part-Dieu,0\n",
+    "stop_times.txt": "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+    "evening,21:00:00,21:00:00,1,1\nevening,21:15:00,21:15:00,2,2\n"
+    "late,24:05:00,24:05:00,1,1\nlate,24:20:00,24:20:00,2,2\n",
+}
+
+
+@pytest.fixture
+def leg(tmp_path, next_passage_api, incident_api):
+    path = tmp_path / "GTFS.ZIP"
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, content in FEED.items():
+            archive.writestr(name, content)
+
+    return SingleLeg(
+        id=1,
+        from_stop=1,
+        to_stop=2,
+        gtfs=Gtfs(str(path)),
+        transport_incident_api=incident_api,
+        delay_api=next_passage_api,
+    )
+
+
+def test_arrival_past_midnight_is_on_the_trip_service_day(leg):
+    estimates = leg.get_estimates(datetime(2026, 10, 18, 23, 0, tzinfo=TZ))
+
+    # Departing at 24:05 of the 18th, the trip also runs on the 19th
+    assert estimates[0] == (
+        "late",
+        datetime(2026, 10, 19, 0, 5, tzinfo=TZ),
+        datetime(2026, 10, 19, 0, 20, tzinfo=TZ),
+    )
+
+
+def test_departures_carry_their_service_date(leg):
+    departures = leg.get_departures(datetime(2026, 10, 18, 22, 0, tzinfo=TZ))
+
+    assert departures[0] == (
+        "late",
+        datetime(2026, 10, 19, 0, 5, tzinfo=TZ),
+        date(2026, 10, 18),
+    )
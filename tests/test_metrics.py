@@ -0,0 +1,82 @@
+import pytest
+
+from instrumentation.metrics import Metrics
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    monkeypatch.setattr(Metrics, "_instance", None)
+    return Metrics.get_instance()
+
+
+def test_counter_renders_one_sample_per_label_values(metrics):
+    requests = metrics.counter(
+        "requests_total", "Requests", ("route", "status")
+    )
+    requests.inc("/legs", "200")
+    requests.inc("/legs", "200")
+    requests.inc("/legs", "500", amount=3)
+
+    assert metrics.render() == (
+        "# HELP home_dashboard_requests_total Requests\n"
+        "# TYPE home_dashboard_requests_total counter\n"
+        'home_dashboard_requests_total{route="/legs",status="200"} 2\n'
+        'home_dashboard_requests_total{route="/legs",status="500"} 3\n'
+    )
+
+
+def test_histogram_buckets_are_cumulative(metrics):
+    durations = metrics.histogram(
+        "duration_seconds", "Durations", ("dataset",), buckets=(0.1, 1)
+    )
+    durations.observe(0.05, "passages")
+    durations.observe(0.1, "passages")
+    durations.observe(0.5, "passages")
+    durations.observe(2, "passages")
+
+    assert metrics.render().splitlines()[2:] == [
+        'home_dashboard_duration_seconds_bucket{dataset="passages",le="0.1"} 2',
+        'home_dashboard_duration_seconds_bucket{dataset="passages",le="1"} 3',
+        'home_dashboard_duration_seconds_bucket{dataset="passages",le="+Inf"} 4',
+        'home_dashboard_duration_seconds_sum{dataset="passages"} 2.65',
+        'home_dashboard_duration_seconds_count{dataset="passages"} 4',
+    ]
+
+
+def test_timed_block_is_observed_when_it_raises(metrics):
+    durations = metrics.histogram("duration_seconds", "Durations")
+
+    with pytest.raises(ValueError):
+        with durations.time():
+            raise ValueError()
+
+    assert "home_dashboard_duration_seconds_count 1" in metrics.render()
+
+
+def test_label_values_are_escaped(metrics):
+    metrics.counter("errors_total", "Errors", ("error",)).inc('say "hi"\n')
+
+    assert (
+        'home_dashboard_errors_total{error="say \\"hi\\"\\n"} 1'
+        in metrics.render()
+    )
+
+
+def test_declaring_a_metric_twice_returns_the_first(metrics):
+    first = metrics.counter("requests_total", "Requests")
+
+    assert metrics.counter("requests_total", "Requests") is first
+
+
+def test_broken_collector_leaves_the_others(metrics):
+    def broken():
+        raise RuntimeError("Cache not loaded")
+
+    def workers():
+        family = metrics.family("workers", "Workers", "gauge")
+        family.samples.append(("", {}, 4))
+        return [family]
+
+    metrics.collectors.extend([broken, workers])
+
+    assert "home_dashboard_workers 4" in metrics.render()
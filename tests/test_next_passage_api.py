@@ -0,0 +1,116 @@
+import pytest
+
+from grand_lyon_data.sytral.base_stryal_api import SytralAPICache
+from grand_lyon_data.sytral.next_passage_api import NextPassageLine
+
+from tests.conftest import passage_row
+
+
+def fill(api, rows):
+    cache = SytralAPICache(type(api).index_fields)
+    for row in rows:
+        cache.add(api.row_key(row), api.parse_row(row))
+    api.adopt(cache)
+
+
+def test_trip_id_matches_courses_containing_it(next_passage_api):
+    fill(
+        next_passage_api,
+        [
+            passage_row(coursetheorique="T1-A-2105"),
+            passage_row(coursetheorique="12345AM:T1-A-2105:2"),
+            passage_row(coursetheorique="T1-A-2106"),
+        ],
+    )
+
+    courses = {
+        passage.coursetheorique
+        for passage in next_passage_api.get(trip_id="T1-A-2105")
+    }
+
+    assert courses == {"T1-A-2105", "12345AM:T1-A-2105:2"}
+
+
+def test_trip_id_is_not_a_pattern(next_passage_api):
+    fill(next_passage_api, [passage_row(coursetheorique="T1xA-2105")])
+
+    assert next_passage_api.get(trip_id="T1.A-2105") == []
+
+
+def test_trip_id_and_stop_id(next_passage_api):
+    fill(
+        next_passage_api,
+        [
+            passage_row(id="30211", coursetheorique="X:T1-A-2105"),
+            passage_row(id="30212", coursetheorique="X:T1-A-2105"),
+        ],
+    )
+
+    (passage,) = next_passage_api.get(trip_id="T1-A-2105", stop_id=30212)
+
+    assert passage.id == 30212
+
+
+def test_lookups_return_rows_in_upstream_order(next_passage_api):
+    courses = [f"T1-A-{number}" for number in [2110, 2101, 2107, 2103, 2109]]
+    fill(
+        next_passage_api,
+        [passage_row(coursetheorique=course) for course in courses],
+    )
+
+    assert [
+        passage.coursetheorique
+        for passage in next_passage_api.get(stop_id=30211)
+    ] == courses
+    assert [
+        passage.coursetheorique
+        for passage in next_passage_api.get(trip_id="T1-A-21")
+    ] == courses
+
+
+def test_trip_id_is_looked_up_in_the_index(next_passage_api):
+    fill(
+        next_passage_api,
+        [
+            passage_row(coursetheorique="12345AM:T1-A-2105:2"),
+            passage_row(coursetheorique="T1-A-21050"),
+        ],
+    )
+
+    (passage,) = next_passage_api.get(trip_id="T1-A-2105")
+
+    assert passage.coursetheorique == "12345AM:T1-A-2105:2"
+    # No course was searched
+    assert next_passage_api.cache._pattern_matches == {}
+
+
+def test_trip_id_in_courses_of_another_format(next_passage_api):
+    fill(next_passage_api, [passage_row(coursetheorique="T1-A-2105/R")])
+
+    (passage,) = next_passage_api.get(trip_id="T1-A-2105")
+
+    assert passage.coursetheorique == "T1-A-2105/R"
+
+
+def test_searches_remembered_are_bounded(next_passage_api, monkeypatch):
+    monkeypatch.setattr(SytralAPICache, "max_pattern_matches", 2)
+    fill(next_passage_api, [passage_row()])
+
+    for number in range(5):
+        assert next_passage_api.get(trip_id=f"T2-B-{number}") == []
+
+    assert len(next_passage_api.cache._pattern_matches) <= 2
+
+
+@pytest.mark.parametrize(
+    "overrides",
+    [
+        {"delaipassage": "2 min"},
+        {"delaipassage": "Proche", "idtarretdestination": ""},
+        {"delaipassage": "06h03"},
+    ],
+)
+def test_records_round_trip_through_rows(overrides):
+    passage = NextPassageLine.from_dict(passage_row(**overrides))
+
+    assert NextPassageLine.from_dict(passage.to_dict()) == passage
@@ -0,0 +1,98 @@
+import marshal
+import threading
+import time
+
+import pytest
+
+from instrumentation.profiling import Profiler
+
+
+@pytest.fixture
+def profiler(monkeypatch):
+    monkeypatch.setattr(Profiler, "_instance", None)
+    monkeypatch.setattr(Profiler, "sample_interval", 0.001)
+    return Profiler.get_instance()
+
+
+def refresh_passages():
+    time.sleep(0.02)
+
+
+def profiled_functions(capture) -> set[str]:
+    content, media_type, _ = capture.download()
+    assert media_type == "application/octet-stream"
+
+    return {name for _, _, name in marshal.loads(content)}
+
+
+def test_capture_profiles_the_next_runs_only(profiler):
+    capture = profiler.arm(
+        "refresh", "next_passages", count=2, mode="deterministic"
+    )
+
+    for dataset in ["incidents", "next_passages", "next_passages"]:
+        with profiler.profile("refresh", dataset):
+            refresh_passages()
+
+    assert capture.captured == 2
+    assert not capture.pending and not profiler.armed
+    assert "refresh_passages" in profiled_functions(capture)
+
+    # Disarmed, nothing claims the run anymore
+    assert profiler.claim("refresh", "next_passages") is None
+
+
+def test_nested_runs_are_left_to_the_running_profile(profiler):
+    capture = profiler.arm("route", None, count=2, mode="deterministic")
+
+    with profiler.profile("route", "/legs"):
+        with profiler.profile("route", "/legs"):
+            refresh_passages()
+
+    assert capture.captured == 1 and capture.pending
+
+
+def test_work_handed_to_another_thread_is_profiled(profiler):
+    capture = profiler.arm("route", "/legs", count=1, mode="deterministic")
+
+    with profiler.profile("route", "/legs"):
+        thread = threading.Thread(target=profiler.wrap(refresh_passages))
+        thread.start()
+        thread.join()
+
+    assert "refresh_passages" in profiled_functions(capture)
+
+
+def test_sampled_capture_downloads_folded_stacks(profiler):
+    capture = profiler.arm("refresh", None, count=1, mode="sampled")
+
+    with profiler.profile("refresh", "incidents"):
+        refresh_passages()
+
+    content, media_type, file_name = capture.download()
+    assert (media_type, file_name) == ("text/plain", "profile-1.folded")
+    stacks = dict(line.rsplit(" ", 1) for line in content.decode().splitlines())
+    assert any(
+        stack.startswith("MainThread;")
+        and "refresh_passages (test_profiling.py" in stack
+        for stack in stacks
+    )
+    assert all(int(samples) > 0 for samples in stacks.values())
+
+
+def test_cancelled_capture_disarms(profiler):
+    capture = profiler.arm("route", "/legs", count=1, mode="sampled")
+
+    profiler.cancel(capture.id)
+
+    assert capture.cancelled and not profiler.armed
+    assert profiler.claim("route", "/legs") is None
+
+
+@pytest.mark.parametrize(
+    "target, count, mode",
+    [("legs", 1, "sampled"), ("route", 0, "sampled"), ("route", 1, "fast")],
+)
+def test_invalid_captures_are_refused(profiler, target, count, mode):
+    with pytest.raises(ValueError):
+        profiler.arm(target, None, count=count, mode=mode)
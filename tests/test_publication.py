@@ -0,0 +1,99 @@
+from types import SimpleNamespace
+
+import pytest
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from grand_lyon_data.sytral.next_passage_api import GrandLyonNextPassageApi
+from modules.refresh.publication import (
+    CacheFollower,
+    CachePublisher,
+    SharedSignal,
+)
+from modules.reload.reloader import Reloader
+from modules.trips.trips import Trips
+
+from tests.conftest import passage_row
+from tests.test_next_passage_api import fill
+
+
+@pytest.fixture(autouse=True)
+def shared_state(tmp_path, monkeypatch):
+    monkeypatch.setenv("SHARED_STATE_DIR", str(tmp_path / "state"))
+
+
+def test_follower_adopts_what_is_published(next_passage_api):
+    fill(next_passage_api, [passage_row(), passage_row(id="30212")])
+    next_passage_api.cache.generation = 7
+    CachePublisher("passages", next_passage_api)()
+
+    GrandLyonNextPassageApi._instance = None
+    following = GrandLyonNextPassageApi(url_base="http://127.0.0.1:1")
+    follower = CacheFollower("passages", following)
+
+    assert follower.poll()
+    assert following.cache.generation == 7
+    passages = following.get(trip_id="T1-A-2105")
+    assert {passage.id for passage in passages} == {30211, 30212}
+
+    # Nothing new published
+    assert not follower.poll()
+
+
+def test_follower_waits_for_a_first_publication(next_passage_api):
+    assert not CacheFollower("passages", next_passage_api).poll()
+    assert next_passage_api.get(trip_id="T1-A-2105") == []
+
+
+def test_signal_reaches_other_processes_only():
+    sender, receiver = SharedSignal("reload"), SharedSignal("reload")
+
+    sender.send()
+
+    assert not sender.poll()
+    assert receiver.poll()
+    assert not receiver.poll()
+
+
+def test_signal_sent_before_startup_is_ignored():
+    SharedSignal("reload").send()
+
+    assert not SharedSignal("reload").poll()
+
+
+@pytest.fixture
+def reloader(tmp_path, monkeypatch):
+    """
+    Reloader with peers, watching files that don't exist.
+    """
+    monkeypatch.setattr(
+        Trips,
+        "_instance",
+        SimpleNamespace(
+            legs_file=str(tmp_path / "legs.csv"),
+            gtfs=SimpleNamespace(
+                file_path=str(tmp_path / "GTFS.ZIP"), memory_usage=lambda: 0
+            ),
+        ),
+    )
+    monkeypatch.setattr(Reloader, "_instance", None)
+
+    return Reloader(BackgroundScheduler(), peers=SharedSignal("reload"))
+
+
+def test_admin_reload_is_passed_on_to_peers(reloader):
+    peer = SharedSignal("reload")
+
+    reloader.reload("admin")
+
+    assert peer.poll()
+
+
+def test_reload_sent_by_a_peer_happens_on_poll(reloader, monkeypatch):
+    triggers = []
+    monkeypatch.setattr(reloader, "reload", triggers.append)
+
+    SharedSignal("reload").send()
+    reloader.poll()
+    reloader.poll()
+
+    assert triggers == ["peer"]
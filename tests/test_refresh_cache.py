@@ -0,0 +1,115 @@
+import pytest
+
+from grand_lyon_data.sytral.next_passage_api import GrandLyonNextPassageApi
+from grand_lyon_data.sytral.row_filter import RowFilter
+
+from tests.conftest import passage_row
+
+
+@pytest.fixture
+def api(upstream):
+    GrandLyonNextPassageApi._instance = None
+    upstream.rows = [
+        passage_row(coursetheorique=f"T1-A-{number}") for number in range(25)
+    ]
+    api = GrandLyonNextPassageApi(
+        url_base=upstream.url_base, maxfeatures=10, max_workers=2
+    )
+    yield api
+    api.close()
+    GrandLyonNextPassageApi._instance = None
+
+
+def test_refresh_with_known_total(api):
+    stats = api.refresh_cache()
+
+    assert len(api.cache.entries) == 25
+    assert stats.added == 25
+    # The first page tells the total, only the pages holding rows are requested
+    assert stats.requests == 3
+
+
+def test_refresh_with_unknown_total(upstream, api):
+    upstream.reports_total = False
+
+    stats = api.refresh_cache()
+
+    assert len(api.cache.entries) == 25
+    assert stats.added == 25
+    # Pages are requested until one comes back short
+    assert stats.requests >= 3
+
+
+def test_failed_refresh_keeps_the_previous_snapshot(upstream, api):
+    api.refresh_cache()
+    previous = api.cache
+    upstream.rows = upstream.rows[:20]
+    upstream.failing_start = 11
+
+    with pytest.raises(RuntimeError, match="500"):
+        api.refresh_cache()
+
+    assert api.cache is previous
+    assert len(api.cache.entries) == 25
+    assert api.last_refresh_failed_at is not None
+
+
+def test_incremental_refresh_of_unchanged_rows_reuses_records(api):
+    api.refresh_cache()
+    previous = api.cache
+
+    stats = api.refresh_cache(incremental=True)
+
+    assert stats.unchanged == 25
+    assert stats.added == stats.updated == stats.removed == 0
+    assert api.cache.generation == previous.generation + 1
+    assert all(
+        api.cache.entries[key] is entry
+        for key, entry in previous.entries.items()
+    )
+
+
+def test_incremental_refresh_keeps_rows_sharing_a_key(upstream, api):
+    # Same stop, course and last_update_fme, different passages
+    upstream.rows = [
+        passage_row(delaipassage="2 min"),
+        passage_row(delaipassage="9 min"),
+    ]
+    api.refresh_cache(incremental=False)
+
+    stats = api.refresh_cache(incremental=True)
+
+    assert len(api.cache.entries) == 2
+    assert stats.unchanged == 2
+    assert stats.removed == 0
+    assert sorted(
+        passage.delaipassage.total_seconds()
+        for passage in api.cache.entries.values()
+    ) == [120, 540]
+
+
+def test_connections_are_kept_across_refreshes(upstream, api):
+    api.refresh_cache()
+    api.refresh_cache()
+
+    # One per concurrently fetched page
+    assert upstream.connections <= api.max_workers
+    kept = upstream.connections
+
+    api.close()
+    api.refresh_cache()
+
+    assert upstream.connections > kept
+
+
+def test_server_filter_downloads_only_matching_rows(upstream, api):
+    upstream.rows += [passage_row(id="30300", coursetheorique="C3-R-1")]
+    api.row_filter = lambda: RowFilter(
+        values={"id": frozenset({"30300"})}, server_field="id"
+    )
+
+    stats = api.refresh_cache()
+
+    assert [passage.id for passage in api.cache.entries.values()] == [30300]
+    assert stats.filtered == 0
+    assert {query["value"][0] for query in upstream.queries} == {"30300"}
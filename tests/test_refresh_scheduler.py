@@ -0,0 +1,158 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.util import ZoneInfo
+
+from grand_lyon_data.sytral.base_stryal_api import RefreshStats
+from modules.refresh.scheduler import (
+    DemandTracker,
+    RefreshPolicy,
+    RefreshScheduler,
+)
+
+TZ = ZoneInfo("Europe/Paris")
+
+
+class FixedDemand(DemandTracker):
+    def __init__(self, requests_per_minute: float):
+        super().__init__()
+        self.rate = requests_per_minute
+
+    def requests_per_minute(self) -> float:
+        return self.rate
+
+
+class FakeGtfs:
+    """
+    A feed whose only trips run for an hour, starting in starts_in.
+    """
+
+    tz = TZ
+
+    def __init__(self, starts_in: timedelta):
+        self.start = datetime.now(TZ) + starts_in
+
+    def current_service_date(self, now):
+        return now.date()
+
+    def service_window(self, day):
+        if day != self.start.date():
+            return None
+        return self.start, self.start + timedelta(hours=1)
+
+
+def policy(name: str = "next_passages") -> RefreshPolicy:
+    return RefreshPolicy(
+        name=name,
+        api=SimpleNamespace(requests_made=0),
+        min_interval=timedelta(minutes=1),
+        max_interval=timedelta(minutes=10),
+        busy_requests_per_minute=2,
+    )
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    """
+    Scheduler of two policies, in service, its demand set with `demand.rate`.
+    """
+    monkeypatch.setattr(RefreshScheduler, "_instance", None)
+    return RefreshScheduler(
+        BackgroundScheduler(),
+        policies=[policy(), policy("incidents")],
+        gtfs_provider=lambda: None,
+        demand=FixedDemand(0),
+    )
+
+
+def interval(decision) -> timedelta:
+    return decision.next_run_at - decision.decided_at
+
+
+def changes(ratio: float) -> RefreshStats:
+    return RefreshStats(
+        updated=int(ratio * 100), unchanged=100 - int(ratio * 100)
+    )
+
+
+def test_interval_follows_demand(scheduler):
+    intervals = []
+    for rate in [0, 1, 10]:
+        scheduler.demand.rate = rate
+        intervals.append(
+            interval(scheduler.decide(policy(), stats=None, spent=0))
+        )
+
+    assert intervals == [
+        timedelta(minutes=10),
+        timedelta(minutes=5.5),
+        timedelta(minutes=1),
+    ]
+
+
+def test_interval_follows_changes(scheduler):
+    scheduler.demand.rate = 1
+
+    unchanged = scheduler.decide(policy(), stats=changes(0), spent=0)
+    changing = scheduler.decide(policy(), stats=changes(0.5), spent=0)
+
+    assert interval(unchanged) == timedelta(minutes=5.5 * 1.5)
+    assert "nothing changed" in unchanged.reason
+    assert interval(changing) == timedelta(minutes=5.5 / 2)
+    assert "50% changed" in changing.reason
+
+
+def test_interval_stays_within_bounds(scheduler):
+    scheduler.demand.rate = 10
+    assert interval(
+        scheduler.decide(policy(), stats=changes(0.5), spent=0)
+    ) == timedelta(minutes=1)
+
+    scheduler.demand.rate = 0
+    assert interval(
+        scheduler.decide(policy(), stats=changes(0), spent=0)
+    ) == timedelta(minutes=10)
+
+
+def test_expensive_refreshes_are_spread_within_the_budget(
+    scheduler, monkeypatch
+):
+    monkeypatch.setattr(RefreshScheduler, "upstream_requests_per_hour", 120)
+    scheduler.demand.rate = 10
+
+    decision = scheduler.decide(policy(), stats=None, spent=30)
+
+    # Half the budget each, 30 requests out of 60 an hour
+    assert interval(decision) == timedelta(minutes=30)
+    assert "upstream budget" in decision.reason
+
+
+def test_budget_counts_every_policy(scheduler):
+    scheduler.decide(policy(), stats=None, spent=5)
+    decision = scheduler.decide(policy("incidents"), stats=None, spent=3)
+
+    assert decision.budget_used == 8
+    assert scheduler.status()["budget_used"] == 8
+
+
+def test_no_polling_until_the_service_starts(scheduler):
+    scheduler.gtfs_provider = lambda: FakeGtfs(timedelta(hours=2))
+    scheduler.demand.rate = 10
+
+    decision = scheduler.decide(policy(), stats=None, spent=0)
+
+    assert not decision.in_service
+    # service_lead before the first trip
+    assert interval(decision).total_seconds() == pytest.approx(
+        (timedelta(hours=2) - timedelta(minutes=15)).total_seconds(), abs=1
+    )
+
+
+def test_polling_resumes_ahead_of_the_service(scheduler):
+    scheduler.gtfs_provider = lambda: FakeGtfs(timedelta(minutes=10))
+
+    decision = scheduler.decide(policy(), stats=None, spent=0)
+
+    assert decision.in_service
@@ -0,0 +1,48 @@
+from types import SimpleNamespace
+
+from modules.trips.relevance import LegRelevance
+
+from tests.conftest import passage_row
+
+
+def leg(from_stop, to_stop, line):
+    return SimpleNamespace(
+        from_stop=from_stop, to_stop=to_stop, line_short_name=line
+    )
+
+
+def test_filters_keep_the_legs_stops_and_lines():
+    relevance = LegRelevance(
+        lambda: [leg(30211, 30199, "T1"), leg(30211, 1500, "C8")]
+    )
+
+    next_passages = relevance.next_passages()
+    incidents = relevance.incidents()
+
+    assert next_passages.server_queries(max_queries=8) == [
+        {"field": "id", "value": value} for value in ["1500", "30199", "30211"]
+    ]
+    assert next_passages.accepts(passage_row(id="1500"))
+    assert not next_passages.accepts(passage_row(id="1501"))
+    # Incident lookups on "C8" also match "C8A"
+    assert incidents.accepts({"ligne_com": "C8A"})
+    assert not incidents.accepts({"ligne_com": "T2"})
+
+
+def test_without_legs_nothing_is_kept():
+    relevance = LegRelevance(lambda: [])
+
+    assert relevance.next_passages().server_queries(max_queries=8) == []
+    assert not relevance.incidents().accepts({"ligne_com": "T1"})
+
+
+def test_filters_follow_the_legs():
+    legs = [leg(30211, 30199, "T1")]
+    relevance = LegRelevance(lambda: legs)
+    first = relevance.next_passages()
+
+    assert relevance.next_passages() is first
+
+    legs.append(leg(1500, 1501, "C8"))
+
+    assert relevance.next_passages().accepts(passage_row(id="1501"))
@@ -0,0 +1,118 @@
+from types import SimpleNamespace
+
+import pytest
+from apscheduler.schedulers.background import BackgroundScheduler
+
+from modules.reload import reloader as reloader_module
+from modules.reload.reloader import Reloader
+from modules.trips.trips import Trips
+
+
+class FakeTrips:
+    """
+    Serves legs_file against gtfs, recording every swap.
+    """
+
+    def __init__(self, legs_file: str, gtfs):
+        self.legs_file = legs_file
+        self.gtfs = gtfs
+        self.legs = []
+
+    def swap(self, gtfs, legs):
+        self.gtfs, self.legs = gtfs, legs
+
+
+def feed(file_path: str, memory_bytes: int = 100):
+    return SimpleNamespace(
+        file_path=file_path,
+        memory_usage=lambda: memory_bytes,
+        prefetch_upcoming_service_days=lambda: None,
+    )
+
+
+@pytest.fixture
+def files(tmp_path):
+    legs_file, gtfs_file = tmp_path / "legs.csv", tmp_path / "GTFS.ZIP"
+    legs_file.write_text("id,from_stop_id,to_stop_id\n1,1,2\n")
+    gtfs_file.write_bytes(b"feed")
+    return legs_file, gtfs_file
+
+
+@pytest.fixture
+def trips(files, monkeypatch):
+    legs_file, gtfs_file = files
+    trips = FakeTrips(str(legs_file), feed(str(gtfs_file)))
+    monkeypatch.setattr(Trips, "_instance", trips)
+    # Every load of the feed gives a new one, twice as big
+    monkeypatch.setattr(
+        reloader_module.GtfsRegistry,
+        "get",
+        lambda path, from_snapshot: feed(path, memory_bytes=200),
+    )
+    monkeypatch.setattr(
+        Trips, "load_legs", lambda legs_file, gtfs: ["leg", "leg"]
+    )
+    return trips
+
+
+@pytest.fixture
+def reloader(trips, monkeypatch):
+    monkeypatch.setattr(Reloader, "_instance", None)
+    return Reloader(BackgroundScheduler())
+
+
+def test_reload_swaps_and_reports(reloader, trips):
+    report = reloader.reload("admin")
+
+    assert trips.legs == ["leg", "leg"]
+    assert report.error is None
+    assert report.gtfs_reloaded
+    assert (report.gtfs_memory_before, report.gtfs_memory_after) == (100, 200)
+    assert report.legs == 2
+    assert reloader.status()["reloads"] == [report.to_dict()]
+
+
+def test_failed_reload_keeps_the_current_state(reloader, trips, monkeypatch):
+    def invalid_legs(legs_file, gtfs):
+        raise ValueError("Stop 2 is not in the feed")
+
+    monkeypatch.setattr(Trips, "load_legs", invalid_legs)
+    gtfs = trips.gtfs
+
+    report = reloader.reload("admin")
+
+    assert "Stop 2 is not in the feed" in report.error
+    assert trips.gtfs is gtfs and trips.legs == []
+
+
+def test_changed_file_is_reloaded_once_stable(reloader, files):
+    legs_file, _ = files
+
+    reloader.poll()
+    assert not reloader.reports
+
+    legs_file.write_text("id,from_stop_id,to_stop_id\n1,1,2\n2,2,1\n")
+    # Maybe still being written
+    reloader.poll()
+    assert not reloader.reports
+
+    reloader.poll()
+    reloader.poll()
+
+    assert [report.trigger for report in reloader.reports] == ["watch"]
+
+
+def test_failed_files_are_not_retried(reloader, files, monkeypatch):
+    legs_file, _ = files
+
+    def invalid_legs(legs_file, gtfs):
+        raise ValueError("Stop 2 is not in the feed")
+
+    monkeypatch.setattr(Trips, "load_legs", invalid_legs)
+    legs_file.write_text("id,from_stop_id,to_stop_id\n2,2,1\n")
+    reloader.poll()
+    reloader.poll()
+    reloader.poll()
+
+    assert [report.trigger for report in reloader.reports] == ["watch"]
+    assert reloader.reports[0].error is not None
@@ -0,0 +1,41 @@
+import re
+
+from grand_lyon_data.sytral.row_filter import RowFilter
+
+from tests.conftest import passage_row
+
+
+def test_rows_must_match_every_criterion():
+    row_filter = RowFilter(
+        values={"id": frozenset({"30211", "30212"})},
+        patterns={"ligne": re.compile("T1")},
+    )
+
+    assert row_filter.accepts(passage_row(id="30212", ligne="T1"))
+    assert not row_filter.accepts(passage_row(id="30213", ligne="T1"))
+    assert not row_filter.accepts(passage_row(id="30211", ligne="C3"))
+    assert not row_filter.accepts(passage_row(id=None))
+
+
+def test_one_server_query_per_value():
+    row_filter = RowFilter(
+        values={"id": frozenset({"30212", "30211"})}, server_field="id"
+    )
+
+    assert row_filter.server_queries(max_queries=8) == [
+        {"field": "id", "value": "30211"},
+        {"field": "id", "value": "30212"},
+    ]
+
+
+def test_full_scan_past_max_queries_or_without_server_field():
+    values = {"id": frozenset({"30211", "30212", "30213"})}
+
+    assert RowFilter(values=values, server_field="id").server_queries(2) == [{}]
+    assert RowFilter(values=values).server_queries(8) == [{}]
+
+
+def test_no_scan_when_no_value_is_accepted():
+    row_filter = RowFilter(values={"id": frozenset()}, server_field="id")
+
+    assert row_filter.server_queries(max_queries=8) == []
@@ -0,0 +1,77 @@
+from datetime import date, datetime
+
+import pandas as pd
+
+from modules.trips.service_calendar import WEEKDAYS, ServiceCalendar
+
+
+def calendar_row(service_id, days, start_date, end_date) -> dict:
+    return {
+        "service_id": service_id,
+        **{weekday: int(weekday in days) for weekday in WEEKDAYS},
+        "start_date": start_date,
+        "end_date": end_date,
+    }
+
+
+CALENDAR = pd.DataFrame(
+    [
+        calendar_row("WEEK", WEEKDAYS[:5], "20261001", "20261031"),
+        calendar_row("WEEKEND", WEEKDAYS[5:], "20261001", "20261031"),
+    ]
+)
+
+CALENDAR_DATES = pd.DataFrame(
+    {
+        # Monday 19 off, Sunday 18 runs the week service, Christmas only
+        "service_id": ["WEEK", "WEEK", "XMAS"],
+        "date": ["20261019", "20261018", "20261225"],
+        "exception_type": [2, 1, 1],
+    }
+)
+
+
+def running(calendar: ServiceCalendar, day: date) -> set[str]:
+    return set(calendar.service_ids[calendar.active_services(day)])
+
+
+def test_weekday_flags_within_date_range():
+    calendar = ServiceCalendar(CALENDAR, None)
+
+    assert running(calendar, date(2026, 10, 20)) == {"WEEK"}
+    assert running(calendar, date(2026, 10, 24)) == {"WEEKEND"}
+    # Past end_date
+    assert running(calendar, date(2026, 11, 2)) == set()
+
+
+def test_exceptions_add_and_remove_days():
+    calendar = ServiceCalendar(CALENDAR, CALENDAR_DATES)
+
+    assert running(calendar, date(2026, 10, 19)) == set()
+    assert running(calendar, date(2026, 10, 18)) == {"WEEK", "WEEKEND"}
+    assert running(calendar, date(2026, 12, 25)) == {"XMAS"}
+    # The feed covers up to its last exception, nothing else runs then
+    assert running(calendar, date(2026, 12, 24)) == set()
+
+
+def test_dates_outside_the_feed_run_nothing():
+    calendar = ServiceCalendar(CALENDAR, CALENDAR_DATES)
+
+    assert running(calendar, date(2026, 9, 30)) == set()
+    assert running(calendar, datetime(2027, 1, 1, 8)) == set()
+
+
+def test_unknown_services_never_run():
+    calendar = ServiceCalendar(CALENDAR, CALENDAR_DATES)
+
+    codes = calendar.service_codes(pd.Series(["WEEK", "GONE"]))
+
+    assert codes[0] == calendar.service_ids.get_loc("WEEK")
+    assert codes[1] == -1
+
+
+def test_calendar_dates_only():
+    calendar = ServiceCalendar(None, CALENDAR_DATES)
+
+    assert running(calendar, date(2026, 12, 25)) == {"XMAS"}
+    assert running(calendar, date(2026, 10, 20)) == set()
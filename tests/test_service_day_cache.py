@@ -0,0 +1,95 @@
+import threading
+import time
+from datetime import date, timedelta
+
+from modules.trips.service_day_cache import ServiceDay, ServiceDayCache
+
+MONDAY = date(2026, 10, 19)
+
+
+def day(offset: int) -> date:
+    return MONDAY + timedelta(days=offset)
+
+
+class Loader:
+    """
+    Fake service days of memory_bytes each, taking delay seconds to build.
+    """
+
+    def __init__(self, memory_bytes: int = 100, delay: float = 0):
+        self.memory_bytes = memory_bytes
+        self.delay = delay
+        self.built: list[date] = []
+
+    def __call__(self, service_date: date) -> ServiceDay:
+        self.built.append(service_date)
+        time.sleep(self.delay)
+        return ServiceDay(
+            service_date=service_date,
+            index=None,
+            memory_bytes=self.memory_bytes,
+        )
+
+
+def test_least_recently_used_days_go_first():
+    cache = ServiceDayCache(Loader(), max_bytes=250)
+
+    cache.get(day(0))
+    cache.get(day(1))
+    cache.get(day(0))
+    cache.get(day(2))
+
+    assert cache.stats()["entries"] == [
+        day(0).isoformat(),
+        day(2).isoformat(),
+    ]
+    assert cache.evictions == 1
+    assert cache.memory_usage() == 200
+
+
+def test_day_larger_than_the_budget_is_still_kept():
+    cache = ServiceDayCache(Loader(memory_bytes=500), max_bytes=250)
+
+    cache.get(day(0))
+    cache.get(day(1))
+
+    assert cache.stats()["entries"] == [day(1).isoformat()]
+    assert cache.peek().service_date == day(1)
+
+
+def test_concurrent_callers_build_a_day_once():
+    loader = Loader(delay=0.05)
+    cache = ServiceDayCache(loader, max_bytes=1000)
+    days = []
+    threads = [
+        threading.Thread(target=lambda: days.append(cache.get(day(0))))
+        for _ in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert loader.built == [day(0)]
+    assert all(service_day is days[0] for service_day in days)
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_prefetch_builds_in_the_background_once():
+    loader = Loader(delay=0.05)
+    cache = ServiceDayCache(loader, max_bytes=1000)
+
+    future = cache.prefetch(day(1))
+    assert future is not None
+    while not loader.built:
+        time.sleep(0.001)
+    # Already being built
+    assert cache.prefetch(day(1)) is None
+
+    future.result(timeout=1)
+    # Already cached
+    assert cache.prefetch(day(1)) is None
+    cache.get(day(1))
+
+    assert loader.built == [day(1)]
+    assert cache.hits == 1
@@ -0,0 +1,102 @@
+from datetime import date
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from modules.trips.stop_index import ServiceDayIndex, StopTimesIndex
+
+
+def hms(time: str) -> int:
+    hours, minutes = time.split(":")
+    return int(hours) * 3600 + int(minutes) * 60
+
+
+@pytest.fixture
+def stop_times_index():
+    # trip, stop, time (arrival and departure alike), stop_sequence
+    rows = [
+        ("early", "A", "05:00", 1),
+        ("early", "B", "05:10", 2),
+        ("late", "A", "23:50", 1),
+        ("late", "B", "24:05", 2),
+        ("night", "A", "25:30", 1),
+        ("night", "B", "25:40", 2),
+        ("weekend", "A", "12:00", 1),
+    ]
+    stop_times = pd.DataFrame(
+        {
+            "trip_id": [row[0] for row in rows],
+            "stop_id": [row[1] for row in rows],
+            "arrival_time": np.array([hms(row[2]) for row in rows], np.int32),
+            "departure_time": np.array([hms(row[2]) for row in rows], np.int32),
+            "stop_sequence": [row[3] for row in rows],
+        }
+    )
+
+    return StopTimesIndex.build(
+        stop_times, pd.Index(["early", "late", "night", "weekend"])
+    )
+
+
+@pytest.fixture
+def weekday(stop_times_index):
+    return ServiceDayIndex(
+        date(2026, 10, 19),
+        stop_times_index,
+        np.array([True, True, True, False]),
+    )
+
+
+def test_next_at_stop_is_sorted_and_strictly_after(weekday):
+    assert weekday.next_at_stop(
+        "A", column="departure_time", after_seconds=hms("05:00")
+    ) == [("late", hms("23:50")), ("night", hms("25:30"))]
+
+
+def test_next_at_stop_past_midnight(weekday):
+    assert weekday.next_at_stop(
+        "B", column="arrival_time", after_seconds=hms("24:00")
+    ) == [("late", hms("24:05")), ("night", hms("25:40"))]
+
+
+def test_next_at_stop_count_and_trip_mask(weekday):
+    assert weekday.next_at_stop(
+        "A", column="departure_time", after_seconds=0, count=1
+    ) == [("early", hms("05:00"))]
+    assert weekday.next_at_stop(
+        "A",
+        column="departure_time",
+        after_seconds=0,
+        count=1,
+        trip_mask=np.array([False, False, True, False]),
+    ) == [("night", hms("25:30"))]
+
+
+def test_next_at_stop_skips_trips_not_running(weekday):
+    trips = [
+        trip_id
+        for trip_id, _ in weekday.next_at_stop(
+            "A", column="departure_time", after_seconds=0
+        )
+    ]
+
+    assert "weekend" not in trips
+    assert (
+        weekday.next_at_stop("C", column="departure_time", after_seconds=0)
+        == []
+    )
+
+
+def test_service_day_bounds(weekday):
+    assert weekday.first_seconds == hms("05:00")
+    assert weekday.last_seconds == hms("25:40")
+
+
+def test_day_view_bytes_bounds_any_day(stop_times_index, weekday):
+    every_trip = ServiceDayIndex(
+        date(2026, 10, 19), stop_times_index, np.ones(4, dtype=bool)
+    )
+
+    assert weekday.memory_usage() < stop_times_index.day_view_bytes()
+    assert every_trip.memory_usage() == stop_times_index.day_view_bytes()
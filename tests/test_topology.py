@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from modules.trips.gtfs import Gtfs
+
+from tests.test_gtfs_registry import write_feed
+from tests.test_leg import FEED
+
+# T2 both ways between 1 and 3, C3 from 1 to 3 and a C3 loop 2 -> 4 -> 2
+TRIPS = {
+    "a1": ("T2", "Part-Dieu", [1, 2, 3]),
+    "a2": ("T2", "Part-Dieu", [1, 2, 3]),
+    "b1": ("T2", "Perrache", [3, 2, 1]),
+    "c1": ("C3", "Vaulx", [1, 3]),
+    "l1": ("C3", "Boucle", [2, 4, 2]),
+}
+
+
+@pytest.fixture(scope="module")
+def topology(tmp_path_factory):
+    path = tmp_path_factory.mktemp("feed") / "GTFS.ZIP"
+    write_feed(
+        path,
+        {
+            **FEED,
+            "stops.txt": "stop_id,stop_name,stop_lat,stop_lon\n"
+            "1,Perrache,45.74,4.82\n2,Bellecour,45.75,4.83\n"
+            "3,Part-Dieu,45.76,4.86\n4,Cordeliers,45.76,4.84\n",
+            "routes.txt": "route_id,agency_id,route_short_name,"
+            "route_long_name,route_type\n"
+            "T2,TCL,T2,Perrache - Part-Dieu,0\nC3,TCL,C3,Vaulx,3\n",
+            "trips.txt": "route_id,service_id,trip_id,trip_headsign\n"
+            + "".join(
+                f"{route},DAILY,{trip},{headsign}\n"
+                for trip, (route, headsign, _) in TRIPS.items()
+            ),
+            "stop_times.txt": "trip_id,arrival_time,departure_time,"
+            "stop_id,stop_sequence\n"
+            + "".join(
+                f"{trip},08:0{sequence}:00,08:0{sequence}:00,{stop},{sequence}\n"
+                for trip, (_, _, stops) in TRIPS.items()
+                for sequence, stop in enumerate(stops, start=1)
+            ),
+        },
+    )
+
+    return Gtfs(str(path)).topology
+
+
+def trips(topology, from_stop, to_stop) -> set[str]:
+    codes = topology.trips_between(from_stop, to_stop)
+
+    return set(topology.stop_times_index.trip_ids[codes])
+
+
+def test_trips_between_go_the_right_way(topology):
+    assert trips(topology, 1, 3) == {"a1", "a2", "c1"}
+    assert trips(topology, 3, 1) == {"b1"}
+    assert trips(topology, 2, 3) == {"a1", "a2"}
+
+
+def test_trips_visiting_a_stop_twice(topology):
+    assert trips(topology, 2, 4) == {"l1"}
+    assert trips(topology, 4, 2) == {"l1"}
+
+
+def test_unknown_stops_have_no_trips(topology):
+    assert trips(topology, 1, 99) == set()
+    assert trips(topology, 99, 1) == set()
+    assert topology.lines_at_stop(99) == []
+
+
+def test_mask_matches_trips_between(topology):
+    mask = topology.trip_mask_between(1, 3)
+
+    assert set(np.flatnonzero(mask)) == set(topology.trips_between(1, 3))
+    assert topology.trip_mask_between(1, 3) is mask
+
+
+def test_lines_busiest_first(topology):
+    assert [
+        (line.route_short_name, line.trip_headsign)
+        for line in topology.lines_between(1, 3)
+    ] == [("T2", "Part-Dieu"), ("C3", "Vaulx")]
+    assert {
+        (line.route_short_name, line.trip_headsign)
+        for line in topology.lines_at_stop(2)
+    } == {("T2", "Part-Dieu"), ("T2", "Perrache"), ("C3", "Boucle")}
+    assert topology.stop_name(4) == "Cordeliers"
@@ -0,0 +1,40 @@
+from types import SimpleNamespace
+
+from modules.trips import trips
+
+
+def leg(leg_id: int):
+    return SimpleNamespace(
+        id=leg_id,
+        to_dict=lambda: {"id": leg_id},
+        delay_api=SimpleNamespace(cache_refreshed_at=None),
+    )
+
+
+def test_batch_computes_legs_with_shared_lookups(monkeypatch):
+    seen = []
+
+    def versioned_estimates(leg, shared):
+        seen.append(shared)
+        if leg.id == 2:
+            raise RuntimeError("not in the feed")
+        return trips.VersionedEstimates.of(f'"{leg.id}"', {"estimates": []})
+
+    monkeypatch.setattr(trips, "versioned_estimates", versioned_estimates)
+
+    results = trips.compute_estimates([leg(1), leg(2), leg(3)])
+
+    # One set of lookups for the whole batch
+    assert len(seen) == 3 and seen[0] is seen[1] is seen[2]
+    assert [results[leg_id].etag for leg_id in [1, 2, 3]] == [
+        '"1"',
+        None,
+        '"3"',
+    ]
+    assert results[2].snapshot == {
+        "leg": {"id": 2},
+        "estimates": [],
+        "incidents": [],
+        "sot_updated_at": None,
+        "error": "RuntimeError('not in the feed')",
+    }
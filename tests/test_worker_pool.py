@@ -0,0 +1,93 @@
+import asyncio
+import threading
+
+import pytest
+
+from worker_pool.worker_pool import (
+    WorkerDeadlineExceeded,
+    WorkerPool,
+    WorkerPoolSaturated,
+)
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(WorkerPool, "max_workers", 1)
+    monkeypatch.setattr(WorkerPool, "background_workers", 1)
+    monkeypatch.setattr(WorkerPool, "max_pending", 2)
+    monkeypatch.setattr(WorkerPool, "_instance", None)
+    pool = WorkerPool()
+    yield pool
+    pool.shutdown(wait=False)
+    WorkerPool._instance = None
+
+
+def test_requests_past_max_pending_are_rejected(pool):
+    released = threading.Event()
+
+    async def scenario():
+        running = [
+            asyncio.create_task(pool.run(released.wait)) for _ in range(2)
+        ]
+        await asyncio.sleep(0.05)
+
+        with pytest.raises(WorkerPoolSaturated):
+            await pool.run(lambda: None)
+
+        released.set()
+        await asyncio.gather(*running)
+
+    asyncio.run(scenario())
+
+    assert pool.stats()["rejected"] == 1
+    assert pool.stats()["completed"] == 2
+    assert pool.stats()["pending"] == 0
+
+
+def test_queued_request_past_its_deadline_never_runs(pool):
+    released = threading.Event()
+    ran = []
+
+    async def scenario():
+        running = asyncio.create_task(pool.run(released.wait))
+        await asyncio.sleep(0.05)
+
+        with pytest.raises(WorkerDeadlineExceeded):
+            await pool.run(ran.append, "late", deadline_seconds=0.05)
+
+        released.set()
+        await running
+
+    asyncio.run(scenario())
+
+    assert ran == []
+    assert pool.stats()["timed_out"] == 1
+    assert pool.stats()["pending"] == 0
+
+
+def test_background_jobs_leave_request_threads_alone(pool):
+    released = threading.Event()
+    pool.submit(released.wait)
+    pool.submit(released.wait)
+
+    async def request():
+        return await pool.run(lambda: "served", deadline_seconds=1)
+
+    try:
+        assert asyncio.run(request()) == "served"
+    finally:
+        released.set()
+
+
+def test_coroutines_share_the_pool_event_loop(pool):
+    loops = []
+
+    async def fetch():
+        loops.append(asyncio.get_running_loop())
+        await asyncio.sleep(0.01)
+        return len(loops)
+
+    futures = [pool.run_coroutine(fetch()) for _ in range(3)]
+
+    assert sorted(future.result(timeout=1) for future in futures) == [3] * 3
+    assert set(loops) == {pool.loop}